@@ -0,0 +1 @@
+"""Benchmarks for the gear's post-processing stages (run with `python -m benchmarks.<module>`)."""
@@ -0,0 +1,100 @@
+"""In-process stand-ins for the Flywheel client and gear context, with latency and call counts."""
+
+import io
+import json
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from benchmarks.synthetic_tree import Scan
+
+
+class FakeClient:
+    """The parts of the Flywheel SDK that post-processing calls.
+
+    Every call sleeps for `latency` seconds (plus `per_row` per data view row)
+    and is counted by method name, so stages can report their API traffic.
+
+    Args:
+        scans (List[Scan]): the files the "project" holds, one acquisition each
+        destination_id (str): id of the analysis
+        latency (float): seconds added to each call
+        per_row (float): seconds added per data view row returned
+    """
+
+    def __init__(self, scans: List[Scan], destination_id: str, latency: float = 0.0, per_row: float = 0.0):
+        self.latency = latency
+        self.per_row = per_row
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.file_info: Dict = {}
+        self.destination = SimpleNamespace(
+            id=destination_id,
+            parent=SimpleNamespace(type="project", id="project-0"),
+            parents={"project": "project-0"},
+        )
+        self.rows = [
+            {
+                "acquisition_id": f"acq-{i}",
+                "acquisition_label": scan.bids_name,
+                "file_id": f"file-{i}",
+                "name": f"{scan.bids_name}.nii.gz",
+                "bids_filename": f"{scan.bids_name}.nii.gz",
+            }
+            for i, scan in enumerate(scans)
+        ]
+
+    def _call(self, method: str, rows: int = 0) -> None:
+        with self._lock:
+            self.calls[method] += 1
+        time.sleep(self.latency + rows * self.per_row)
+
+    def get(self, container_id: str):
+        self._call("get")
+        return self.destination
+
+    def View(self, **kwargs):  # noqa: N802 (SDK name)
+        return SimpleNamespace(**kwargs)
+
+    def read_view_data(self, view, container_id: str, format: str = "json", skip: int = 0, limit: int = 1000):
+        page = self.rows[skip : skip + limit]
+        self._call("read_view_data", rows=len(page))
+        return io.BytesIO(b"".join(json.dumps(row).encode() + b"\n" for row in page))
+
+    def modify_acquisition_file_info(self, acquisition_id: str, file_name: str, body: Dict) -> None:
+        self._call("modify_acquisition_file_info")
+        with self._lock:
+            self.file_info[(acquisition_id, file_name)] = body
+
+    def snapshot(self) -> Counter:
+        with self._lock:
+            return Counter(self.calls)
+
+    def updated_files(self) -> int:
+        with self._lock:
+            return len(self.file_info)
+
+
+class FakeMetadata:
+    """Collects what would be written to .metadata.json."""
+
+    def __init__(self):
+        self.containers: Dict = {}
+
+    def update_container(self, container_type: str, deep: bool = True, **kwargs) -> None:
+        self.containers.setdefault(container_type, {}).update(kwargs)
+
+
+class FakeGearContext:
+    """Enough of GearToolkitContext for the post-processing stages."""
+
+    def __init__(self, destination_id: str, config: Optional[Dict] = None):
+        self.destination = {"id": destination_id, "type": "analysis"}
+        self.config = config or {}
+        self.metadata = FakeMetadata()
+        self.manifest = {"name": "bids-mriqc"}
+
+    def get_input(self, name: str) -> Optional[Dict]:
+        return {"key": "benchmark:fake-key"} if name == "api-key" else None
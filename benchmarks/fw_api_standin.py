@@ -0,0 +1,500 @@
+"""Local HTTP stand-in for the Flywheel API endpoints the gear uses.
+
+Serves, from a fixture, the containers and acquisitions that the metadata path
+reads and writes:
+
+    GET  /api/version
+    GET  /api/containers/{id}                      fw.get
+    GET  /api/acquisitions?filter=...              fw.acquisitions.find / iter_find
+    GET  /api/acquisitions/{id}                    acquisition with its file listing
+    GET  /api/acquisitions/{id}/files              file listing
+    GET  /api/acquisitions/{id}/files/{name}/info  fw.get_acquisition_file_info
+    POST /api/acquisitions/{id}/files/{name}/info  fw.modify_acquisition_file_info
+    POST /api/views/data?containerId=...           fw.read_view_data
+
+Every API request can be delayed (--latency, --jitter, --per-row-latency),
+rate limited (--rate-limit requests per second, answered with 429 and
+Retry-After), or failed at random (--error-rate, answered with a 5xx).
+Request counts per endpoint and status are served at /__standin/stats and
+reset with POST /__standin/reset.
+
+Point the Flywheel SDK at it with `api_key`, e.g. `127.0.0.1:8080:__force_insecure:standin`,
+which the SDK reads as a plain-HTTP host.
+
+Example:
+    python -m benchmarks.fw_api_standin --subjects 1700 --sessions 2 --latency 0.05 --rate-limit 100 --error-rate 0.01
+"""
+
+import argparse
+import copy
+import fnmatch
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from benchmarks.synthetic_tree import DATATYPE, Scan, make_scans
+
+log = logging.getLogger(__name__)
+
+API_VERSION = "18.0.0"
+FAULT_STATUSES = (500, 502, 503)
+_FILE_ROUTE = re.compile(r"^/api/acquisitions/(?P<acq>[^/]+)/files/(?P<name>[^/]+)/info$")
+
+
+def synthetic_fixture(
+    scans: List[Scan], destination_id: str = "analysis-standin", parent_type: str = "project"
+) -> Dict:
+    """Project, subjects, sessions, and one acquisition with a BIDS NIfTI per scan.
+
+    Args:
+        scans (List[Scan]): from `benchmarks.synthetic_tree.make_scans`
+        destination_id (str): id of the analysis the gear "runs" in
+        parent_type (str): level the analysis is attached to; the first
+                container of that level is used
+
+    Returns:
+        fixture (Dict): the description `StandinState` is seeded from
+    """
+    project = {"_id": "project-0", "container_type": "project", "label": "standin", "parents": {}}
+    containers = {project["_id"]: project}
+    acquisitions = []
+    for i, scan in enumerate(scans):
+        subject_id = f"subject-{scan.sub}"
+        session_id = f"session-{scan.sub}-{scan.ses or 'none'}"
+        containers.setdefault(
+            subject_id,
+            {"_id": subject_id, "container_type": "subject", "label": scan.sub, "parents": {"project": "project-0"}},
+        )
+        containers.setdefault(
+            session_id,
+            {
+                "_id": session_id,
+                "container_type": "session",
+                "label": scan.ses or "none",
+                "parents": {"project": "project-0", "subject": subject_id},
+            },
+        )
+        nifti = f"{scan.bids_name}.nii.gz"
+        acquisitions.append(
+            {
+                "_id": f"acq-{i:06d}",
+                "container_type": "acquisition",
+                "label": scan.bids_name,
+                "parents": {"project": "project-0", "subject": subject_id, "session": session_id},
+                "files": [
+                    {
+                        "file_id": f"file-{i:06d}",
+                        "name": nifti,
+                        "type": "nifti",
+                        "info": {"BIDS": {"Filename": nifti, "Folder": DATATYPE[scan.modality]}},
+                    },
+                    {
+                        "file_id": f"file-{i:06d}-dcm",
+                        "name": f"{scan.bids_name}.dicom.zip",
+                        "type": "dicom",
+                        "info": {},
+                    },
+                ],
+            }
+        )
+    parent = next(c for c in [*containers.values(), *acquisitions] if c["container_type"] == parent_type)
+    parents = {**parent["parents"], parent_type: parent["_id"]}
+    containers[destination_id] = {
+        "_id": destination_id,
+        "container_type": "analysis",
+        "label": "bids-mriqc standin",
+        "parent": {"type": parent_type, "id": parent["_id"]},
+        "parents": parents,
+    }
+    return {"containers": list(containers.values()), "acquisitions": acquisitions}
+
+
+class StandinState:
+    """The fixture's containers, the file info written so far, and request counts."""
+
+    def __init__(self, fixture: Dict):
+        self.lock = threading.Lock()
+        self.containers = {c["_id"]: c for c in fixture.get("containers", [])}
+        # Sorted by id, which is the order the API pages in
+        self.acquisitions = {a["_id"]: a for a in sorted(fixture.get("acquisitions", []), key=lambda a: a["_id"])}
+        self.calls = Counter()
+        self.statuses = Counter()
+
+    def get_container(self, container_id: str) -> Optional[Dict]:
+        return self.containers.get(container_id) or self.acquisitions.get(container_id)
+
+    def get_file(self, acquisition_id: str, name: str) -> Optional[Dict]:
+        acquisition = self.acquisitions.get(acquisition_id)
+        return next((f for f in acquisition["files"] if f["name"] == name), None) if acquisition else None
+
+    def acquisitions_under(self, container_id: str) -> Iterator[Dict]:
+        for acquisition in self.acquisitions.values():
+            if acquisition["_id"] == container_id or container_id in acquisition["parents"].values():
+                yield acquisition
+
+    def find(self, filter_expr: str) -> List[Dict]:
+        """Acquisitions matching a find filter, e.g. `subject=<id>,label=~T1w` (AND of terms)."""
+        terms = []
+        for term in filter(None, (t.strip() for t in filter_expr.split(","))):
+            match = re.match(r"^([\w.]+)(=~|!=|=)(.*)$", term)
+            if not match:
+                raise ValueError(f"Cannot parse filter term {term!r}")
+            terms.append(match.groups())
+        return [a for a in self.acquisitions.values() if all(_matches(a, *term) for term in terms)]
+
+    def snapshot(self) -> Counter:
+        with self.lock:
+            return Counter(self.calls)
+
+
+def _lookup(container: Dict, key: str):
+    if key in ("project", "subject", "session"):
+        return container["parents"].get(key)
+    if key in ("id", "_id"):
+        return container["_id"]
+    value = container
+    for part in key.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def _matches(container: Dict, key: str, op: str, expected: str) -> bool:
+    value = _lookup(container, key)
+    if op == "=~":
+        return value is not None and re.search(expected, str(value)) is not None
+    if op == "!=":
+        return str(value) != expected
+    return str(value) == expected
+
+
+def _view_rows(state: StandinState, container_id: str, spec: Dict) -> Iterator[Dict]:
+    """One row per file of the acquisitions below the container, with the view's columns."""
+    columns = [
+        (c, c) if isinstance(c, str) else (c.get("src"), c.get("dst") or c.get("src")) for c in spec.get("columns", [])
+    ]
+    filename = spec.get("filename") or "*"
+    for acquisition in state.acquisitions_under(container_id):
+        for file in acquisition["files"]:
+            if not fnmatch.fnmatch(file["name"], filename):
+                continue
+            sources = {"acquisition": {**acquisition, "id": acquisition["_id"]}, "file": file}
+            row = {}
+            for src, dst in columns:
+                head, _, rest = src.partition(".")
+                value = sources.get(head)
+                for part in rest.split("."):
+                    value = value.get(part) if isinstance(value, dict) else None
+                row[dst] = value
+            yield row
+
+
+class FaultInjector:
+    """Latency, a token-bucket rate limit, and random 5xx for each API request."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        per_row: float = 0.0,
+        rate_limit: float = 0.0,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.per_row = per_row
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._refilled = time.monotonic()
+
+    def delay(self, rows: int = 0) -> None:
+        with self._lock:
+            jitter = self._random.uniform(0, self.jitter) if self.jitter else 0.0
+        time.sleep(self.latency + jitter + rows * self.per_row)
+
+    def fault(self) -> Optional[Tuple[int, Dict[str, str]]]:
+        """(status, headers) to answer with instead of the real response, if any."""
+        with self._lock:
+            if self.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                if self._tokens < 1:
+                    retry_after = (1 - self._tokens) / self.rate_limit
+                    return 429, {"Retry-After": f"{retry_after:.3f}"}
+                self._tokens -= 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self._random.choice(FAULT_STATUSES), {}
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "StandinServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # noqa: A002 (BaseHTTPRequestHandler signature)
+        log.debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, status: int, body=None, headers: Optional[Dict[str, str]] = None, ndjson: bool = False) -> None:
+        if ndjson:
+            payload = b"".join(json.dumps(row).encode() + b"\n" for row in body)
+        else:
+            payload = json.dumps(body if body is not None else {"status": status}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-ndjson" if ndjson else "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        with self.server.state.lock:
+            self.server.state.statuses[status] += 1
+
+    def _body(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def do_GET(self):  # noqa: N802 (BaseHTTPRequestHandler name)
+        self._dispatch("GET")
+
+    def do_POST(self):  # noqa: N802 (BaseHTTPRequestHandler name)
+        self._dispatch("POST")
+
+    def _dispatch(self, method: str) -> None:
+        url = urlsplit(self.path)
+        path = unquote(url.path).rstrip("/")
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        state = self.server.state
+        # Read the body first so that a faulted request leaves the connection usable
+        body = self._body() if method == "POST" else {}
+
+        if path.startswith("/__standin/"):
+            if path == "/__standin/reset" and method == "POST":
+                with state.lock:
+                    state.calls.clear()
+                    state.statuses.clear()
+            with state.lock:
+                stats = {"calls": dict(state.calls), "statuses": dict(state.statuses)}
+            return self._send(200, stats)
+
+        route, handler = self._route(method, path)
+        with state.lock:
+            state.calls[route] += 1
+        fault = self.server.faults.fault()
+        if fault:
+            return self._send(fault[0], {"message": "injected by the standin"}, headers=fault[1])
+        try:
+            handler(path, query, body)
+        except (KeyError, ValueError) as exc:
+            self._send(400, {"message": str(exc)})
+
+    def _route(self, method: str, path: str):
+        if method == "GET" and path == "/api/version":
+            return "version", lambda *_: self._ok({"release": API_VERSION, "flywheel_release": API_VERSION})
+        if method == "GET" and path.startswith("/api/containers/"):
+            return "get", self._get_container
+        if method == "GET" and path == "/api/acquisitions":
+            return "find_acquisitions", self._find_acquisitions
+        if method == "GET" and re.match(r"^/api/acquisitions/[^/]+(/files)?$", path):
+            return ("get_acquisition_files" if path.endswith("/files") else "get_acquisition"), self._get_acquisition
+        if _FILE_ROUTE.match(path) and method == "GET":
+            return "get_acquisition_file_info", self._get_file_info
+        if _FILE_ROUTE.match(path) and method == "POST":
+            return "modify_acquisition_file_info", self._modify_file_info
+        if method == "POST" and path == "/api/views/data":
+            return "read_view_data", self._read_view_data
+        return "unknown", lambda *_: self._send(404, {"message": f"{method} {path} is not served by the standin"})
+
+    def _ok(self, body, rows: int = 0, ndjson: bool = False) -> None:
+        self.server.faults.delay(rows)
+        self._send(200, body, ndjson=ndjson)
+
+    def _get_container(self, path: str, query: Dict, body: Dict) -> None:
+        container = self.server.state.get_container(path.rsplit("/", 1)[-1])
+        if container is None:
+            return self._send(404, {"message": "container not found"})
+        self._ok(container)
+
+    def _get_acquisition(self, path: str, query: Dict, body: Dict) -> None:
+        acquisition_id = path.split("/")[3]
+        acquisition = self.server.state.acquisitions.get(acquisition_id)
+        if acquisition is None:
+            return self._send(404, {"message": "acquisition not found"})
+        with self.server.state.lock:
+            acquisition = copy.deepcopy(acquisition)
+        self._ok(acquisition["files"] if path.endswith("/files") else acquisition)
+
+    def _find_acquisitions(self, path: str, query: Dict, body: Dict) -> None:
+        found = self.server.state.find(query.get("filter", ""))
+        if query.get("after_id"):
+            found = [a for a in found if a["_id"] > query["after_id"]]
+        skip = int(query.get("skip") or 0)
+        limit = int(query["limit"]) if query.get("limit") else None
+        page = found[skip : skip + limit if limit else None]
+        with self.server.state.lock:
+            page = copy.deepcopy(page)
+        self._ok(page, rows=len(page))
+
+    def _get_file_info(self, path: str, query: Dict, body: Dict) -> None:
+        match = _FILE_ROUTE.match(path)
+        file = self.server.state.get_file(match["acq"], match["name"])
+        if file is None:
+            return self._send(404, {"message": "file not found"})
+        with self.server.state.lock:
+            info = copy.deepcopy(file["info"])
+        self._ok(info)
+
+    def _modify_file_info(self, path: str, query: Dict, body: Dict) -> None:
+        match = _FILE_ROUTE.match(path)
+        file = self.server.state.get_file(match["acq"], match["name"])
+        if file is None:
+            return self._send(404, {"message": "file not found"})
+        with self.server.state.lock:
+            if "replace" in body:
+                file["info"] = dict(body["replace"])
+            file["info"].update(body.get("set") or {})
+            for key in body.get("delete") or []:
+                file["info"].pop(key, None)
+        self._ok({"modified": 1})
+
+    def _read_view_data(self, path: str, query: Dict, body: Dict) -> None:
+        container_id = query.get("containerId") or query["container_id"]
+        fmt = query.get("format", "json")
+        if fmt not in ("json", "ndjson", "json-flat", "json-row-column"):
+            raise ValueError(f"format {fmt} is not served by the standin")
+        skip = int(query.get("skip") or 0)
+        limit = int(query["limit"]) if query.get("limit") else None
+        with self.server.state.lock:
+            rows = list(_view_rows(self.server.state, container_id, body))
+        page = rows[skip : skip + limit if limit else None]
+        if fmt == "ndjson":
+            self._ok(page, rows=len(page), ndjson=True)
+        else:
+            self._ok({"data": page}, rows=len(page))
+
+
+class StandinServer(ThreadingHTTPServer):
+    """The stand-in, served from a background thread.
+
+    Args:
+        fixture (Dict): containers and acquisitions, e.g. from `synthetic_fixture`
+        faults (FaultInjector): latency and failures applied to API requests
+        host (str): interface to bind
+        port (int): 0 for any free port
+        api_key (str): key part of `api_key`; any key is accepted
+
+    Usable as a context manager, which starts and stops the server.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        fixture: Dict,
+        faults: Optional[FaultInjector] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        api_key: str = "standin",
+    ):
+        super().__init__((host, port), _Handler)
+        self.state = StandinState(fixture)
+        self.faults = faults or FaultInjector()
+        self.key = api_key
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_key(self) -> str:
+        """Flywheel API key that points the SDK at this server over plain HTTP."""
+        host, port = self.server_address[:2]
+        return f"{host}:{port}:__force_insecure:{self.key}"
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def snapshot(self) -> Counter:
+        """Requests so far by endpoint, like `FakeClient.snapshot`."""
+        return self.state.snapshot()
+
+    def updated_files(self) -> int:
+        """Files that have IQMs in their info."""
+        with self.state.lock:
+            return sum("IQM" in f["info"] for a in self.state.acquisitions.values() for f in a["files"])
+
+    def start(self) -> "StandinServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="fw-api-standin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> "StandinServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--fixture", help="JSON with 'containers' and 'acquisitions'; overrides the synthetic options")
+    parser.add_argument("--subjects", type=int, default=50)
+    parser.add_argument("--sessions", type=int, default=2, help="0 for no session level")
+    parser.add_argument("--modalities", nargs="+", default=["T1w", "T2w", "bold"], choices=["T1w", "T2w", "bold"])
+    parser.add_argument("--runs", type=int, default=1, help="runs per modality and session")
+    parser.add_argument("--destination-id", default="analysis-standin")
+    parser.add_argument("--parent-type", default="project", choices=["project", "subject", "session", "acquisition"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each API request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument("--per-row-latency", type=float, default=0.0, help="seconds per listed row")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests per second before 429s (0 = none)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 5xx")
+    parser.add_argument("--seed", type=int, help="for reproducible jitter and errors")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    if args.fixture:
+        with open(args.fixture) as fp:
+            fixture = json.load(fp)
+    else:
+        scans = make_scans(args.subjects, args.sessions, args.modalities, args.runs)
+        fixture = synthetic_fixture(scans, args.destination_id, args.parent_type)
+    faults = FaultInjector(
+        args.latency, args.jitter, args.per_row_latency, args.rate_limit, args.error_rate, seed=args.seed
+    )
+    server = StandinServer(fixture, faults, args.host, args.port)
+    files = sum(len(a["files"]) for a in server.state.acquisitions.values())
+    log.info(f"Serving {len(server.state.acquisitions)} acquisitions ({files} files) at {server.url}")
+    log.info(f"API key: {server.api_key}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
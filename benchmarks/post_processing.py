@@ -0,0 +1,245 @@
+"""Benchmark the post-processing stages on a synthetic MRIQC output tree.
+
+Generates N subjects x sessions x modalities of MRIQC-shaped output, then runs
+`_find_output_files`, `store_iqms`, `find_group_tsvs`, `write_iqm_tables`, and
+the output packaging against an in-process fake Flywheel client, or, with
+--standin, the Flywheel SDK talking to `fw_api_standin` over HTTP. Wall time,
+API calls, and peak Python memory of each stage go to a JSON report; with
+--baseline, stages that got slower than --tolerance are flagged and the exit
+code is 1.
+
+Example:
+    python -m benchmarks.post_processing --subjects 200 --sessions 2 --latency 0.02 --report bench.json
+"""
+
+import argparse
+import json
+import logging
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from benchmarks.fake_flywheel import FakeClient, FakeGearContext
+from benchmarks.fw_api_standin import FaultInjector, StandinServer, synthetic_fixture
+from benchmarks.synthetic_tree import make_scans, write_tree
+from fw_gear_bids_mriqc.utils import store_iqms as store_iqms_module
+from fw_gear_bids_mriqc.utils.helpers import find_group_tsvs
+from fw_gear_bids_mriqc.utils.iqm_table import pa, write_iqm_tables
+from fw_gear_bids_mriqc.utils.packaging import zip_tree
+
+log = logging.getLogger(__name__)
+
+DESTINATION_ID = "analysis-benchmark"
+# Stages faster than this are too noisy to flag
+NOISE_FLOOR_S = 0.05
+
+
+class StageRecorder:
+    """Times each stage and records its API calls and peak traced memory.
+
+    Args:
+        client (FakeClient or StandinServer): counts the API calls by endpoint
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.stages: List[Dict] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        calls_before = self.client.snapshot()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        record = {"stage": name}
+        try:
+            yield record
+        finally:
+            record["wall_s"] = round(time.perf_counter() - start, 4)
+            record["peak_mb"] = round((tracemalloc.get_traced_memory()[1] - baseline) / 1024**2, 2)
+            calls = self.client.snapshot() - calls_before
+            record["api_calls"] = dict(calls)
+            record["api_calls_total"] = sum(calls.values())
+            self.stages.append(record)
+            log.info(f"{name}: {record['wall_s']}s, {record['api_calls_total']} API calls, {record['peak_mb']} MB peak")
+
+
+def _gear_version() -> Optional[str]:
+    try:
+        with open(Path(__file__).resolve().parents[1] / "manifest.json") as fp:
+            return json.load(fp).get("version")
+    except (OSError, ValueError):
+        return None
+
+
+def run_benchmark(args: argparse.Namespace, scratch: Path) -> Dict:
+    scans = make_scans(args.subjects, args.sessions, args.modalities, args.runs)
+    if args.standin:
+        # The real SDK, over HTTP, against the local stand-in of the API
+        from flywheel import Client
+
+        faults = FaultInjector(
+            args.latency, per_row=args.per_row_latency, rate_limit=args.rate_limit, error_rate=args.error_rate, seed=0
+        )
+        counter = StandinServer(synthetic_fixture(scans, DESTINATION_ID), faults).start()
+        client = Client(counter.api_key)
+    else:
+        client = counter = FakeClient(scans, DESTINATION_ID, latency=args.latency, per_row=args.per_row_latency)
+    try:
+        return _run_stages(args, scratch, scans, client, counter)
+    finally:
+        if args.standin:
+            counter.stop()
+
+
+def _run_stages(args: argparse.Namespace, scratch: Path, scans: List, client, counter) -> Dict:
+    gear_context = FakeGearContext(DESTINATION_ID, {"gear-metadata-workers": args.workers})
+    output_dir = scratch / "output"
+    analysis_output_dir = output_dir / DESTINATION_ID
+    app_context = SimpleNamespace(
+        analysis_output_dir=analysis_output_dir,
+        output_dir=output_dir,
+        analysis_level="group",
+        destination_id=DESTINATION_ID,
+        bids_app_binary="mriqc",
+        gear_dry_run=False,
+    )
+    # The stages talk to the fake client instead of a Flywheel instance
+    store_iqms_module._get_client = lambda _gear_context: client
+
+    start = time.perf_counter()
+    tree = write_tree(analysis_output_dir, scans, html_kb=args.html_kb)
+    log.info(f"Wrote {tree['files']} files ({tree['bytes'] / 1024**2:.0f} MB) in {time.perf_counter() - start:.1f}s")
+
+    recorder = StageRecorder(counter)
+    tracemalloc.start()
+
+    with recorder.stage("find_output_files") as record:
+        record["files"] = len(store_iqms_module._find_output_files(analysis_output_dir, "json") or [])
+
+    with recorder.stage("store_iqms") as record:
+        store_iqms_module.store_iqms(gear_context, app_context)
+        record["files_updated"] = counter.updated_files()
+
+    with recorder.stage("find_group_tsvs"):
+        find_group_tsvs(analysis_output_dir, output_dir, DESTINATION_ID)
+
+    with recorder.stage("write_iqm_tables") as record:
+        if pa is None:
+            record["skipped"] = "pyarrow is not installed"
+        else:
+            record["files"] = len(write_iqm_tables(analysis_output_dir.rglob("sub-*.json"), output_dir, DESTINATION_ID))
+
+    with recorder.stage("package_output") as record:
+        stats = zip_tree(output_dir, DESTINATION_ID, output_dir / "bids-mriqc_benchmark.zip", workers=args.workers)
+        record.update(stats.summary())
+    tracemalloc.stop()
+
+    return {
+        "benchmark": "post-processing",
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "gear_version": _gear_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "subjects": args.subjects,
+            "sessions": args.sessions,
+            "modalities": args.modalities,
+            "runs": args.runs,
+            "scans": len(scans),
+            "tree_files": tree["files"],
+            "tree_mb": round(tree["bytes"] / 1024**2, 1),
+            "html_kb": args.html_kb,
+            "latency": args.latency,
+            "per_row_latency": args.per_row_latency,
+            "workers": args.workers,
+            "api": "standin" if args.standin else "in-process",
+            "rate_limit": args.rate_limit,
+            "error_rate": args.error_rate,
+        },
+        "stages": recorder.stages,
+        "total_wall_s": round(sum(s["wall_s"] for s in recorder.stages), 4),
+    }
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[Dict]:
+    """Stages that are slower than the baseline by more than the tolerance (same parameters expected)."""
+    if report["params"] != baseline.get("params"):
+        log.warning("The baseline was run with different parameters; comparing anyway.")
+    before = {s["stage"]: s for s in baseline.get("stages", [])}
+    regressions = []
+    for stage in report["stages"]:
+        old = before.get(stage["stage"])
+        if not old or "skipped" in stage:
+            continue
+        ratio = stage["wall_s"] / old["wall_s"] if old["wall_s"] else float("inf")
+        stage["baseline_wall_s"] = old["wall_s"]
+        stage["ratio"] = round(ratio, 3)
+        more_calls = stage["api_calls_total"] > old.get("api_calls_total", 0)
+        if (ratio > 1 + tolerance and stage["wall_s"] > NOISE_FLOOR_S) or more_calls:
+            regressions.append(stage)
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--subjects", type=int, default=50)
+    parser.add_argument("--sessions", type=int, default=2, help="0 for no session level")
+    parser.add_argument("--modalities", nargs="+", default=["T1w", "T2w", "bold"], choices=["T1w", "T2w", "bold"])
+    parser.add_argument("--runs", type=int, default=1, help="runs per modality and session")
+    parser.add_argument("--html-kb", type=int, default=200, help="approximate size of each html report")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per fake API call")
+    parser.add_argument("--per-row-latency", type=float, default=0.0, help="seconds per data view row")
+    parser.add_argument("--standin", action="store_true", help="use the Flywheel SDK against fw_api_standin")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="stand-in requests per second before 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stand-in requests that fail")
+    parser.add_argument("--workers", type=int, default=4, help="gear-metadata-workers and packaging threads")
+    parser.add_argument("--report", default="benchmark_report.json", help="where to write the JSON report")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before flagging")
+    parser.add_argument("--keep", action="store_true", help="keep the generated tree")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    # The stages log per file; keep the benchmark output readable
+    logging.getLogger("fw_gear_bids_mriqc").setLevel(logging.WARNING)
+    scratch = Path(tempfile.mkdtemp(prefix="mriqc-bench-"))
+    try:
+        report = run_benchmark(args, scratch)
+    finally:
+        if args.keep:
+            log.info(f"Kept the synthetic tree in {scratch}")
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(report, json.load(fp), args.tolerance)
+        report["regressions"] = [r["stage"] for r in regressions]
+        for stage in regressions:
+            log.error(
+                f"Regression in {stage['stage']}: {stage['wall_s']}s vs {stage['baseline_wall_s']}s, "
+                f"{stage['api_calls_total']} API calls"
+            )
+        exit_code = 1 if regressions else 0
+
+    with open(args.report, "w") as fp:
+        json.dump(report, fp, indent=2)
+    log.info(f"Report written to {args.report} (total {report['total_wall_s']}s)")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
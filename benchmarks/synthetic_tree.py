@@ -0,0 +1,137 @@
+"""Generate MRIQC-shaped output trees of any size for the benchmarks."""
+
+import csv
+import json
+import random
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Union
+
+_SUMMARY_STATS = ["k", "mad", "mean", "median", "n", "p05", "p95", "stdv"]
+
+ANAT_IQMS = (
+    ["cjv", "cnr", "efc", "fber", "fwhm_avg", "fwhm_x", "fwhm_y", "fwhm_z", "inu_med", "inu_range", "qi_1", "qi_2"]
+    + [f"{m}_{t}" for m in ["icvs", "rpve", "snr", "snrd", "tpm_overlap"] for t in ["csf", "gm", "wm"]]
+    + ["snr_total", "snrd_total", "wm2max", "size_x", "size_y", "size_z", "spacing_x", "spacing_y", "spacing_z"]
+    + [f"summary_{r}_{s}" for r in ["bg", "csf", "gm", "wm"] for s in _SUMMARY_STATS]
+)
+BOLD_IQMS = (
+    ["aor", "aqi", "dummy_trs", "dvars_nstd", "dvars_std", "dvars_vstd", "efc", "fber", "fd_mean", "fd_num"]
+    + ["fd_perc", "fwhm_avg", "fwhm_x", "fwhm_y", "fwhm_z", "gcor", "gsr_x", "gsr_y", "snr", "tsnr"]
+    + ["size_t", "size_x", "size_y", "size_z", "spacing_tr", "spacing_x", "spacing_y", "spacing_z"]
+    + [f"summary_{r}_{s}" for r in ["bg", "fg"] for s in _SUMMARY_STATS]
+)
+MODALITY_IQMS = {"T1w": ANAT_IQMS, "T2w": ANAT_IQMS, "bold": BOLD_IQMS}
+DATATYPE = {"T1w": "anat", "T2w": "anat", "bold": "func"}
+
+
+@dataclass
+class Scan:
+    """One synthetic scan: the BIDS name of its NIfTI and of the MRIQC outputs."""
+
+    sub: str
+    ses: str
+    modality: str
+    run: int
+
+    @property
+    def bids_name(self) -> str:
+        task = "_task-rest" if self.modality == "bold" else ""
+        ses = f"_ses-{self.ses}" if self.ses else ""
+        return f"sub-{self.sub}{ses}{task}_run-{self.run}_{self.modality}"
+
+    @property
+    def rel_dir(self) -> Path:
+        parts = [f"sub-{self.sub}"] + ([f"ses-{self.ses}"] if self.ses else []) + [DATATYPE[self.modality]]
+        return Path(*parts)
+
+
+def make_scans(subjects: int, sessions: int, modalities: List[str], runs: int = 1) -> List[Scan]:
+    """Every subject x session x modality x run combination."""
+    sessions_labels = [f"{i + 1:02d}" for i in range(sessions)] if sessions else [""]
+    return [
+        Scan(f"{s + 1:04d}", ses, modality, run + 1)
+        for s in range(subjects)
+        for ses in sessions_labels
+        for modality in modalities
+        for run in range(runs)
+    ]
+
+
+def iqm_json(scan: Scan, rng: random.Random) -> Dict:
+    """Per-scan IQMs with the same keys and nesting as MRIQC's output."""
+    data = {name: round(rng.uniform(0, 100), 6) for name in MODALITY_IQMS[scan.modality]}
+    data["bids_meta"] = {
+        "modality": scan.modality,
+        "subject_id": scan.sub,
+        "session_id": scan.ses or None,
+        "run_id": scan.run,
+        "RepetitionTime": 2.0,
+        "EchoTime": 0.03,
+        "MagneticFieldStrength": 3,
+        "Manufacturer": "Siemens",
+    }
+    data["provenance"] = {
+        "md5sum": f"{rng.getrandbits(128):032x}",
+        "version": "24.0.2",
+        "software": "mriqc",
+        "webapi_url": "https://mriqc.nimh.nih.gov/api/v1",
+        "webapi_port": None,
+        "settings": {"testing": False},
+    }
+    return data
+
+
+# Random bytes to path-data characters: digits, spaces, and drawing commands
+_PATH_CHARS = bytes.maketrans(bytes(range(256)), (b"0123456789 0123456789 MLCZ" * 10)[:256])
+
+
+def html_report(scan: Scan, kb: int, rng: random.Random) -> str:
+    """A report with inline SVG, about kb kilobytes, like MRIQC's self-contained reports."""
+    path_data = rng.randbytes(kb * 1024).translate(_PATH_CHARS).decode()
+    return (
+        f"<html><head><title>{scan.bids_name}</title></head><body><h1>{scan.bids_name}</h1>"
+        f'<div class="svg-reportlet"><svg xmlns="http://www.w3.org/2000/svg"><path d="{path_data}"/></svg></div>'
+        "</body></html>"
+    )
+
+
+def write_tree(
+    analysis_output_dir: Union[Path, str], scans: List[Scan], html_kb: int = 200, seed: int = 0
+) -> Dict[str, int]:
+    """Write the per-scan IQM JSONs, html reports, and group TSVs of a group-level MRIQC run.
+
+    Args:
+        analysis_output_dir (Path): output/<destination id>, as MRIQC fills it
+        scans (List[Scan]): from `make_scans`
+        html_kb (int): approximate size of each html report
+        seed (int): for reproducible values
+
+    Returns:
+        counts (Dict): files and bytes written
+    """
+    rng = random.Random(seed)
+    root = Path(analysis_output_dir)
+    rows: Dict[str, List[Dict]] = {}
+    files = size = 0
+    for scan in scans:
+        scan_dir = root / scan.rel_dir
+        scan_dir.mkdir(parents=True, exist_ok=True)
+        data = iqm_json(scan, rng)
+        text = json.dumps(data, indent=2)
+        (scan_dir / f"{scan.bids_name}.json").write_text(text)
+        report = html_report(scan, html_kb, rng)
+        (root / f"{scan.bids_name}.html").write_text(report)
+        files += 2
+        size += len(text) + len(report)
+        rows.setdefault(scan.modality, []).append(
+            {"bids_name": scan.bids_name, **{k: data[k] for k in MODALITY_IQMS[scan.modality]}}
+        )
+    for modality, modality_rows in rows.items():
+        with open(root / f"group_{modality}.tsv", "w", newline="") as fp:
+            writer = csv.DictWriter(fp, fieldnames=list(modality_rows[0]), delimiter="\t")
+            writer.writeheader()
+            writer.writerows(modality_rows)
+        files += 1
+    (root / "dataset_description.json").write_text(json.dumps({"Name": "MRIQC - synthetic", "BIDSVersion": "1.8.0"}))
+    return {"files": files + 1, "bytes": size}
@@ -22,6 +22,11 @@ from flywheel_gear_toolkit.interfaces.command_line import build_command_list, ex
 from flywheel_gear_toolkit.licenses.freesurfer import install_freesurfer_license
 from flywheel_gear_toolkit.utils.file import sanitize_filename
 
+from fw_gear_bids_mriqc.utils.batch import get_batch_data, parse_batch_ids, resolve_batch_members
+from fw_gear_bids_mriqc.utils.bids_download import parallel_bids_downloads
+from fw_gear_bids_mriqc.utils.log_monitor import run_with_log_monitor
+from fw_gear_bids_mriqc.utils.resources import with_resource_options
+
 log = logging.getLogger(__name__)
 
 
@@ -56,12 +61,25 @@ def setup_bids_env(gear_context: GearToolkitContext, app_context: BIDSAppContext
     else:
         skip_download = False
 
-    participant_info, errors = get_bids_data(
-        gear_context,
-        app_context.bids_app_data_types,
-        tree_title=tree_title,
-        skip_download=skip_download,
-    )
+    # One MRIQC run for many sessions (gear-batch-sessions)
+    batch_ids = parse_batch_ids(gear_context.config.get("gear-batch-sessions"))
+    if batch_ids:
+        project_id = gear_context.client.get(gear_context.destination["id"]).parents["project"]
+        app_context.batch_members = resolve_batch_members(gear_context.client, batch_ids, project_id)
+
+    # Concurrent downloads, reusing files cached by earlier runs (gear-download-*)
+    with parallel_bids_downloads(gear_context, app_context.work_dir):
+        if batch_ids:
+            participant_info, errors = get_batch_data(
+                gear_context, app_context, app_context.batch_members, skip_download=skip_download
+            )
+        else:
+            participant_info, errors = get_bids_data(
+                gear_context,
+                app_context.bids_app_data_types,
+                tree_title=tree_title,
+                skip_download=skip_download,
+            )
 
     # Any run through BIDS validator needs a .bidsignore file, if the user
     # wants to skip dirs or files en masse.
@@ -112,31 +130,36 @@ def run_bids_algo(gear_context: GearToolkitContext, app_context: BIDSAppContext,
 
     Returns:
         run_error (int): any error encountered running the app. (0: no error)
+
+    Raises:
+        RuntimeError: If the app fails
     """
     if not Path(app_context.analysis_output_dir).exists():
         # Create output directory
         log.info("Creating output directory %s", app_context.analysis_output_dir)
         Path(app_context.analysis_output_dir).mkdir(parents=True, exist_ok=True)
 
+    # Size MRIQC to this job's CPUs and memory, unless the user did
+    command = with_resource_options(command, gear_context.config)
+
     # This is what it is all about
-    # Turn off logging b/c of log limits and redirect for offline logs
-    # Potentially add "> log_file" to the command to hard force the output to log file.
-    log_file = Path(app_context.output_dir) / Path(
-        app_context.bids_app_binary + "_log.txt"
-    )
-    # GTK requires str not PosixPath for log_file
-    # if log.getEffectiveLevel() == 10:
-    # tee may mess up the nipype output entirely.
-    #     command.extend(["|", "tee", str(log_file)])
-    # else:
-    if gear_context.config.get("gear-log-to-file"):
-        command.extend([">", str(log_file)])
-
-    stdout, stderr, run_error = exec_command(
+    if app_context.gear_dry_run:
+        stdout, stderr, run_error = exec_command(
+            command,
+            dry_run=app_context.gear_dry_run,
+            environ=os.environ,
+            shell=True,
+            cont_output=True,
+        )
+        return run_error
+
+    # The full output goes to a compressed mriqc_log.txt in the output directory,
+    # along with the nipype node timings. The job log gets the output too, unless
+    # gear-log-to-file asks to keep it to progress lines (log size limits).
+    return run_with_log_monitor(
         command,
-        dry_run=app_context.gear_dry_run,
+        app_context.output_dir,
+        app_context.bids_app_binary,
         environ=os.environ,
-        shell=True,
-        cont_output=True,
+        echo=not gear_context.config.get("gear-log-to-file"),
     )
-    return run_error
\ No newline at end of file
@@ -0,0 +1,163 @@
+"""Read a previous MRIQC run (archived_runs zip) without inflating all of it."""
+
+import fnmatch
+import json
+import logging
+import shutil
+import time
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+from flywheel_gear_toolkit import GearToolkitContext
+
+log = logging.getLogger(__name__)
+
+# What post-processing (check_bids_dir, group TSVs, html reports) reads from disk
+EXTRACT_PATTERNS = ["dataset_description.json", "*.tsv", "*.html", "*/figures/*.svg"]
+# Keys that tell MRIQC's IQM JSONs apart from BIDS sidecars and nipype JSONs
+IQM_KEYS = {"bids_meta", "provenance"}
+# nipype's cached node results, in a saved work directory (gear-save-intermediate-output)
+NIPYPE_RESULT = ".pklz"
+
+
+def _wanted(name: str) -> bool:
+    base = name.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(name if "/" in p else base, p) for p in EXTRACT_PATTERNS)
+
+
+def _is_iqm_candidate(name: str) -> bool:
+    base = name.rsplit("/", 1)[-1]
+    return base.startswith("sub-") and base.endswith(".json") and not name.endswith("/")
+
+
+def extract_needed_members(archive: zipfile.ZipFile, unzip_dir: Union[Path, str]) -> List[str]:
+    """Extract only the members that post-processing reads from disk.
+
+    Returns:
+        names (List): extracted member names
+    """
+    names = [info.filename for info in archive.infolist() if not info.is_dir() and _wanted(info.filename)]
+    for name in names:
+        archive.extract(name, unzip_dir)
+    return names
+
+
+def read_archived_iqms(archive: zipfile.ZipFile, unzip_dir: Union[Path, str]) -> Dict[Path, Dict]:
+    """Parse the IQM JSONs in memory, keyed by the path they would have once extracted.
+
+    Args:
+        archive (ZipFile): the archived run
+        unzip_dir (Path): where the archive would be extracted
+
+    Returns:
+        iqms (Dict): {path: IQMs} for every per-scan MRIQC JSON in the archive
+    """
+    iqms = {}
+    for info in archive.infolist():
+        if not _is_iqm_candidate(info.filename):
+            continue
+        try:
+            data = json.loads(archive.read(info))
+        except ValueError:
+            log.info(f"{info.filename} was empty or not JSON")
+            continue
+        if isinstance(data, dict) and IQM_KEYS & data.keys():
+            iqms[Path(unzip_dir) / info.filename] = data
+    return iqms
+
+
+def is_work_archive(archive: zipfile.ZipFile, work_dir_name: str) -> bool:
+    """Whether the archive is a saved nipype work directory (<gear>_work_<label>_<id>.zip) rather than a run."""
+    prefix = f"{work_dir_name}/"
+    return any(name.startswith(prefix) and name.endswith(NIPYPE_RESULT) for name in archive.namelist())
+
+
+def _destination(work_dir: Path, name: str) -> Optional[Path]:
+    """Where a member goes under work_dir; None for absolute names or names that lead outside of it."""
+    if name.startswith("/"):
+        return None
+    dest = (work_dir / name).resolve()
+    return dest if dest.is_relative_to(work_dir) else None
+
+
+def restore_archived_work(archive_path: Union[Path, str], work_dir: Union[Path, str], work_dir_name: str) -> int:
+    """Extract a saved work directory into the work dir, so MRIQC resumes from its finished nodes.
+
+    Args:
+        archive_path (Path): the saved work directory (<gear>_work_<label>_<id>.zip)
+        work_dir (Path): where to extract it
+        work_dir_name (str): top folder of the archive's members (the saved work dir's name);
+            members outside of it are not restored
+
+    Returns:
+        files (int): number of files restored
+    """
+    start = time.perf_counter()
+    work_dir = Path(work_dir).resolve()
+    prefix = f"{work_dir_name}/"
+    restored = 0
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.startswith(prefix):
+                continue
+            dest = _destination(work_dir, info.filename[len(prefix) :])
+            if dest is None:
+                log.warning(f"Skipping {info.filename}: it would be written outside of {work_dir}")
+                continue
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with archive.open(info) as src, open(dest, "wb") as fp:
+                shutil.copyfileobj(src, fp)
+            restored += 1
+    if not restored:
+        log.warning(f"{Path(archive_path).name} has no files under {prefix}; nothing to resume from.")
+        return 0
+    log.info(f"Restored {restored} work files from {Path(archive_path).name} in {time.perf_counter() - start:.1f}s")
+    return restored
+
+
+class MRIQCAppContext(BIDSAppContext):
+    """BIDSAppContext that only extracts what post-processing needs from archived_runs.
+
+    With gear-post-processing-only, the archive's central directory is read and
+    only the reports, group TSVs, and dataset_description.json are extracted.
+    The IQM JSONs are parsed straight from the archive into `archived_iqms`,
+    which `store_iqms` and the IQM tables use instead of searching the disk.
+    gear-extract-full-archive restores the full extraction.
+
+    A saved work directory given as archived_runs is not BIDS input; it is kept
+    on `archived_work` and restored before MRIQC runs (see `checkpoint`).
+    """
+
+    def check_archived_inputs(self, gear_context: GearToolkitContext):
+        archives = gear_context.get_input_path("archived_runs")
+        if not self.post_processing_only and archives and zipfile.is_zipfile(archives):
+            with zipfile.ZipFile(archives) as archive:
+                if is_work_archive(archive, Path(self.work_dir).name):
+                    self.archived_work = Path(archives)
+                    log.info(f"archived_runs is a saved work directory; MRIQC will resume from {archives}")
+                    return
+        if (
+            not self.post_processing_only
+            or not archives
+            or not zipfile.is_zipfile(archives)
+            or gear_context.config.get("gear-extract-full-archive")
+        ):
+            super().check_archived_inputs(gear_context)
+            return
+
+        start = time.perf_counter()
+        # Same location as unzip_archive_files
+        unzip_dir = Path(archives).with_suffix("")
+        unzip_dir.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(archives) as archive:
+            total = len(archive.infolist())
+            extracted = extract_needed_members(archive, unzip_dir)
+            self.archived_iqms = read_archived_iqms(archive, unzip_dir)
+        self.bids_dir = unzip_dir
+        log.info(
+            f"Archived runs provided. Extracted {len(extracted)} of {total} members and read "
+            f"{len(self.archived_iqms)} IQM files from the archive in {time.perf_counter() - start:.1f}s. "
+            f"BIDS directory set to {self.bids_dir}"
+        )
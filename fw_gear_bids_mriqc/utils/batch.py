@@ -0,0 +1,201 @@
+"""Run many sessions through one MRIQC invocation (gear-batch-sessions).
+
+Each session-level launch pays for the container start, TemplateFlow, the BIDS
+download and validation, and building the nipype graph, often for only
+minutes of MRIQC compute. In batch mode, one job downloads the BIDS data of
+every listed session (or every session of a listed subject), runs MRIQC once
+with all their participant and session labels, and then routes the results:
+the IQMs go to the info of each session's own files, and each session gets
+its own output zip, which its info points to.
+"""
+
+import logging
+import re
+from collections import defaultdict
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+from flywheel_bids.flywheel_bids_app_toolkit.prep import set_participant_info_for_command
+from flywheel_bids.flywheel_bids_app_toolkit.utils.query_flywheel import get_analysis_run_level_and_hierarchy
+from flywheel_gear_toolkit import GearToolkitContext
+from flywheel_gear_toolkit.utils.file import sanitize_filename
+
+from fw_gear_bids_mriqc.utils.command_options import pop_option, set_option
+from fw_gear_bids_mriqc.utils.fw_updates import PhaseStats, run_update_pool
+from fw_gear_bids_mriqc.utils.helpers import PARTICIPANT_OPTIONS
+
+log = logging.getLogger(__name__)
+
+# Session info key that points a batch member to its results
+BATCH_INFO_KEY = "mriqc_batch"
+SESSION_OPTIONS = ["--session-id", "--session_id"]
+
+
+class BatchMember(NamedTuple):
+    """One session of the batch, with the labels the MRIQC command uses."""
+
+    session_id: str
+    session_label: str
+    subject_label: str
+    # As set by set_participant_info_for_command (no "sub-"/"ses-")
+    participant: str
+    session: Optional[str]
+
+    @property
+    def bids_prefix(self) -> str:
+        if self.session:
+            return f"sub-{self.participant}_ses-{self.session}"
+        return f"sub-{self.participant}"
+
+    @property
+    def bids_dir(self) -> str:
+        if self.session:
+            return f"sub-{self.participant}/ses-{self.session}"
+        return f"sub-{self.participant}"
+
+
+def parse_batch_ids(spec: Optional[str]) -> List[str]:
+    """Container ids from gear-batch-sessions: separated by commas or whitespace, duplicates dropped."""
+    return list(dict.fromkeys(cid for cid in re.split(r"[,\s]+", spec or "") if cid))
+
+
+def _member(session) -> BatchMember:
+    labels = SimpleNamespace()
+    set_participant_info_for_command(labels, {"subject_label": session.subject.label, "session_label": session.label})
+    bids_session = getattr(labels, "session_label", None)
+    if bids_session and bids_session.startswith("ses-"):
+        bids_session = bids_session[len("ses-") :]
+    return BatchMember(session.id, session.label, session.subject.label, labels.subject_label, bids_session)
+
+
+def resolve_batch_members(fw, container_ids: List[str], project_id: str) -> List[BatchMember]:
+    """Look up the sessions of the batch.
+
+    Args:
+        fw (flywheel.Client): Flywheel client
+        container_ids (List): session ids, or subject ids for all of their sessions
+        project_id (str): project of the gear's destination; all sessions must belong to it
+
+    Returns:
+        members (List[BatchMember]): one per session, in the order given
+
+    Raises:
+        ValueError: an id is neither a session nor a subject, or is in another project
+    """
+    members = {}
+    for container_id in container_ids:
+        container = fw.get(container_id)
+        if container.container_type == "subject":
+            sessions = fw.get_subject_sessions(container_id)
+        elif container.container_type == "session":
+            sessions = [container]
+        else:
+            raise ValueError(
+                f"gear-batch-sessions takes session and subject ids; {container_id} is a {container.container_type}"
+            )
+        if container.parents["project"] != project_id:
+            raise ValueError(f"{container.container_type} {container_id} is not in the project of this analysis")
+        for session in sessions:
+            members.setdefault(session.id, _member(session))
+    log.info(f"Batch of {len(members)} sessions: {', '.join(m.bids_prefix for m in members.values())}")
+    return list(members.values())
+
+
+def get_batch_data(
+    gear_context: GearToolkitContext,
+    app_context: BIDSAppContext,
+    members: List[BatchMember],
+    skip_download: bool = False,
+) -> Tuple[Dict, List[str]]:
+    """Stand-in for `get_bids_data` that downloads only the sessions of the batch.
+
+    The BIDS export filters by subject and by session label, so each subject is
+    downloaded with just its own sessions.
+
+    Returns:
+        participant_info (Dict): subject_label, session_label, and run_label of the launch container
+        errors (list[str]): list of generated errors
+    """
+    hierarchy = get_analysis_run_level_and_hierarchy(gear_context.client, gear_context.destination["id"])
+    participant_info = {
+        "subject_label": hierarchy.get("subject_label"),
+        "session_label": hierarchy.get("session_label"),
+        "run_label": sanitize_filename(hierarchy["run_label"]),
+    }
+    errors = []
+    if skip_download:
+        return participant_info, errors
+
+    by_subject = defaultdict(list)
+    for member in members:
+        by_subject[member.subject_label].append(member.session_label)
+    for subject, sessions in by_subject.items():
+        try:
+            gear_context.download_project_bids(
+                folders=app_context.bids_app_data_types, subjects=[subject], sessions=sessions
+            )
+        except Exception as exc:
+            log.error(f"Downloading BIDS for subject {subject} failed: {exc}")
+            errors.append("BIDS Error(s) detected")
+    for member in members:
+        if not (Path(app_context.bids_dir) / member.bids_dir).is_dir():
+            log.warning(f"No BIDS data was downloaded for {member.bids_prefix} (session {member.session_id})")
+    return participant_info, errors
+
+
+def batch_command(command: List[str], members: List[BatchMember]) -> List[str]:
+    """Restrict the MRIQC command to the participants and sessions of the batch."""
+    command, _ = pop_option(command, PARTICIPANT_OPTIONS + SESSION_OPTIONS)
+    command = set_option(command, "--participant-label", *dict.fromkeys(m.participant for m in members))
+    sessions = dict.fromkeys(m.session for m in members)
+    if None not in sessions:
+        command = set_option(command, "--session-id", *sessions)
+    return command
+
+
+def batch_session_ids(app_context) -> Optional[List[str]]:
+    """Sessions whose files get IQMs in batch mode; None for the usual launch container."""
+    members = getattr(app_context, "batch_members", None)
+    return [m.session_id for m in members] if members else None
+
+
+def route_batch_outputs(gear_context: GearToolkitContext, app_context: BIDSAppContext) -> Optional[PhaseStats]:
+    """Zip each session's MRIQC outputs separately and point the session to them.
+
+    The outputs of a job can only be attached to its analysis, so each session
+    gets `<binary>_<sub>_<ses>_<analysis id>.zip` among the analysis outputs
+    and `session.info.mriqc_batch` with the analysis id and the zip name.
+
+    Returns:
+        stats (PhaseStats): the session info writes, or None if there is no batch
+    """
+    # Imported when needed; they pull in the Flywheel client
+    from fw_gear_bids_mriqc.utils.packaging import zip_paths
+    from fw_gear_bids_mriqc.utils.store_iqms import _get_client
+
+    members = getattr(app_context, "batch_members", None)
+    if not members:
+        return None
+    analysis_dir = Path(app_context.analysis_output_dir)
+    destination_id = gear_context.destination["id"]
+    fw = _get_client(gear_context)
+    tasks = []
+    for member in members:
+        paths = [analysis_dir / member.bids_dir] if (analysis_dir / member.bids_dir).is_dir() else []
+        paths.extend(sorted(analysis_dir.glob(f"{member.bids_prefix}_*.html")))
+        if not paths:
+            log.warning(f"MRIQC wrote no outputs for {member.bids_prefix} (session {member.session_id})")
+            continue
+        zip_name = f"{app_context.bids_app_binary}_{member.bids_prefix}_{destination_id}.zip"
+        zip_paths(analysis_dir, paths, Path(app_context.output_dir) / zip_name)
+        info = {
+            "analysis_id": destination_id,
+            "output": zip_name,
+            "scans": sum(1 for _ in analysis_dir.glob(f"{member.bids_dir}/*/{member.bids_prefix}_*.json")),
+        }
+        write = partial(fw.modify_session_info, member.session_id, {"set": {BATCH_INFO_KEY: info}})
+        tasks.append((member.bids_prefix, write))
+    return run_update_pool(tasks, "batch-sessions", max_workers=gear_context.config.get("gear-metadata-workers") or 4)
@@ -0,0 +1,259 @@
+"""Download the BIDS files in parallel, through a content-addressed cache shared across gear runs."""
+
+import hashlib
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+import flywheel_bids.export_bids as export_bids
+from flywheel_gear_toolkit import GearToolkitContext
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = "bids-cache"
+BLOBS = "blobs"
+# Above this, the least recently used blobs are evicted after each download
+DEFAULT_CACHE_GB = 50.0
+DEFAULT_WORKERS = 8
+CONTAINER_TYPES = ["session", "acquisition", "sidecar"]
+# The serial original, still used for project files and dry runs
+_serial_download_bids_files = export_bids.download_bids_files
+
+
+def blob_key(container_id: str, name: str, modified: Optional[str]) -> str:
+    """Key of one version of a Flywheel file: its container, name, and modification time."""
+    return hashlib.blake2b(f"{container_id}\0{name}\0{modified or ''}".encode(), digest_size=20).hexdigest()
+
+
+class BlobCache:
+    """Content-addressed store of downloaded files, safe to share between concurrent jobs.
+
+    Blobs are written to a temporary name and renamed into place, and they are
+    read-only. A ``.used`` stamp next to each blob records the last time a run
+    used it, for LRU eviction. Runs get hard links to the blobs, so evicting a
+    blob never removes a file from a BIDS tree that is in use.
+
+    Args:
+        cache_dir (Path): cache location, e.g., under gear-writable-dir
+        max_gb (float): size above which the least recently used blobs are evicted
+    """
+
+    def __init__(self, cache_dir: Union[Path, str], max_gb: float = DEFAULT_CACHE_GB):
+        self.root = Path(cache_dir) / BLOBS
+        self.max_bytes = int(max_gb * 1024**3)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> Optional[Path]:
+        blob = self.path(key)
+        if not blob.exists():
+            return None
+        self.touch(key)
+        return blob
+
+    def touch(self, key: str) -> None:
+        self.path(key).with_suffix(".used").touch()
+
+    def tmp_path(self, key: str) -> Path:
+        blob = self.path(key)
+        blob.parent.mkdir(exist_ok=True)
+        return blob.with_name(f".{key}.{os.getpid()}.{time.monotonic_ns()}.tmp")
+
+    def put(self, key: str, tmp_path: Path) -> Path:
+        """Move a finished download into the cache; another job may have raced us to it."""
+        blob = self.path(key)
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, blob)
+        self.touch(key)
+        return blob
+
+    def evict(self) -> Tuple[int, int]:
+        """Remove the least recently used blobs until the cache fits under the cap.
+
+        Returns:
+            evicted (int), remaining_bytes (int)
+        """
+        blobs = []
+        for stamp in self.root.glob("*/*.used"):
+            blob = stamp.with_suffix("")
+            try:
+                blobs.append((stamp.stat().st_mtime, blob.stat().st_size, blob, stamp))
+            except OSError:
+                # Evicted by another job, or a stale stamp
+                stamp.unlink(missing_ok=True)
+        total = sum(size for _, size, _, _ in blobs)
+        evicted = 0
+        for _, size, blob, stamp in sorted(blobs):
+            if total <= self.max_bytes:
+                break
+            blob.unlink(missing_ok=True)
+            stamp.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+        if evicted:
+            log.info(f"Evicted {evicted} files from the BIDS download cache ({total / 1024**3:.1f} GB left)")
+        return evicted, total
+
+
+def materialize(blob: Path, dest: Union[Path, str]) -> str:
+    """Put a cached file at its place in the BIDS tree: a hard link, or a copy across filesystems.
+
+    A symlink would dangle as soon as another job evicts the blob.
+
+    Returns:
+        how (str): "link" or "copy"
+    """
+    dest = Path(dest)
+    dest.unlink(missing_ok=True)
+    try:
+        os.link(blob, dest)
+        return "link"
+    except OSError:
+        # copy2 keeps the Flywheel modified time set on the blob, as a hard link would
+        shutil.copy2(blob, dest)
+        return "copy"
+
+
+def _set_modified(path: Union[Path, str], modified: Optional[str]) -> None:
+    if modified:
+        modified_time = float(export_bids.timestamp_to_int(modified))
+        os.utime(path, (modified_time, modified_time))
+
+
+def _download(fw, file_type: str, args: Tuple, modified: Optional[str], cache: Optional[BlobCache]) -> str:
+    """Fetch one BIDS file, from the cache when possible.
+
+    Returns:
+        source (str): "cache", "download", or "direct" (no cache)
+    """
+    container_id, name, dest = args
+    method = getattr(fw, "download_file_from_" + ("acquisition" if file_type == "sidecar" else file_type))
+    if cache is None:
+        method(container_id, name, dest)
+        _set_modified(dest, modified)
+        return "direct"
+
+    key = blob_key(container_id, name, modified)
+    blob = cache.get(key)
+    if blob is not None:
+        try:
+            materialize(blob, dest)
+            return "cache"
+        except FileNotFoundError:
+            # Evicted by another job in the meantime
+            pass
+    tmp_path = cache.tmp_path(key)
+    try:
+        method(container_id, name, str(tmp_path))
+        _set_modified(tmp_path, modified)
+        blob = cache.put(key, tmp_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    materialize(blob, dest)
+    return "download"
+
+
+def download_bids_files_parallel(
+    fw,
+    filepath_downloads: Dict,
+    dry_run: bool,
+    outdir: str,
+    ignore_sidecars: bool,
+    workers: int = DEFAULT_WORKERS,
+    cache: Optional[BlobCache] = None,
+) -> Dict[str, int]:
+    """Drop-in for `flywheel_bids.export_bids.download_bids_files`.
+
+    Session, acquisition, and sidecar files are fetched by a bounded pool of
+    threads sharing the client (and its HTTP connection pool). Project files
+    are left to the original function, which also unzips them.
+
+    Args:
+        fw: Flywheel client
+        filepath_downloads (Dict): {container_type: {filepath: {"args": (id, name, dest), "modified": ...}}}
+        dry_run (bool): only log what would be downloaded
+        outdir (str): BIDS directory
+        ignore_sidecars (bool): create the sidecars from file.info instead of downloading them
+        workers (int): number of concurrent downloads
+        cache (BlobCache, optional): shared download cache; None downloads straight into the tree
+
+    Returns:
+        counts (Dict): files per source ("cache", "download", "direct")
+    """
+    if dry_run:
+        _serial_download_bids_files(fw, filepath_downloads, dry_run, outdir, ignore_sidecars)
+        return {}
+
+    # Creates (or drops) the sidecars that come from file.info
+    export_bids.check_sidecar_exist(fw, filepath_downloads, outdir, ignore_sidecars)
+    project_only = {"project": filepath_downloads["project"], **{ft: {} for ft in CONTAINER_TYPES}}
+    _serial_download_bids_files(fw, project_only, dry_run, outdir, ignore_sidecars)
+
+    tasks = [
+        (file_type, details["args"], details.get("modified"))
+        for file_type in CONTAINER_TYPES
+        for details in filepath_downloads[file_type].values()
+    ]
+    log.info(f"Downloading {len(tasks)} BIDS files with {workers} workers")
+    counts = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(_download, fw, *task, cache): task for task in tasks}
+        for future in as_completed(futures):
+            file_type, args, _ = futures[future]
+            try:
+                source = future.result()
+            except Exception:
+                log.error(f"Unable to download {file_type} file {args[1]} to {args[2]}")
+                raise
+            counts[source] = counts.get(source, 0) + 1
+            log.debug(f"{args[2]} ({source})")
+    log.info(
+        f"BIDS files ready in {time.perf_counter() - start:.1f}s: "
+        + ", ".join(f"{n} from {source}" for source, n in sorted(counts.items()))
+    )
+    if cache is not None:
+        cache.evict()
+    return counts
+
+
+@contextmanager
+def parallel_bids_downloads(gear_context: GearToolkitContext, work_dir: Union[Path, str]) -> Iterator:
+    """Route the toolkit's BIDS download (`get_bids_data`) through `download_bids_files_parallel`.
+
+    `gear-download-workers` sets the number of concurrent downloads (1 keeps the
+    original, serial download); `gear-download-cache-gb` caps the shared cache
+    under gear-writable-dir (0 turns the cache off).
+    """
+    config = gear_context.config
+    workers = int(config.get("gear-download-workers") or DEFAULT_WORKERS)
+    if workers <= 1:
+        yield
+        return
+    cache_gb = config.get("gear-download-cache-gb")
+    cache_gb = DEFAULT_CACHE_GB if cache_gb is None else float(cache_gb)
+    cache = None
+    if cache_gb > 0:
+        cache = BlobCache(Path(config.get("gear-writable-dir") or work_dir) / CACHE_DIR, cache_gb)
+
+    original = export_bids.download_bids_files
+
+    def download_bids_files(fw, filepath_downloads, dry_run, outdir, ignore_sidecars):
+        return download_bids_files_parallel(
+            fw, filepath_downloads, dry_run, outdir, ignore_sidecars, workers=workers, cache=cache
+        )
+
+    # download_bids_dir looks the function up in its module at call time
+    export_bids.download_bids_files = download_bids_files
+    try:
+        yield
+    finally:
+        export_bids.download_bids_files = original
+
@@ -0,0 +1,65 @@
+"""Parse BIDS filenames into entities for exact, dictionary-based matching."""
+
+import logging
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+log = logging.getLogger(__name__)
+
+# Entities that identify a scan in MRIQC output. Any other entity found in a
+# filename (e.g., rec, dir, echo) is kept as well, so that two scans that only
+# differ by one of those entities never collide.
+KEY_ENTITIES = ("sub", "ses", "task", "acq", "run")
+
+BidsKey = Tuple[Tuple[str, str], ...]
+
+
+def parse_bids_entities(filename: Union[Path, str]) -> Dict[str, str]:
+    """Split a BIDS filename into its key-value entities and suffix.
+
+    e.g., "sub-01_ses-A_task-rest_run-1_bold.nii.gz" returns
+    {"sub": "01", "ses": "A", "task": "rest", "run": "1", "suffix": "bold"}
+
+    Args:
+        filename (Union[Path, str]): BIDS filename, with or without a path and
+            any number of extensions
+
+    Returns:
+        entities (Dict): entity labels keyed by the entity name. The BIDS
+            suffix (e.g., T1w, bold) is stored under "suffix".
+    """
+    name = Path(filename).name.split(".")[0]
+    entities = {}
+    for part in name.split("_"):
+        if "-" in part:
+            key, _, value = part.partition("-")
+            entities[key] = value
+        elif part:
+            # Only the last bare token is the suffix (e.g., T1w, bold)
+            entities["suffix"] = part
+    return entities
+
+
+def bids_key(filename: Union[Path, str]) -> Optional[BidsKey]:
+    """Create a hashable lookup key for a BIDS filename.
+
+    The key is built from every entity in the name, ordered so that the key
+    does not depend on the position of the entities in the filename. Values
+    are compared exactly, so "run-1" never matches "run-10".
+
+    Args:
+        filename (Union[Path, str]): BIDS filename, e.g., an IQM JSON from
+            MRIQC or the info.BIDS.Filename of a Flywheel file
+
+    Returns:
+        key (Tuple): ((entity, label), ...) pairs, with the suffix last.
+            None if the filename does not have a subject entity and suffix.
+    """
+    entities = parse_bids_entities(filename)
+    if "sub" not in entities or "suffix" not in entities:
+        return None
+    suffix = entities.pop("suffix")
+    ordered = [(k, entities.pop(k)) for k in KEY_ENTITIES if k in entities]
+    ordered.extend(sorted(entities.items()))
+    ordered.append(("suffix", suffix))
+    return tuple(ordered)
@@ -0,0 +1,326 @@
+"""Checkpoint the nipype work directory, so a preempted job resumes from its completed nodes.
+
+While MRIQC runs, a background thread copies the files of the work directory
+that changed since the last pass (size or modification time) to
+`<gear-writable-dir>/mriqc-checkpoints/<container id>`, every
+`gear-checkpoint-interval` minutes (off by default) and once more when Slurm
+sends SIGTERM to preempt the job. Files still being written are left for the
+next pass, and a pass only replaces the previous checkpoint once it is
+complete.
+
+When the gear is launched again for the same container, with the same MRIQC
+version and options, the checkpoint (or a saved work directory given as
+archived_runs) is copied back before MRIQC starts. nipype then finds the
+results of the nodes that had finished and only runs the rest. nipype's cached
+results hold absolute paths, so the work directory must be at the same path
+as before; checkpointing keeps it in place (no gear-work-dir-staging).
+"""
+
+import json
+import logging
+import os
+import shutil
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+
+from fw_gear_bids_mriqc.utils.bids_download import CACHE_DIR as DOWNLOAD_CACHE_DIR
+from fw_gear_bids_mriqc.utils.command_options import pop_option
+from fw_gear_bids_mriqc.utils.run_cache import CACHE_DIR as RUN_CACHE_DIR
+from fw_gear_bids_mriqc.utils.run_cache import mriqc_version, relevant_flags
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = "mriqc-checkpoints"
+MANIFEST_NAME = "checkpoint.json"
+TREE = "tree"
+# A pass is written to PENDING_DIR, renamed to PASS_DIR once complete, then merged into TREE
+PENDING_DIR = "pass.tmp"
+PASS_DIR = "pass"
+REMOVED_NAME = "removed.json"
+# Files modified more recently than this may still be open for writing
+SETTLE_SECONDS = 30
+WORK_DIR_OPTIONS = ["-w", "--work-dir"]
+
+
+@dataclass
+class SyncStats:
+    """What one checkpoint pass copied and removed."""
+
+    copied: int = 0
+    removed: int = 0
+    skipped: int = 0
+    bytes_copied: int = 0
+    wall_time: float = 0.0
+
+
+def _walk(top: Path, exclude: Iterable[str]) -> Dict[str, Tuple[int, int, bool]]:
+    """{relative path: (size, mtime_ns, is_symlink)} of the files under top, skipping excluded top-level entries."""
+    exclude = set(exclude)
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(top):
+        rel_dir = os.path.relpath(dirpath, top)
+        if rel_dir == ".":
+            dirnames[:] = [d for d in dirnames if d not in exclude and not d.startswith("MPLCONFIGDIR-")]
+            filenames = [f for f in filenames if f not in exclude]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            rel = name if rel_dir == "." else os.path.join(rel_dir, name)
+            files[rel] = (stat.st_size, stat.st_mtime_ns, os.path.islink(path))
+    return files
+
+
+def _copy(src: str, dest: Path) -> None:
+    """Copy a file (or a symlink, as a link) into the checkpoint; readers never see half a file."""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+    if os.path.islink(src):
+        tmp_path.unlink(missing_ok=True)
+        os.symlink(os.readlink(src), tmp_path)
+    else:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+
+def _apply_pass(checkpoint_dir: Path) -> None:
+    """Merge a completed pass into the checkpoint tree; repeating it after an interruption is harmless."""
+    pass_dir = checkpoint_dir / PASS_DIR
+    if not pass_dir.is_dir():
+        return
+    for rel in _walk(pass_dir / TREE, ()):
+        dest = checkpoint_dir / TREE / rel
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(pass_dir / TREE / rel, dest)
+    with open(pass_dir / REMOVED_NAME) as fp:
+        for rel in json.load(fp):
+            (checkpoint_dir / TREE / rel).unlink(missing_ok=True)
+    shutil.rmtree(pass_dir)
+
+
+def _recover(checkpoint_dir: Path) -> None:
+    """Finish merging a completed pass and drop an incomplete one, as left by a killed job."""
+    _apply_pass(checkpoint_dir)
+    shutil.rmtree(checkpoint_dir / PENDING_DIR, ignore_errors=True)
+
+
+class WorkDirCheckpointer:
+    """Background thread that mirrors the changed files of the work directory to a checkpoint.
+
+    Args:
+        source (Path): the nipype work directory
+        checkpoint_dir (Path): persistent checkpoint location
+        interval (float): seconds between passes
+        key (Dict): what the work directory is valid for (MRIQC version, options, path)
+        exclude (Iterable): top-level entries of source that are not part of the checkpoint
+    """
+
+    def __init__(
+        self,
+        source: Union[Path, str],
+        checkpoint_dir: Union[Path, str],
+        interval: float,
+        key: Dict,
+        exclude: Iterable[str] = (),
+    ):
+        self.source = Path(source)
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.interval = interval
+        self.key = key
+        self.exclude = list(exclude)
+        self.passes = 0
+        # Files as they were when last copied
+        self._synced: Dict[str, Tuple[int, int, bool]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="checkpoint", daemon=True)
+        self._previous_sigterm = None
+
+    @property
+    def tree(self) -> Path:
+        return self.checkpoint_dir / TREE
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.checkpoint_dir / MANIFEST_NAME
+
+    def start(self) -> "WorkDirCheckpointer":
+        _recover(self.checkpoint_dir)
+        self.tree.mkdir(parents=True, exist_ok=True)
+        # Files restored from this checkpoint are already in it
+        self._synced = {rel: state for rel, state in _walk(self.tree, ()).items()}
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sigterm = signal.signal(signal.SIGTERM, self._on_sigterm)
+        self._thread.start()
+        log.info(f"Checkpointing {self.source} to {self.checkpoint_dir} every {self.interval / 60:.0f} min")
+        return self
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync()
+            except OSError as exc:
+                log.warning(f"Checkpoint pass failed: {exc}")
+
+    def sync(self, settle: float = SETTLE_SECONDS) -> SyncStats:
+        """Copy the changed files, and drop the ones nipype removed, in one pass.
+
+        The pass is written to a separate directory first and only then merged
+        into the checkpoint, so a pass that is killed part way (e.g., after
+        SIGTERM, by Slurm's KillWait) leaves the previous checkpoint intact.
+        """
+        with self._lock:
+            start = time.perf_counter()
+            stats = SyncStats()
+            pending = self.checkpoint_dir / PENDING_DIR
+            shutil.rmtree(pending, ignore_errors=True)
+            current = _walk(self.source, self.exclude)
+            newest = time.time_ns() - int(settle * 1e9)
+            copied = {}
+            for rel, state in current.items():
+                if self._synced.get(rel, (None, None, None))[:2] == state[:2]:
+                    continue
+                if state[1] > newest:
+                    stats.skipped += 1
+                    continue
+                try:
+                    _copy(str(self.source / rel), pending / TREE / rel)
+                except FileNotFoundError:
+                    # Removed by nipype since the walk
+                    continue
+                copied[rel] = state
+                stats.copied += 1
+                stats.bytes_copied += state[0]
+            removed = [rel for rel in self._synced if rel not in current]
+            stats.removed = len(removed)
+            (pending / TREE).mkdir(parents=True, exist_ok=True)
+            with open(pending / REMOVED_NAME, "w") as fp:
+                json.dump(removed, fp)
+            # The pass is complete: from here on, it is applied even if the job is killed
+            os.replace(pending, self.checkpoint_dir / PASS_DIR)
+            _apply_pass(self.checkpoint_dir)
+            self._synced.update(copied)
+            for rel in removed:
+                del self._synced[rel]
+            self._write_manifest()
+            self.passes += 1
+            stats.wall_time = time.perf_counter() - start
+        log.info(
+            f"Checkpoint {self.passes}: copied {stats.copied} files ({stats.bytes_copied / 1024**2:.0f} MB), "
+            f"removed {stats.removed}, {stats.skipped} still being written, in {stats.wall_time:.1f}s"
+        )
+        return stats
+
+    def _write_manifest(self) -> None:
+        manifest = dict(self.key, files=len(self._synced), updated=time.strftime("%Y-%m-%dT%H:%M:%S%z"))
+        tmp_path = self.manifest_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(manifest, fp, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _on_sigterm(self, signum, frame) -> None:
+        """Preemption: save everything, settled or not, then let the signal do what it would have."""
+        log.warning("SIGTERM received; writing a final checkpoint.")
+        self._stop.set()
+        try:
+            self.sync(settle=0)
+        finally:
+            signal.signal(signal.SIGTERM, self._previous_sigterm or signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def finish(self, success: bool) -> None:
+        """Stop checkpointing. A finished run no longer needs its checkpoint; a failed one keeps a final pass."""
+        self._stop.set()
+        self._thread.join()
+        if threading.current_thread() is threading.main_thread() and self._previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, self._previous_sigterm)
+        if success:
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+            log.info(f"MRIQC finished; removed the checkpoint {self.checkpoint_dir}")
+        else:
+            self.sync(settle=0)
+            log.info(f"Kept the checkpoint {self.checkpoint_dir} for the next launch")
+
+
+def restore_checkpoint(checkpoint_dir: Union[Path, str], source: Union[Path, str], key: Dict) -> int:
+    """Copy a checkpoint back to the work directory, if it was made for the same run.
+
+    Returns:
+        files (int): number of files restored (0 if there is no usable checkpoint)
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    if checkpoint_dir.is_dir():
+        _recover(checkpoint_dir)
+    try:
+        with open(checkpoint_dir / MANIFEST_NAME) as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as exc:
+        log.warning(f"Ignoring unreadable checkpoint manifest in {checkpoint_dir}: {exc}")
+        return 0
+    if any(manifest.get(k) != v for k, v in key.items()):
+        log.warning(f"Discarding the checkpoint in {checkpoint_dir}: it was made for a different MRIQC run")
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        return 0
+    start = time.perf_counter()
+    shutil.copytree(checkpoint_dir / TREE, source, symlinks=True, dirs_exist_ok=True)
+    log.info(
+        f"Restored {manifest.get('files', 0)} work files from the checkpoint of {manifest.get('updated')} "
+        f"in {time.perf_counter() - start:.1f}s; MRIQC resumes from the nodes that had finished"
+    )
+    return manifest.get("files", 0)
+
+
+def nipype_work_dir(app_context: BIDSAppContext, command: List[str]) -> Path:
+    """Where MRIQC keeps its nipype work directory: -w/--work-dir, or the gear's work dir."""
+    _, values = pop_option(list(command), WORK_DIR_OPTIONS)
+    return Path(values[0]) if values else Path(app_context.work_dir)
+
+
+def start_checkpoints(
+    config: Dict, app_context: BIDSAppContext, command: List[str], container_id: str
+) -> Optional[WorkDirCheckpointer]:
+    """Restore the last checkpoint of this container's run, if any, and keep checkpointing.
+
+    Args:
+        config (Dict): gear config (gear-checkpoint-interval minutes; 0 turns checkpoints off)
+        app_context (BIDSAppContext): information specific to this BIDS app and gear run
+        command (List): BIDS App command; its MRIQC options must match the checkpoint's
+        container_id (str): container the gear was launched from, the same on every relaunch
+
+    Returns:
+        checkpointer (WorkDirCheckpointer): or None, if checkpoints are off
+    """
+    # Imported when needed; only relaunches with a saved work dir read it
+    from fw_gear_bids_mriqc.utils.archived_runs import restore_archived_work
+
+    interval = float(config.get("gear-checkpoint-interval") or 0)
+    writable_dir = config.get("gear-writable-dir")
+    if interval <= 0 or app_context.gear_dry_run:
+        return None
+    if not writable_dir:
+        log.info("Checkpoints need gear-writable-dir for a location that outlives the job; not checkpointing.")
+        return None
+
+    source = nipype_work_dir(app_context, command)
+    source.mkdir(parents=True, exist_ok=True)
+    flags = relevant_flags(command, [app_context.bids_dir, app_context.analysis_output_dir])
+    key = {"version": mriqc_version(command[0]), "flags": flags, "source": str(source)}
+    checkpoint_dir = Path(writable_dir) / CHECKPOINT_DIR / container_id
+    if not restore_checkpoint(checkpoint_dir, source, key) and getattr(app_context, "archived_work", None):
+        restore_archived_work(app_context.archived_work, source, Path(app_context.work_dir).name)
+
+    bids_dir = Path(app_context.bids_dir)
+    exclude = [DOWNLOAD_CACHE_DIR, RUN_CACHE_DIR, CHECKPOINT_DIR]
+    if bids_dir.parent == source:
+        exclude.append(bids_dir.name)
+    return WorkDirCheckpointer(source, checkpoint_dir, interval * 60, key, exclude).start()
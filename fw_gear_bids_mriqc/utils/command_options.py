@@ -0,0 +1,94 @@
+"""Inspect and edit kwargs in an already generated BIDS App command list."""
+
+from typing import Iterable, List, Tuple
+
+ANALYSIS_LEVELS = ("participant", "group")
+PARTICIPANT_OPTIONS = ["--participant-label", "--participant_label"]
+
+
+def _matches(arg: str, names: Iterable[str]) -> bool:
+    return any(arg == name or arg.startswith(name + "=") for name in names)
+
+
+def has_option(command: List[str], names: Iterable[str]) -> bool:
+    """Check whether any spelling of a kwarg is already in the command.
+
+    Args:
+        command (List): BIDS App command, e.g. ['mriqc', 'bids', 'out', 'participant', '--nprocs=4']
+        names (Iterable): spellings of the kwarg, e.g. ['--nprocs', '--n_procs']
+
+    Returns:
+        True if the kwarg is present, as either "--key value" or "--key=value"
+    """
+    return any(_matches(arg, names) for arg in command)
+
+
+def pop_option(command: List[str], names: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """Remove a kwarg and its values from the command.
+
+    `clean_generated_bids_command` splits space-separated values into
+    separate list items, so every item after the kwarg that is not another
+    kwarg is treated as one of its values.
+
+    Args:
+        command (List): BIDS App command list
+        names (Iterable): spellings of the kwarg to remove
+
+    Returns:
+        command (List): new command list without the kwarg
+        values (List): the values that were given to the kwarg
+    """
+    names = list(names)
+    out_cmd, values = [], []
+    i = 0
+    while i < len(command):
+        arg = command[i]
+        if _matches(arg, names):
+            if "=" in arg:
+                values.extend(arg.split("=", 1)[1].split())
+            i += 1
+            while i < len(command) and not command[i].startswith("-"):
+                values.append(command[i])
+                i += 1
+            continue
+        out_cmd.append(arg)
+        i += 1
+    return out_cmd, values
+
+
+def set_option(command: List[str], name: str, *values) -> List[str]:
+    """Append a kwarg (and values) to the command, replacing any previous entry.
+
+    Args:
+        command (List): BIDS App command list
+        name (str): the kwarg, e.g. '--participant-label'
+        values: values for the kwarg; none for boolean flags
+
+    Returns:
+        command (List): new command list
+    """
+    command, _ = pop_option(command, [name])
+    command.append(name)
+    command.extend(str(v) for v in values)
+    return command
+
+
+def set_output_dir(command: List[str], output_dir) -> List[str]:
+    """Replace the output_dir positional argument (the one before the analysis level).
+
+    Args:
+        command (List): BIDS App command, e.g. ['mriqc', 'bids', 'out', 'participant', ...]
+        output_dir: the new output directory
+
+    Returns:
+        command (List): new command list
+
+    Raises:
+        ValueError: the command has no analysis level
+    """
+    command = list(command)
+    for i, arg in enumerate(command[2:], start=2):
+        if arg in ANALYSIS_LEVELS:
+            command[i - 1] = str(output_dir)
+            return command
+    raise ValueError(f"No analysis level ({', '.join(ANALYSIS_LEVELS)}) in {command}")
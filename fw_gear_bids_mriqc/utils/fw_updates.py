@@ -0,0 +1,142 @@
+"""Bounded, retrying worker pool for Flywheel API writes."""
+
+import logging
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+log = logging.getLogger(__name__)
+
+# HTTP statuses that signal a transient API problem (rate limit or server hiccup)
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# Longest wait before a retry, whatever the backoff or a Retry-After header says
+MAX_RETRY_DELAY = 60.0
+
+
+@dataclass
+class PhaseStats:
+    """Counts and timings for one phase of API writes."""
+
+    phase: str
+    writes: int = 0
+    failures: int = 0
+    retries: int = 0
+    latencies: List[float] = field(default_factory=list)
+    wall_time: float = 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        """Condense the phase into reportable numbers (seconds)."""
+        ordered = sorted(self.latencies)
+        return {
+            "phase": self.phase,
+            "writes": self.writes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "wall_time": round(self.wall_time, 3),
+            "mean_latency": round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+            "p95_latency": round(ordered[int(0.95 * (len(ordered) - 1))], 3) if ordered else 0.0,
+            "max_latency": round(ordered[-1], 3) if ordered else 0.0,
+        }
+
+
+def _is_retryable(exc: Exception) -> bool:
+    """Decide whether an API error is worth another attempt."""
+    if getattr(exc, "status", None) in RETRYABLE_STATUS:
+        return True
+    # Dropped connections and timeouts (requests' errors subclass OSError)
+    return isinstance(exc, OSError)
+
+
+def _retry_delay(exc: Exception, attempt: int, backoff: float) -> float:
+    """Honor Retry-After when the API sends it; otherwise back off exponentially. Never over MAX_RETRY_DELAY."""
+    headers = getattr(exc, "headers", None) or {}
+    try:
+        delay = float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        delay = backoff * (2**attempt) * (1 + random.random())
+    # A bogus header (huge, negative, or NaN) must not stall the writes
+    if math.isnan(delay):
+        return MAX_RETRY_DELAY
+    return min(max(delay, 0.0), MAX_RETRY_DELAY)
+
+
+def _call_with_retries(task: Callable[[], Any], max_retries: int, backoff: float) -> Tuple[float, int]:
+    """Run a single write, retrying transient errors.
+
+    Returns:
+        latency (float): seconds spent on the successful attempt
+        retries (int): number of attempts that were retried
+    """
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            task()
+            return time.perf_counter() - start, attempt
+        except Exception as exc:
+            if attempt >= max_retries or not _is_retryable(exc):
+                exc.retries = attempt
+                raise
+            delay = _retry_delay(exc, attempt, backoff)
+            log.debug(f"Retrying API write in {delay:.1f}s after: {exc}")
+            time.sleep(delay)
+            attempt += 1
+
+
+def run_update_pool(
+    tasks: Iterable[Tuple[str, Callable[[], Any]]],
+    phase: str,
+    max_workers: int = 4,
+    max_retries: int = 4,
+    backoff: float = 0.5,
+) -> PhaseStats:
+    """Apply API writes through a bounded thread pool.
+
+    Each write is retried on rate limiting (429), 5xx responses, and dropped
+    connections. A write that still fails is logged and counted, but does not
+    stop the remaining writes.
+
+    Args:
+        tasks (Iterable): (label, callable) pairs; the callable performs one write
+        phase (str): name of the phase for reporting (e.g., "file-info")
+        max_workers (int): maximum number of concurrent writes
+        max_retries (int): retries per write before giving up
+        backoff (float): base delay (seconds) for the exponential backoff
+
+    Returns:
+        stats (PhaseStats): counts of writes, failures, retries, and latencies
+    """
+    stats = PhaseStats(phase)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = {pool.submit(_call_with_retries, task, max_retries, backoff): label for label, task in tasks}
+        for future in as_completed(futures):
+            try:
+                latency, retries = future.result()
+                stats.writes += 1
+                stats.retries += retries
+                stats.latencies.append(latency)
+                log.debug(f"Updated {futures[future]}")
+            except Exception as exc:
+                stats.failures += 1
+                stats.retries += getattr(exc, "retries", 0)
+                log.error(f"Unable to update {futures[future]}: {exc}")
+    stats.wall_time = time.perf_counter() - start
+    return stats
+
+
+def log_phase_stats(all_stats: List[PhaseStats]) -> None:
+    """Report the per-phase API write statistics at the end of the run."""
+    if not all_stats:
+        return
+    lines = [f"{'phase':<16}{'writes':>8}{'failed':>8}{'retries':>9}{'wall(s)':>9}{'mean(s)':>9}{'p95(s)':>8}"]
+    for stats in all_stats:
+        s = stats.summary()
+        lines.append(
+            f"{s['phase']:<16}{s['writes']:>8}{s['failures']:>8}{s['retries']:>9}"
+            f"{s['wall_time']:>9.2f}{s['mean_latency']:>9.3f}{s['p95_latency']:>8.3f}"
+        )
+    log.info("Metadata write summary:\n  " + "\n  ".join(lines))
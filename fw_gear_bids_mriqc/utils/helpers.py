@@ -1,16 +1,21 @@
 """Small methods specific to this BIDS app gear"""
 
 import logging
+import os
 import sys
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, List, Optional, Union
 
 from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
-from flywheel_bids.flywheel_bids_app_toolkit.commands import run_bids_algo, validate_kwargs
+from flywheel_bids.flywheel_bids_app_toolkit.commands import validate_kwargs
 from flywheel_bids.flywheel_bids_app_toolkit.utils.helpers import (
     determine_dir_structure,
 )
-from fw_gear_bids_mriqc.utils.store_iqms import store_iqms
+from fw_gear_bids_mriqc.utils.command_options import PARTICIPANT_OPTIONS, pop_option, set_option
+from fw_gear_bids_mriqc.utils.log_monitor import run_with_log_monitor
+from fw_gear_bids_mriqc.utils.resources import with_resource_options
+from fw_gear_bids_mriqc.utils.run_cache import CACHE_DIR, RunCache
+from fw_gear_bids_mriqc.utils.scheduler import discover_work_units, run_work_units
 
 log = logging.getLogger(__name__)
 
@@ -44,38 +49,116 @@ def find_group_tsvs(
         log.debug(f"Do you spot tsv files here?\n" f"{determine_dir_structure(flywheel_output_dir)}")
 
 
-def analyze_participants(app_context: BIDSAppContext, command: List) -> int:
+def analyze_participants(
+    app_context: BIDSAppContext, command: List, config: Optional[Dict] = None, cache_key: Optional[str] = None
+) -> int:
     """Ensure participants have been analyzed with mriqc
 
     Current behavior follows legacy bids-mriqc gear style of running the
     mriqc command with 'participant' rather than 'group' and then running
     the 'group' command.
 
-    Future behavior should check for "IQM" as metadata on acquisitions
-    and pull that metadata into the proper JSON file.
+    With `gear-parallel-participants` set to "participant" or "session", the
+    dataset is split into work units that run as separate, concurrent mriqc
+    commands (see `fw_gear_bids_mriqc.utils.scheduler`).
+
+    With `gear-incremental`, participants whose inputs are unchanged since the
+    last run are restored from the run cache instead of being re-run (see
+    `fw_gear_bids_mriqc.utils.run_cache`).
+
+    IQMs already stored on the project's files can be reused instead, so
+    that only participants without them are run (`gear-group-from-stored-iqms`,
+    see `reuse_stored_iqms`).
 
     Args:
         app_context (BIDSAppContext): information specific to this
                     BIDS app and gear run
         command (list): BIDS App command list to pass to subprocess
+        config (dict, optional): gear config
+        cache_key (str, optional): id of the container whose results are cached (the project)
     """
+    config = config or {}
 
     # Run participant-level analyses
     participant_command = ["participant" if arg == "group" else arg for arg in command]
+    parallel_mode = config.get("gear-parallel-participants") or "off"
+    run_cache, misses = None, None
     try:
-        log.info("NEED TO RUN PARTICIPANT LEVEL FIRST. ATTEMPTING...")
-        e_code = run_bids_algo(app_context, participant_command)
+        if config.get("gear-incremental") and cache_key:
+            cache_root = Path(config.get("gear-writable-dir") or app_context.work_dir) / CACHE_DIR / cache_key
+            run_cache = RunCache(
+                cache_root, app_context.bids_dir, participant_command, app_context.analysis_output_dir
+            )
+            participant_command, labels = pop_option(participant_command, PARTICIPANT_OPTIONS)
+            units = discover_work_units(app_context.bids_dir, participants=[lab.replace("sub-", "") for lab in labels])
+            hits, misses = run_cache.partition([unit.participant for unit in units])
+            run_cache.restore(hits, app_context.analysis_output_dir)
+            if not misses:
+                return 0
+            participant_command = set_option(participant_command, "--participant-label", *misses)
+
+        if parallel_mode in ["participant", "session"]:
+            participant_command, labels = pop_option(participant_command, PARTICIPANT_OPTIONS)
+            units = discover_work_units(
+                app_context.bids_dir,
+                by_session=parallel_mode == "session",
+                participants=[label.replace("sub-", "") for label in labels],
+            )
+            log.info("NEED TO RUN PARTICIPANT LEVEL FIRST. RUNNING %d WORK UNITS...", len(units))
+            e_code = run_work_units(app_context, participant_command, units, config)
+        else:
+            log.info("NEED TO RUN PARTICIPANT LEVEL FIRST. ATTEMPTING...")
+            Path(app_context.analysis_output_dir).mkdir(parents=True, exist_ok=True)
+            # Own log and node timings, so the group run does not overwrite them
+            e_code = run_with_log_monitor(
+                with_resource_options(participant_command, config),
+                app_context.output_dir,
+                f"{app_context.bids_app_binary}_participant",
+                environ=os.environ,
+                echo=not config.get("gear-log-to-file"),
+            )
+        if run_cache and e_code == 0:
+            run_cache.save(misses, app_context.analysis_output_dir)
     except Exception as e:
         log.error(f"While running {command} encountered:\n{e}")
         e_code = 1
     return e_code
 
 
+def reuse_stored_iqms(gear_context, app_context: BIDSAppContext, command: List) -> Optional[List]:
+    """Prepare a group-level run from the IQMs stored on Flywheel by earlier runs.
+
+    The stored IQMs are written out as MRIQC participant outputs (see
+    `fw_gear_bids_mriqc.utils.stored_iqms`), so only the participants with
+    scans that were never analyzed need a participant-level run.
+
+    Args:
+        gear_context (GearToolkitContext): gear context
+        app_context (BIDSAppContext): information specific to this
+                    BIDS app and gear run
+        command (list): BIDS App command list
+
+    Returns:
+        command (list): the command restricted to the participants that are
+                    missing IQMs, or None if no participant needs to be run
+    """
+    from fw_gear_bids_mriqc.utils.stored_iqms import materialize_stored_iqms
+
+    command, labels = pop_option(command, PARTICIPANT_OPTIONS)
+    missing = materialize_stored_iqms(gear_context, app_context, [label.replace("sub-", "") for label in labels])
+    if not missing:
+        return None
+    return set_option(command, "--participant-label", *missing)
+
+
 def store_metadata(gear_context, app_context):
     if app_context.gear_dry_run:
         log.info("Just dry run: no additional data.\n" "Skipping store_iqms method.")
         return {"analysis": {"info": {"derived": {"dry_run": {"How dry I am": "Say to Mister Temperance...."}}}}}
     else:
+        # Imported when needed; it pulls in the Flywheel client
+        from fw_gear_bids_mriqc.utils.store_iqms import store_iqms
+
         try:
             return store_iqms(gear_context, app_context)
         except TypeError:
@@ -87,16 +170,47 @@ def store_metadata(gear_context, app_context):
 
 def extra_post_processing(gear_context, app_context) -> None:
     """Collect IQMs and update the appropriate metadata fields"""
+    # pyarrow is only needed here, so dry runs and early exits don't load it
+    from fw_gear_bids_mriqc.utils.iqm_store import update_iqm_store
+    from fw_gear_bids_mriqc.utils.iqm_table import write_iqm_tables
 
+    archived = getattr(app_context, "archived_iqms", None)
     if app_context.analysis_level == "group":
         find_group_tsvs(
             app_context.analysis_output_dir,
             app_context.output_dir,
             gear_context.destination["id"],
         )
+        # Typed, per-modality tables for fast loading downstream
+        write_iqm_tables(
+            list(archived) if archived is not None else Path(app_context.analysis_output_dir).rglob("sub-*.json"),
+            app_context.output_dir,
+            gear_context.destination["id"],
+            loaded=archived,
+        )
+
+    # Project-wide IQMs, carried from run to run (any analysis level)
+    previous_store = gear_context.get_input_path("iqm_store")
+    if (previous_store or gear_context.config.get("gear-iqm-store")) and not app_context.gear_dry_run:
+        update_iqm_store(
+            list(archived) if archived is not None else Path(app_context.analysis_output_dir).rglob("sub-*.json"),
+            app_context.output_dir,
+            app_context.work_dir,
+            gear_context.destination["id"],
+            previous_store=previous_store,
+            loaded=archived,
+            export=gear_context.config.get("gear-iqm-store-export", False),
+        )
 
     store_metadata(gear_context, app_context)
 
+    if getattr(app_context, "batch_members", None) and not app_context.gear_dry_run:
+        from fw_gear_bids_mriqc.utils.batch import route_batch_outputs
+        from fw_gear_bids_mriqc.utils.fw_updates import log_phase_stats
+
+        # Each session of the batch gets its own results
+        log_phase_stats([route_batch_outputs(gear_context, app_context)])
+
 
 def validate_setup(gear_context, app_context):
     """Customizable validation pipeline for gear-dependent configuration options.
@@ -112,3 +226,5 @@ def validate_setup(gear_context, app_context):
     """
     if app_context.bids_app_options:
         validate_kwargs(app_context)
+    if gear_context.config.get("gear-batch-sessions") and app_context.post_processing_only:
+        raise ValueError("gear-batch-sessions cannot be combined with gear-post-processing-only.")
@@ -0,0 +1,178 @@
+"""Compact encoding of the per-scan IQM records sent to Flywheel as metadata.
+
+The IQMs of the scans that do not match an analyzed file go to the analysis
+info. Written as a list of dicts, every record repeats its ~68 key names and
+every float is at full precision. Here, each chunk keeps one key dictionary
+("schemas": the distinct key lists, e.g., one per modality) and the records
+are `[bids_name, schema, [values...]]` (plus the outlier flags, if any), with
+floats rounded to a configurable number of significant digits.
+
+`CompactIqmWriter` streams the records to disk as they come, starting a new
+chunk file when the current one reaches its size limit, so the whole
+structure is never built in memory. `read_chunk` turns a chunk back into the
+original records.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+log = logging.getLogger(__name__)
+
+ENCODING = "mriqc-iqm-compact/1"
+CHUNK_PREFIX = "mriqc_iqm_metadata"
+# Significant digits kept by default; MRIQC's own measures are not more precise
+DEFAULT_DIGITS = 6
+DEFAULT_CHUNK_KB = 1024
+
+_SEPARATORS = (",", ":")
+
+
+def round_floats(value, digits: Optional[int]):
+    """Round every float in a (nested) value to `digits` significant digits; None or 0 keeps them as they are."""
+    if not digits:
+        return value
+    return _round(value, f"%.{digits}g")
+
+
+def _round(value, fmt: str):
+    # Formatting with %g and parsing back is faster than math.log10 and round()
+    if type(value) is float:
+        return float(fmt % value)
+    if isinstance(value, list):
+        return [float(fmt % v) if type(v) is float else _round(v, fmt) for v in value]
+    if isinstance(value, dict):
+        return {k: float(fmt % v) if type(v) is float else _round(v, fmt) for k, v in value.items()}
+    return value
+
+
+class CompactIqmWriter:
+    """Stream IQM records to size-bounded chunks of the compact encoding.
+
+    Args:
+        directory (Path): where the chunks are written
+        max_chunk_bytes (int): chunks are kept under this size (a single larger record gets its own chunk)
+        digits (int, optional): significant digits of the floats; None keeps full precision
+        prefix (str): chunk file names are `<prefix>_<n>.json`
+    """
+
+    def __init__(
+        self,
+        directory: Union[Path, str],
+        max_chunk_bytes: int = DEFAULT_CHUNK_KB * 1024,
+        digits: Optional[int] = DEFAULT_DIGITS,
+        prefix: str = CHUNK_PREFIX,
+    ):
+        self.directory = Path(directory)
+        self.max_chunk_bytes = max_chunk_bytes
+        self.digits = digits
+        self.prefix = prefix
+        self.chunks: List[Path] = []
+        self.records = 0
+        # Size of the same records as a list of dicts at full precision
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self._fp = None
+        self._schemas: Dict[Tuple[str, ...], int] = {}
+        self._trailer_bytes = 0
+        self._chunk_bytes = 0
+        self._chunk_records = 0
+
+    def __enter__(self) -> "CompactIqmWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def add(self, bids_name: str, iqms: Dict, outliers: Optional[Dict] = None) -> None:
+        """Append one scan's IQMs (and outlier flags) to the current chunk."""
+        raw = dict(iqms, filename=bids_name)
+        if outliers is not None:
+            raw["IQM_outliers"] = outliers
+        self.raw_bytes += len(json.dumps(raw))
+
+        values = round_floats(list(iqms.values()), self.digits)
+        if self._fp is None:
+            self._open_chunk()
+        text = self._encode(bids_name, tuple(iqms), values, outliers)
+        # Start a new chunk rather than let this one go over its limit (unless it is the only record)
+        if self._chunk_records and self._chunk_bytes + len(text) + self._trailer_bytes > self.max_chunk_bytes:
+            self._close_chunk()
+            self._open_chunk()
+            text = self._encode(bids_name, tuple(iqms), values, outliers)
+        self._write(text)
+        self._chunk_records += 1
+        self.records += 1
+
+    def _encode(self, bids_name: str, keys: Tuple[str, ...], values: List, outliers: Optional[Dict]) -> str:
+        schema = self._schemas.get(keys)
+        if schema is None:
+            schema = self._schemas[keys] = len(self._schemas)
+            self._trailer_bytes = len(self._trailer())
+        record = [bids_name, schema, values]
+        if outliers is not None:
+            record.append(outliers)
+        return ("," if self._chunk_records else "") + json.dumps(record, separators=_SEPARATORS)
+
+    def close(self) -> None:
+        if self._fp is not None:
+            self._close_chunk()
+
+    def summary(self) -> Dict:
+        return {
+            "encoding": ENCODING,
+            "scans": self.records,
+            "chunks": [path.name for path in self.chunks],
+            "encoded_bytes": self.encoded_bytes,
+            "raw_bytes": self.raw_bytes,
+        }
+
+    @property
+    def ratio(self) -> float:
+        """Full-precision list-of-dicts size over the encoded size."""
+        return self.raw_bytes / self.encoded_bytes if self.encoded_bytes else 0.0
+
+    def _open_chunk(self) -> None:
+        path = self.directory / f"{self.prefix}_{len(self.chunks) + 1:03d}.json"
+        self.chunks.append(path)
+        self._fp = open(path, "w")
+        self._schemas = {}
+        self._trailer_bytes = len(self._trailer())
+        self._chunk_bytes = 0
+        self._chunk_records = 0
+        header = {"encoding": ENCODING, "digits": self.digits}
+        self._write(json.dumps(header, separators=_SEPARATORS)[:-1] + ',"records":[')
+
+    def _close_chunk(self) -> None:
+        # The key dictionary is complete only once the chunk's records are written
+        self._write(self._trailer())
+        self._fp.close()
+        self._fp = None
+        log.debug(f"Wrote {self._chunk_records} IQM records to {self.chunks[-1].name} ({self._chunk_bytes} bytes)")
+
+    def _trailer(self) -> str:
+        return '],"schemas":' + json.dumps([list(keys) for keys in self._schemas], separators=_SEPARATORS) + "}"
+
+    def _write(self, text: str) -> None:
+        self._fp.write(text)
+        self._chunk_bytes += len(text)
+        self.encoded_bytes += len(text)
+
+
+def decode_records(chunk: Dict) -> Iterator[Dict]:
+    """The records of a compact chunk, as the dicts they were encoded from."""
+    schemas = chunk["schemas"]
+    for record in chunk["records"]:
+        bids_name, schema, values = record[:3]
+        iqms = dict(zip(schemas[schema], values))
+        iqms["filename"] = bids_name
+        if len(record) > 3:
+            iqms["IQM_outliers"] = record[3]
+        yield iqms
+
+
+def read_chunk(path: Union[Path, str]) -> Iterator[Dict]:
+    """Read a chunk written by `CompactIqmWriter`."""
+    with open(path) as fp:
+        yield from decode_records(json.load(fp))
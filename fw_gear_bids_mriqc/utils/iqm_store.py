@@ -0,0 +1,376 @@
+"""Project-wide IQM store (SQLite), carried from one gear run to the next.
+
+Each run upserts the IQMs of the scans it analyzed, keyed by BIDS name and
+MRIQC version, and keeps running per-IQM statistics up to date as it goes.
+The store holds only the latest IQMs of each scan (per MRIQC version): a
+re-analysis replaces the earlier values, which are not kept as history. A
+run only parses, aggregates, and writes out the scans it changed, however many
+earlier runs the store holds; the full project-wide group tables are exported
+from the store only when asked for (gear-iqm-store-export).
+"""
+
+import hashlib
+import json
+import logging
+import math
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from fw_gear_bids_mriqc.utils.bids_entities import KEY_ENTITIES, parse_bids_entities
+from fw_gear_bids_mriqc.utils.iqm_table import MODALITIES, _flatten
+
+log = logging.getLogger(__name__)
+
+STORE_NAME = "mriqc_iqm_store.sqlite"
+SCHEMA_VERSION = 1
+UNKNOWN_VERSION = "unknown"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    bids_name TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    sub TEXT NOT NULL,
+    ses TEXT,
+    task TEXT,
+    acq TEXT,
+    run TEXT,
+    entities TEXT NOT NULL,
+    mriqc_version TEXT NOT NULL,
+    iqms TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    destination_id TEXT,
+    updated REAL NOT NULL,
+    UNIQUE (bids_name, mriqc_version)
+);
+CREATE INDEX IF NOT EXISTS scans_by_entities ON scans (modality, sub, ses, task, run, mriqc_version);
+CREATE INDEX IF NOT EXISTS scans_by_version ON scans (mriqc_version);
+CREATE INDEX IF NOT EXISTS scans_by_destination ON scans (modality, destination_id);
+CREATE TABLE IF NOT EXISTS iqm_columns (
+    modality TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (modality, name)
+);
+CREATE TABLE IF NOT EXISTS iqm_stats (
+    modality TEXT NOT NULL,
+    mriqc_version TEXT NOT NULL,
+    name TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    m2 REAL NOT NULL,
+    PRIMARY KEY (modality, mriqc_version, name)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    destination_id TEXT PRIMARY KEY,
+    finished REAL NOT NULL,
+    inserted INTEGER NOT NULL,
+    updated INTEGER NOT NULL,
+    unchanged INTEGER NOT NULL
+);
+"""
+
+
+def _numeric(iqms: Dict) -> Dict[str, float]:
+    return {
+        k: float(v)
+        for k, v in iqms.items()
+        if isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v)
+    }
+
+
+class IqmStore:
+    """Scans and their IQMs, with running statistics, in one SQLite file.
+
+    Rows are never deleted. A scan analyzed again with the same MRIQC version
+    replaces its IQMs in place (and in the statistics), so only the latest
+    values are kept; another MRIQC version adds a row.
+
+    Args:
+        path (Path): SQLite file; created if missing
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.row_factory = sqlite3.Row
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"{self.path} was written by a newer gear (schema {version} > {SCHEMA_VERSION})")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "IqmStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def upsert(self, records: Iterable[Dict], destination_id: Optional[str] = None) -> Dict[str, int]:
+        """Add or replace scans, in one transaction.
+
+        Args:
+            records (Iterable[Dict]): from `iter_store_records`
+            destination_id (str, optional): the analysis the IQMs come from
+
+        Returns:
+            counts (Dict): inserted, updated, and unchanged scans
+        """
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        now = time.time()
+        # Running statistics of the modalities and versions touched, written once at the end
+        stats = {}
+        with self.conn:
+            for record in records:
+                iqms_json = json.dumps(record["iqms"], sort_keys=True)
+                content_hash = hashlib.blake2b(iqms_json.encode(), digest_size=16).hexdigest()
+                old = self.conn.execute(
+                    "SELECT id, iqms, content_hash FROM scans WHERE bids_name = ? AND mriqc_version = ?",
+                    (record["bids_name"], record["mriqc_version"]),
+                ).fetchone()
+                if old and old["content_hash"] == content_hash:
+                    counts["unchanged"] += 1
+                    continue
+                entities = record["entities"]
+                values = (
+                    record["modality"],
+                    entities["sub"],
+                    *(entities.get(k) for k in KEY_ENTITIES[1:]),
+                    json.dumps(entities, sort_keys=True),
+                    iqms_json,
+                    content_hash,
+                    destination_id,
+                    now,
+                )
+                if old:
+                    self._update_stats(stats, record["modality"], record["mriqc_version"], json.loads(old["iqms"]), -1)
+                    self.conn.execute(
+                        "UPDATE scans SET modality = ?, sub = ?, ses = ?, task = ?, acq = ?, run = ?, entities = ?, "
+                        "iqms = ?, content_hash = ?, destination_id = ?, updated = ? WHERE id = ?",
+                        (*values, old["id"]),
+                    )
+                    counts["updated"] += 1
+                else:
+                    self.conn.execute(
+                        "INSERT INTO scans (modality, sub, ses, task, acq, run, entities, iqms, content_hash, "
+                        "destination_id, updated, bids_name, mriqc_version) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (*values, record["bids_name"], record["mriqc_version"]),
+                    )
+                    counts["inserted"] += 1
+                self._update_stats(stats, record["modality"], record["mriqc_version"], record["iqms"], +1)
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO iqm_columns (modality, name) VALUES (?, ?)",
+                    [(record["modality"], name) for name in record["iqms"]],
+                )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO iqm_stats (modality, mriqc_version, name, n, mean, m2) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(*key, *value) for key, value in stats.items()],
+            )
+            if destination_id:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO runs (destination_id, finished, inserted, updated, unchanged) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (destination_id, now, counts["inserted"], counts["updated"], counts["unchanged"]),
+                )
+        return counts
+
+    def _update_stats(self, stats: Dict, modality: str, mriqc_version: str, iqms: Dict, sign: int) -> None:
+        """Add (sign=1) or remove (sign=-1) one scan from the running mean and variance (Welford)."""
+        for name, value in _numeric(iqms).items():
+            key = (modality, mriqc_version, name)
+            if key not in stats:
+                row = self.conn.execute(
+                    "SELECT n, mean, m2 FROM iqm_stats WHERE modality = ? AND mriqc_version = ? AND name = ?", key
+                ).fetchone()
+                stats[key] = (row["n"], row["mean"], row["m2"]) if row else (0, 0.0, 0.0)
+            n, mean, m2 = stats[key]
+            if sign > 0:
+                n += 1
+                delta = value - mean
+                mean += delta / n
+                m2 += delta * (value - mean)
+            elif n <= 1:
+                n, mean, m2 = 0, 0.0, 0.0
+            else:
+                old_mean = (n * mean - value) / (n - 1)
+                m2 = max(m2 - (value - mean) * (value - old_mean), 0.0)
+                n, mean = n - 1, old_mean
+            stats[key] = (n, mean, m2)
+
+    def columns(self, modality: str) -> List[str]:
+        rows = self.conn.execute("SELECT name FROM iqm_columns WHERE modality = ? ORDER BY name", (modality,))
+        return [row["name"] for row in rows]
+
+    def latest_scans(self, modality: str) -> Iterator[sqlite3.Row]:
+        """The most recently updated row of each scan, by BIDS name."""
+        # SQLite takes the bare columns from the row with the MAX()
+        yield from self.conn.execute(
+            "SELECT *, MAX(updated) FROM scans WHERE modality = ? GROUP BY bids_name ORDER BY bids_name",
+            (modality,),
+        )
+
+    def scans_from(self, modality: str, destination_id: str) -> Iterator[sqlite3.Row]:
+        """The scans that an analysis added or changed (and that no later run changed again)."""
+        yield from self.conn.execute(
+            "SELECT * FROM scans WHERE modality = ? AND destination_id = ? ORDER BY bids_name",
+            (modality, destination_id),
+        )
+
+    def stats(self, modality: str) -> Iterator[Tuple[str, str, int, float, float]]:
+        """(mriqc_version, IQM, n, mean, standard deviation) for the modality."""
+        rows = self.conn.execute(
+            "SELECT mriqc_version, name, n, mean, m2 FROM iqm_stats WHERE modality = ? AND n > 0 "
+            "ORDER BY mriqc_version, name",
+            (modality,),
+        )
+        for row in rows:
+            std = math.sqrt(row["m2"] / (row["n"] - 1)) if row["n"] > 1 else 0.0
+            yield row["mriqc_version"], row["name"], row["n"], row["mean"], std
+
+
+def iter_store_records(
+    json_files: Iterable[Union[Path, str]], loaded: Optional[Dict[Path, Dict]] = None
+) -> Iterator[Dict]:
+    """Read the per-scan MRIQC JSONs into store records.
+
+    Args:
+        json_files (Iterable): MRIQC per-scan JSON outputs
+        loaded (Dict, optional): IQMs already read (e.g., from an archived run), by file
+
+    Yields:
+        record (Dict): bids_name, modality, entities, mriqc_version, and flat IQMs
+    """
+    for json_file in json_files:
+        entities = parse_bids_entities(json_file)
+        modality = entities.pop("suffix", None)
+        if modality not in MODALITIES or "sub" not in entities:
+            continue
+        try:
+            if loaded and Path(json_file) in loaded:
+                data = loaded[Path(json_file)]
+            else:
+                with open(json_file) as fp:
+                    data = json.load(fp)
+        except (OSError, ValueError) as exc:
+            log.debug(f"Skipping {json_file}: {exc}")
+            continue
+        yield {
+            "bids_name": Path(json_file).name[: -len(".json")],
+            "modality": modality,
+            "entities": entities,
+            "mriqc_version": (data.get("provenance") or {}).get("version") or UNKNOWN_VERSION,
+            "iqms": _flatten(data),
+        }
+
+
+def write_store_tables(
+    store: IqmStore, output_dir: Union[Path, str], destination_id: Optional[str] = None
+) -> List[Path]:
+    """Write the group TSV and IQM statistics of each modality in the store.
+
+    The statistics are always written (project_group_<modality>_stats.tsv). With
+    a destination_id, the group TSV only has the scans that analysis added or
+    changed (project_group_<modality>_updates.tsv), so writing it does not grow
+    with the store; without one, every scan is exported (project_group_<modality>.tsv).
+
+    Returns:
+        written (List[Path]): the tables that were written
+    """
+    written = []
+    for modality in MODALITIES:
+        iqm_names = store.columns(modality)
+        if not iqm_names:
+            continue
+        entity_names = list(KEY_ENTITIES)
+        if destination_id:
+            path = Path(output_dir) / f"project_group_{modality}_updates.tsv"
+            scans = store.scans_from(modality, destination_id)
+        else:
+            path = Path(output_dir) / f"project_group_{modality}.tsv"
+            scans = store.latest_scans(modality)
+        rows = 0
+        with open(path, "w") as fp:
+            fp.write("\t".join(["bids_name", *entity_names, "mriqc_version", *iqm_names]) + "\n")
+            for scan in scans:
+                entities = json.loads(scan["entities"])
+                iqms = json.loads(scan["iqms"])
+                cells = [scan["bids_name"], *(entities.get(k) for k in entity_names), scan["mriqc_version"]]
+                cells.extend(iqms.get(name) for name in iqm_names)
+                fp.write("\t".join(_cell(v) for v in cells) + "\n")
+                rows += 1
+        stats_path = Path(output_dir) / f"project_group_{modality}_stats.tsv"
+        with open(stats_path, "w") as fp:
+            fp.write("mriqc_version\tiqm\tn\tmean\tstd\n")
+            for version, name, n, mean, std in store.stats(modality):
+                fp.write(f"{version}\t{name}\t{n}\t{mean:.6g}\t{std:.6g}\n")
+        written.extend([path, stats_path])
+        log.info(f"Wrote {path.name}: {rows} scans x {len(iqm_names)} IQMs")
+    return written
+
+
+def _cell(value) -> str:
+    if value is None:
+        return "n/a"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def update_iqm_store(
+    json_files: Iterable[Union[Path, str]],
+    output_dir: Union[Path, str],
+    work_dir: Union[Path, str],
+    destination_id: str,
+    previous_store: Optional[Union[Path, str]] = None,
+    loaded: Optional[Dict[Path, Dict]] = None,
+    export: bool = False,
+) -> Optional[Path]:
+    """Add this run's IQMs to the store and write the tables of the scans it changed.
+
+    The store is updated in the work directory (SQLite does not like network
+    file systems) and copied to the output directory, to be given to the next
+    run as the iqm_store input.
+
+    Args:
+        json_files (Iterable): MRIQC per-scan JSON outputs of this run
+        output_dir (Path): gear output directory
+        work_dir (Path): local directory to update the store in
+        destination_id (str): Flywheel id of the analysis
+        previous_store (Path, optional): store from an earlier run (iqm_store input);
+            without it, the store starts empty
+        loaded (Dict, optional): IQMs already read, by file
+        export (bool): also export the full project-wide group tables
+
+    Returns:
+        path (Path): the store in the output directory, None if it could not be updated
+    """
+    local = Path(work_dir) / STORE_NAME
+    # Never a leftover store (or its journal) from an earlier run in the same work directory
+    for path in [local, local.with_name(f"{local.name}-journal")]:
+        path.unlink(missing_ok=True)
+    if previous_store:
+        shutil.copyfile(previous_store, local)
+    try:
+        with IqmStore(local) as store:
+            counts = store.upsert(iter_store_records(json_files, loaded), destination_id)
+            write_store_tables(store, output_dir, destination_id)
+            if export:
+                write_store_tables(store, output_dir)
+    except (sqlite3.Error, ValueError) as exc:
+        log.error(f"Could not update the IQM store: {exc}")
+        return None
+    log.info(
+        f"IQM store: {counts['inserted']} scans added, {counts['updated']} updated, "
+        f"{counts['unchanged']} unchanged."
+    )
+    output = Path(output_dir) / STORE_NAME
+    shutil.copyfile(local, output)
+    return output
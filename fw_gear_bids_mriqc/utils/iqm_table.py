@@ -0,0 +1,187 @@
+"""Typed, columnar IQM tables (Parquet and Arrow IPC) built from the per-scan MRIQC JSONs."""
+
+import json
+import logging
+import numbers
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+
+from fw_gear_bids_mriqc.utils.bids_entities import KEY_ENTITIES, parse_bids_entities
+
+log = logging.getLogger(__name__)
+
+MODALITIES = ("T1w", "T2w", "bold")
+# Fields of the MRIQC JSON that are not IQMs
+SKIP_FIELDS = ("bids_meta", "provenance")
+
+
+def _flatten(data: Dict, prefix: str = "") -> Dict:
+    """Nested IQMs (e.g., {"summary": {"bg": {"mean": 1}}}) become "summary_bg_mean"."""
+    flat = {}
+    for key, value in data.items():
+        if key.startswith("__") or (not prefix and key in SKIP_FIELDS):
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{name}_"))
+        else:
+            flat[name] = value
+    return flat
+
+
+def collect_iqm_records(
+    json_files: Iterable[Union[Path, str]], loaded: Optional[Dict[Path, Dict]] = None
+) -> Dict[str, List[Dict]]:
+    """Read the per-scan IQM JSONs into flat records, grouped by modality.
+
+    Args:
+        json_files (Iterable): MRIQC per-scan JSON outputs
+        loaded (Dict, optional): IQMs already read (e.g., from an archived run), by file
+
+    Returns:
+        records (Dict): modality (T1w, T2w, bold) -> list of flat records. Each
+            record carries the scan's BIDS entities and its IQMs.
+    """
+    records = defaultdict(list)
+    for json_file in json_files:
+        entities = parse_bids_entities(json_file)
+        modality = entities.pop("suffix", None)
+        if modality not in MODALITIES or "sub" not in entities:
+            continue
+        try:
+            if loaded and Path(json_file) in loaded:
+                iqms = loaded[Path(json_file)]
+            else:
+                with open(json_file) as fp:
+                    iqms = json.load(fp)
+        except (OSError, ValueError) as exc:
+            log.debug(f"Skipping {json_file}: {exc}")
+            continue
+        record = {"bids_name": Path(json_file).name[: -len(".json")], **entities}
+        record.update({k: v for k, v in _flatten(iqms).items() if k not in record})
+        records[modality].append(record)
+    return records
+
+
+def _column_type(values: List):
+    """Narrowest Arrow type for one IQM column."""
+    present = [v for v in values if v is not None]
+    if present and all(isinstance(v, bool) for v in present):
+        return pa.bool_()
+    if all(isinstance(v, numbers.Real) and not isinstance(v, bool) for v in present):
+        return pa.float64()
+    return pa.string()
+
+
+def build_iqm_table(records: List[Dict]) -> "pa.Table":
+    """Convert flat IQM records into a typed Arrow table.
+
+    Entity columns (sub, ses, task, acq, run, ...) come first and are
+    dictionary-encoded strings; IQMs are float64 (bool for flags), and
+    anything else (lists, free text) is stored as a string.
+
+    Args:
+        records (List[Dict]): output of `collect_iqm_records` for one modality
+
+    Returns:
+        table (pa.Table): one row per scan, sorted by bids_name
+    """
+    records = sorted(records, key=lambda r: r["bids_name"])
+    names = list(dict.fromkeys(k for record in records for k in record))
+    found = {k for record in records for k in parse_bids_entities(record["bids_name"])} - {"suffix"}
+    entity_names = [k for k in KEY_ENTITIES if k in found] + sorted(found - set(KEY_ENTITIES))
+    iqm_names = sorted(k for k in names if k not in entity_names and k != "bids_name")
+
+    arrays, fields = [], []
+    for name in ["bids_name"] + entity_names:
+        arrays.append(pa.array([r.get(name) for r in records], pa.string()).dictionary_encode())
+        fields.append(pa.field(name, arrays[-1].type))
+    for name in iqm_names:
+        values = [r.get(name) for r in records]
+        col_type = _column_type(values)
+        if col_type == pa.string():
+            values = [v if v is None or isinstance(v, str) else json.dumps(v) for v in values]
+        arrays.append(pa.array(values, col_type))
+        fields.append(pa.field(name, col_type))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def write_iqm_tables(
+    json_files: Iterable[Union[Path, str]],
+    output_dir: Union[Path, str],
+    destination_id: str,
+    loaded: Optional[Dict[Path, Dict]] = None,
+) -> List[Path]:
+    """Write one Parquet and one Arrow IPC table per modality next to the group TSVs.
+
+    Files are named like the TSVs from `find_group_tsvs`, e.g.,
+    group_T1w_<destination_id>.parquet and group_T1w_<destination_id>.arrow.
+
+    Args:
+        json_files (Iterable): MRIQC per-scan JSON outputs
+        output_dir (Path): gear output directory
+        destination_id (str): Flywheel id of the analysis
+        loaded (Dict, optional): IQMs already read, by file (see `collect_iqm_records`)
+
+    Returns:
+        written (List[Path]): the tables that were written
+    """
+    if pa is None:
+        log.info("pyarrow is not installed; skipping the Parquet/Arrow IQM tables.")
+        return []
+
+    written = []
+    for modality, records in sorted(collect_iqm_records(json_files, loaded).items()):
+        table = build_iqm_table(records)
+        stem = Path(output_dir) / f"group_{modality}_{destination_id}"
+        pq.write_table(table, stem.with_suffix(".parquet"), compression="zstd")
+        with pa.OSFile(str(stem.with_suffix(".arrow")), "wb") as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        written.extend([stem.with_suffix(".parquet"), stem.with_suffix(".arrow")])
+        log.info(f"Wrote {modality} IQM table: {table.num_rows} scans x {table.num_columns} columns")
+    return written
+
+
+def load_iqm_table(
+    path: Union[Path, str],
+    columns: Optional[List[str]] = None,
+    filters: Optional[List] = None,
+    as_pandas: bool = False,
+):
+    """Load an IQM table written by `write_iqm_tables`.
+
+    Parquet files are read column by column (only the requested columns are
+    decoded, and `filters` are pushed down to the row groups). Arrow IPC files
+    are memory-mapped, so opening them costs no copies.
+
+    Args:
+        path (Path): .parquet or .arrow file
+        columns (List, optional): subset of columns to read
+        filters (List, optional): Parquet filters, e.g., [("sub", "in", ["01", "02"])]
+        as_pandas (bool): return a pandas DataFrame instead of an Arrow table
+
+    Returns:
+        pa.Table or pandas.DataFrame
+    """
+    if pa is None:
+        raise ImportError("Loading IQM tables requires pyarrow (pip install fw-gear-bids-mriqc[tables]).")
+    path = Path(path)
+    if path.suffix == ".parquet":
+        table = pq.read_table(path, columns=columns, filters=filters, memory_map=True)
+    else:
+        with pa.memory_map(str(path), "r") as source:
+            table = ipc.open_file(source).read_all()
+        if columns:
+            table = table.select(columns)
+        if filters:
+            log.warning("filters are only applied to Parquet files; ignoring them.")
+    return table.to_pandas() if as_pandas else table
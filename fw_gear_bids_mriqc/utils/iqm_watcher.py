@@ -0,0 +1,306 @@
+"""Harvest IQM JSONs while MRIQC is still running, and send them to Flywheel right away."""
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import queue
+import select
+import struct
+import threading
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+from flywheel_gear_toolkit import GearToolkitContext
+
+from fw_gear_bids_mriqc.utils.batch import batch_session_ids
+from fw_gear_bids_mriqc.utils.fw_updates import PhaseStats, run_update_pool
+from fw_gear_bids_mriqc.utils.store_iqms import (
+    _get_client,
+    _get_engine_acquisition_id,
+    _iqm_digits,
+    _update_fw_file,
+    build_bids_file_index,
+    filter_fw_files,
+    iter_associated_bids_files,
+)
+
+log = logging.getLogger(__name__)
+
+POLL_SECONDS = 5.0
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII")
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+def is_iqm_json(path: Path) -> bool:
+    """Per-scan MRIQC output, e.g., sub-01_T1w.json (same rules as `_find_output_files`)."""
+    return path.suffix == ".json" and path.name.startswith("sub-")
+
+
+class _PollingWatcher:
+    """Report new or changed IQM JSONs by re-scanning the tree every few seconds."""
+
+    def __init__(self, root: Path, callback: Callable[[Path], None], interval: float = POLL_SECONDS):
+        self.root = root
+        self.callback = callback
+        self.interval = interval
+        self._seen = {}
+        self._stop = threading.Event()
+
+    def scan(self) -> None:
+        stack = [str(self.root)]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                path = Path(entry.path)
+                if not is_iqm_json(path):
+                    continue
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if self._seen.get(path) != signature:
+                    self._seen[path] = signature
+                    self.callback(path)
+
+    def run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.scan()
+        # Pick up whatever was written since the last pass
+        self.scan()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class _InotifyWatcher:
+    """Report IQM JSONs as soon as they are closed or moved into the tree (Linux only)."""
+
+    def __init__(self, root: Path, callback: Callable[[Path], None]):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._add_watch = libc.inotify_add_watch
+        self.root = root
+        self.callback = callback
+        self._dirs = {}
+        # Directories that could not be watched (e.g., max_user_watches reached)
+        self.unwatched = 0
+        self._stop = threading.Event()
+        self._watch_tree(root)
+
+    def _watch_tree(self, top: Path) -> None:
+        """Watch a directory and everything below it, reporting the files already there."""
+        for dirpath, _, filenames in os.walk(top):
+            wd = self._add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                self.unwatched += 1
+                level = logging.WARNING if self.unwatched == 1 else logging.DEBUG
+                log.log(level, f"Unable to watch {dirpath}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self._dirs[wd] = Path(dirpath)
+            for name in filenames:
+                path = Path(dirpath) / name
+                if is_iqm_json(path):
+                    self.callback(path)
+
+    def _read_events(self, timeout: float) -> bool:
+        """Handle one batch of events; False if there were none."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+            name = buffer[offset + _EVENT.size : offset + _EVENT.size + length].rstrip(b"\0")
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                log.debug("inotify queue overflowed; re-scanning the output tree.")
+                self._watch_tree(self.root)
+                continue
+            if wd not in self._dirs or not name:
+                continue
+            path = self._dirs[wd] / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_iqm_json(path):
+                self.callback(path)
+        return True
+
+    def run(self) -> None:
+        while not self._stop.is_set():
+            self._read_events(1.0)
+        # Drain the events queued before stop()
+        while self._read_events(0):
+            pass
+        os.close(self.fd)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class IqmHarvester:
+    """Collect the IQM JSONs that MRIQC writes and stream them to the Flywheel files.
+
+    A watcher thread (inotify, or polling where inotify is not available or
+    cannot see the writes, e.g., NFS) parses each JSON as soon as it is
+    complete. An upload thread matches it to its Flywheel file and sends the
+    IQMs through the bounded, retrying API pool. If inotify could not watch
+    every output directory, the tree is scanned once more when the run ends,
+    so the index is complete. After the run, `store_iqms` only confirms this
+    index and writes whatever was not already sent.
+    """
+
+    def __init__(
+        self,
+        app_context: BIDSAppContext,
+        gear_context: Optional[GearToolkitContext] = None,
+        polling: bool = False,
+        poll_interval: float = POLL_SECONDS,
+    ):
+        self.app_context = app_context
+        self.root = Path(app_context.analysis_output_dir)
+        self.gear_context = gear_context
+        self.index: Dict[Path, Dict] = {}
+        self.uploaded: Set[Path] = set()
+        self.stats: Optional[PhaseStats] = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads: List[threading.Thread] = []
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.watcher = None
+        if not polling:
+            try:
+                self.watcher = _InotifyWatcher(self.root, self._on_file)
+            except (OSError, AttributeError) as exc:
+                log.debug(f"inotify is not available ({exc}); polling for IQMs instead.")
+        if self.watcher is None:
+            self.watcher = _PollingWatcher(self.root, self._on_file, poll_interval)
+
+    def start(self) -> "IqmHarvester":
+        self._threads.append(threading.Thread(target=self.watcher.run, name="iqm-watcher", daemon=True))
+        if self.gear_context is not None:
+            self._threads.append(threading.Thread(target=self._upload, name="iqm-upload", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        log.info(f"Harvesting IQMs from {self.root} with {type(self.watcher).__name__.strip('_')}")
+        return self
+
+    def stop(self) -> None:
+        """Stop watching, then wait for the queued IQM updates to finish."""
+        self.watcher.stop()
+        self._threads[0].join()
+        if getattr(self.watcher, "unwatched", 0):
+            log.warning(
+                f"{self.watcher.unwatched} output directories could not be watched; scanning {self.root} for "
+                "the IQMs that were missed."
+            )
+            _PollingWatcher(self.root, self._on_file).scan()
+        self._queue.put(None)
+        for thread in self._threads[1:]:
+            thread.join()
+        log.info(f"Harvested {len(self.index)} IQM files during the run; {len(self.uploaded)} already on Flywheel.")
+
+    def confirmed_files(self) -> List[Path]:
+        """Harvested IQM files that are still on disk, for post-run processing."""
+        return sorted(path for path in self.index if path.exists())
+
+    def _on_file(self, path: Path) -> None:
+        try:
+            with open(path) as fp:
+                json_data = json.load(fp)
+        except (OSError, ValueError):
+            # Not complete yet; the next event (or poll) will pick it up
+            return
+        with self._lock:
+            if self.index.get(path) == json_data:
+                # Reported twice (e.g., found by a directory scan, then by its event)
+                return
+            self.index[path] = json_data
+            self.uploaded.discard(path)
+        self._queue.put(path)
+
+    def _mark_uploaded(self, path: Path, json_data: Dict, write: Callable[[], None]) -> None:
+        write()
+        with self._lock:
+            if self.index.get(path) is json_data:
+                self.uploaded.add(path)
+
+    def _iter_tasks(self):
+        """Turn harvested files into API writes until stop() is called."""
+        bids_index, engine_acq_id = None, None
+        fw = _get_client(self.gear_context)
+        digits = _iqm_digits(self.gear_context)
+        for path in iter(self._queue.get, None):
+            if bids_index is None:
+                bids_index = build_bids_file_index(
+                    iter_associated_bids_files(self.gear_context, parent_ids=batch_session_ids(self.app_context))
+                )
+                engine_acq_id = _get_engine_acquisition_id(self.gear_context)
+            # IQMs read back from Flywheel (gear-group-from-stored-iqms) are already there
+            if path in getattr(self.app_context, "reused_iqm_files", ()):
+                continue
+            fw_file = filter_fw_files(path.stem, bids_index)
+            # Unmatched files and the launch acquisition's files go through .metadata.json at the end
+            if not fw_file or fw_file.acquisition_id == engine_acq_id:
+                continue
+            json_data = self.index[path]
+            write = partial(_update_fw_file, fw, fw_file, json_data, digits=digits)
+            yield fw_file.name, partial(self._mark_uploaded, path, json_data, write)
+
+    def _upload(self) -> None:
+        try:
+            self.stats = run_update_pool(
+                self._iter_tasks(),
+                "live-file-info",
+                max_workers=self.gear_context.config.get("gear-metadata-workers") or 4,
+            )
+        except Exception as exc:
+            # Anything not sent now is sent by store_iqms after the run
+            log.warning(f"Live IQM updates stopped: {exc}")
+            while self._queue.get() is not None:
+                pass
+
+
+def start_iqm_harvester(
+    gear_context: GearToolkitContext, app_context: BIDSAppContext, polling: bool = False
+) -> Optional[IqmHarvester]:
+    """Start harvesting IQMs for this run, if `gear-live-iqms` is on.
+
+    The harvester is kept on `app_context.iqm_harvester` for `store_iqms`.
+
+    Args:
+        gear_context (GearToolkitContext): gear context
+        app_context (BIDSAppContext): information specific to this BIDS app and gear run
+        polling (bool): poll instead of using inotify (e.g., outputs written by other nodes)
+
+    Returns:
+        harvester (IqmHarvester): the running harvester, or None
+    """
+    if not gear_context.config.get("gear-live-iqms"):
+        return None
+    app_context.iqm_harvester = IqmHarvester(app_context, gear_context, polling=polling).start()
+    return app_context.iqm_harvester
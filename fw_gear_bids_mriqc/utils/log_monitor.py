@@ -0,0 +1,212 @@
+"""Stream the BIDS App output: nipype node timings, progress lines, and a compressed full log."""
+
+import csv
+import gzip
+import io
+import json
+import logging
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Dict, List, Optional, TextIO, Union
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+PROGRESS_SECONDS = 60
+TAIL_LINES = 200
+
+NODE_START = re.compile(r'\[Node\] Setting-up "(?P<node>[^"]+)" in "(?P<node_dir>[^"]+)"')
+NODE_FINISH = re.compile(r'\[Node\] Finished "(?P<node>[^"]+)", elapsed time (?P<elapsed>[\d.]+)s')
+MULTIPROC = re.compile(r"\[MultiProc\] Running (?P<running>\d+) tasks, and (?P<ready>\d+) jobs ready")
+PARTICIPANT = re.compile(r"sub-([a-zA-Z0-9]+)")
+
+
+def open_compressed_log(path_stem: Union[Path, str]) -> TextIO:
+    """Text stream for the full log: zstd if available, gzip otherwise."""
+    if zstandard is not None:
+        raw = open(f"{path_stem}.zst", "wb")
+        writer = zstandard.ZstdCompressor(level=10).stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(writer, encoding="utf-8")
+    return gzip.open(f"{path_stem}.gz", "wt", compresslevel=6, encoding="utf-8")
+
+
+class NodeTimer:
+    """Pair nipype "Setting-up" and "Finished" lines into per-node timings."""
+
+    def __init__(self):
+        self.running = defaultdict(deque)
+        self.finished: List[Dict] = []
+        self.ready = 0
+
+    def feed(self, line: str, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        match = NODE_START.search(line)
+        if match:
+            participant = PARTICIPANT.search(match.group("node_dir"))
+            self.running[match.group("node")].append((now, participant.group(1) if participant else ""))
+            return
+        match = NODE_FINISH.search(line)
+        if match:
+            node = match.group("node")
+            if not self.running.get(node):
+                # Older nipype only reports the short name when finishing
+                node = next((n for n, q in self.running.items() if q and n.rsplit(".", 1)[-1] == node), node)
+            start, participant = self.running[node].popleft() if self.running.get(node) else (None, "")
+            self.finished.append(
+                {
+                    "participant": participant,
+                    "node": node,
+                    "start": round(start, 3) if start else None,
+                    "finish": round(now, 3),
+                    "elapsed": float(match.group("elapsed")),
+                }
+            )
+            return
+        match = MULTIPROC.search(line)
+        if match:
+            self.ready = int(match.group("ready"))
+
+    @property
+    def n_running(self) -> int:
+        return sum(len(q) for q in self.running.values())
+
+    def progress(self, started: float) -> str:
+        """One-line status: finished/estimated total nodes and a rough ETA."""
+        done, running = len(self.finished), self.n_running
+        total = done + running + self.ready
+        line = f"Progress: {done}/{total} nipype nodes finished, {running} running"
+        if done and total > done:
+            # Remaining nodes at the pace seen so far
+            rate = done / max(time.time() - started, 1)
+            line += f", ETA ~{(total - done) / rate / 60:.0f} min (estimated)"
+        return line
+
+    def summary(self) -> Dict:
+        """Aggregate the timings per node and per participant."""
+        per_node = defaultdict(list)
+        per_participant = defaultdict(list)
+        for row in self.finished:
+            per_node[row["node"]].append(row["elapsed"])
+            per_participant[row["participant"] or "n/a"].append(row)
+        nodes = [
+            {
+                "node": node,
+                "count": len(elapsed),
+                "total": round(sum(elapsed), 2),
+                "mean": round(sum(elapsed) / len(elapsed), 2),
+                "max": round(max(elapsed), 2),
+            }
+            for node, elapsed in per_node.items()
+        ]
+        participants = {}
+        for participant, rows in per_participant.items():
+            starts = [r["start"] for r in rows if r["start"]]
+            participants[participant] = {
+                "nodes": len(rows),
+                "node_seconds": round(sum(r["elapsed"] for r in rows), 2),
+                "wall_seconds": round(max(r["finish"] for r in rows) - min(starts), 2) if starts else None,
+            }
+        return {
+            "nodes": sorted(nodes, key=lambda n: n["total"], reverse=True),
+            "participants": participants,
+            "unfinished": sorted(n for n, q in self.running.items() if q),
+        }
+
+
+def write_timing_report(timer: NodeTimer, output_dir: Union[Path, str], prefix: str) -> Dict:
+    """Write <prefix>_node_timing.json (nodes and participants) and .tsv (per-node)."""
+    summary = timer.summary()
+    stem = Path(output_dir) / f"{prefix}_node_timing"
+    with open(f"{stem}.json", "w") as fp:
+        json.dump(summary, fp, indent=2)
+    with open(f"{stem}.tsv", "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=["node", "count", "total", "mean", "max"], delimiter="\t")
+        writer.writeheader()
+        writer.writerows(summary["nodes"])
+    if summary["nodes"]:
+        slowest = "\n  ".join(f"{n['node']}: {n['total']}s over {n['count']} run(s)" for n in summary["nodes"][:5])
+        log.info(f"Slowest nipype nodes:\n  {slowest}")
+    return summary
+
+
+def run_with_log_monitor(
+    command: List[str],
+    output_dir: Union[Path, str],
+    log_prefix: str,
+    environ: Optional[Dict] = None,
+    echo: bool = True,
+) -> int:
+    """Run the BIDS App, processing its output as it is produced.
+
+    Every line goes to a compressed log (<prefix>_log.txt.zst, or .gz without
+    zstandard); nipype node lines feed the timing report and a progress line
+    that is logged every minute. Only the last lines are kept in memory,
+    to show when the command fails.
+
+    Args:
+        command (List): BIDS App command
+        output_dir (Path): where the log and the timing report go
+        log_prefix (str): file name prefix, e.g. "mriqc"
+        environ (Dict, optional): environment for the command
+        echo (bool): also print every line to the job log
+
+    Returns:
+        returncode (int): 0 on success
+
+    Raises:
+        RuntimeError: If the command fails, as with `exec_command`
+    """
+    log.info("Executing command: \n %s \n\n", " ".join(command))
+    timer = NodeTimer()
+    tail = deque(maxlen=TAIL_LINES)
+    started = last_progress = time.time()
+    log_stem = Path(output_dir) / f"{log_prefix}_log.txt"
+
+    with open_compressed_log(log_stem) as full_log:
+        # Undecodable bytes (e.g., from a tool's binary output) must not end the stream
+        proc = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            bufsize=1,
+            env=environ,
+        )
+        finished = False
+        try:
+            for line in proc.stdout:
+                full_log.write(line)
+                tail.append(line)
+                timer.feed(line)
+                if echo:
+                    # Verbatim: nipype's lines already carry their own time stamps and levels
+                    sys.stdout.write(line)
+                if time.time() - last_progress >= PROGRESS_SECONDS:
+                    last_progress = time.time()
+                    log.info(timer.progress(started))
+            finished = True
+        finally:
+            if not finished:
+                # e.g., the log disk is full or the gear is interrupted: do not leave MRIQC
+                # running, blocked on a pipe that nobody reads
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+        returncode = proc.wait()
+
+    log.info(timer.progress(started))
+    write_timing_report(timer, output_dir, log_prefix)
+    log.info("Command return code: %s", returncode)
+    if returncode != 0:
+        log.error("Last lines of the output:\n" + "".join(tail))
+        raise RuntimeError("The following command has failed: \n{}".format(command))
+    return returncode
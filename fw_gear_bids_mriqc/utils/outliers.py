@@ -0,0 +1,161 @@
+"""Robust z-scores and outlier flags for every IQM of every scan, in one vectorized pass."""
+
+import json
+import logging
+import math
+import time
+from collections import defaultdict
+from itertools import chain, repeat
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from fw_gear_bids_mriqc.utils.iqm_store import IqmStore, iter_store_records
+
+log = logging.getLogger(__name__)
+
+# Modified z-score cut-off (Iglewicz and Hoaglin)
+DEFAULT_THRESHOLD = 3.5
+# Image geometry, not quality
+NOT_SCORED = ("size_", "spacing_")
+# MAD and mean absolute deviation to standard deviation, for normal data
+MAD_SCALE = 1.4826
+MEANAD_SCALE = 1.2533
+
+
+def robust_z_scores(matrix: "np.ndarray") -> "np.ndarray":
+    """Modified z-scores of each column (metric) of a scans x metrics matrix.
+
+    z = (x - median) / (1.4826 * MAD). Columns whose MAD is 0 (more than half
+    the scans share a value) use 1.2533 * the mean absolute deviation instead;
+    constant columns score 0. Missing values (NaN) are ignored and stay NaN.
+
+    Args:
+        matrix (np.ndarray): float64, one row per scan, one column per metric
+
+    Returns:
+        z (np.ndarray): same shape as matrix
+    """
+    # Metrics as contiguous rows, so the medians read memory in order; the copy is worked on in place.
+    # (ascontiguousarray would not copy a single row or column, and the caller's matrix would change.)
+    centered = np.array(matrix.T, order="C")
+    missing = np.isnan(centered).any()
+    median = np.nanmedian if missing else np.median
+    centered -= median(centered, axis=1, keepdims=True)
+    deviation = np.abs(centered)
+    scale = MAD_SCALE * median(deviation, axis=1, keepdims=True, overwrite_input=True)
+    zero = scale[:, 0] == 0
+    if zero.any():
+        mean = np.nanmean if missing else np.mean
+        scale[zero] = MEANAD_SCALE * mean(np.abs(centered[zero]), axis=1, keepdims=True)
+    # Constant metrics: nothing is an outlier (0 / inf = 0; NaN stays NaN)
+    scale[scale == 0] = np.inf
+    centered /= scale
+    return centered.T
+
+
+def build_matrix(records: List[Dict]) -> Tuple[List[str], "np.ndarray"]:
+    """Dense scans x metrics matrix of the numeric IQMs (NaN where missing).
+
+    Args:
+        records (List[Dict]): flat IQMs of the scans of one modality
+
+    Returns:
+        metrics (List[str]): column names
+        matrix (np.ndarray): float64, one row per record
+    """
+    names = set().union(*records)
+    metrics = sorted(k for k in names if not k.startswith(NOT_SCORED) and _is_number(_first(records, k)))
+    nan = math.nan
+    try:
+        values = np.fromiter(
+            chain.from_iterable(map(record.get, metrics, repeat(nan)) for record in records),
+            np.float64,
+            count=len(records) * len(metrics),
+        )
+    except (TypeError, ValueError):
+        # Some scan has a null or text value for a metric: fill cell by cell
+        values = np.array(
+            [[v if _is_number(v) else nan for v in map(record.get, metrics)] for record in records], np.float64
+        )
+    matrix = values.reshape(len(records), len(metrics))
+    return metrics, matrix
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _first(records: List[Dict], key: str):
+    return next(record[key] for record in records if key in record)
+
+
+def _store_population(store_path: Path, modality: str, versions: Set[str], exclude: Set[str]) -> List[Dict]:
+    """Flat IQMs of the project's other scans in the IQM store, for the same MRIQC versions."""
+    with IqmStore(store_path) as store:
+        return [
+            json.loads(scan["iqms"])
+            for scan in store.latest_scans(modality)
+            if scan["mriqc_version"] in versions and scan["bids_name"] not in exclude
+        ]
+
+
+def score_outliers(
+    json_files: Iterable[Union[Path, str]],
+    threshold: float = DEFAULT_THRESHOLD,
+    loaded: Optional[Dict[Path, Dict]] = None,
+    store_path: Optional[Union[Path, str]] = None,
+) -> Dict[str, Dict]:
+    """Flag the IQMs of this run's scans that are outliers within their modality.
+
+    The population is this run's scans plus, when `store_path` exists, the
+    project's other scans in the IQM store with the same MRIQC version.
+
+    Args:
+        json_files (Iterable): MRIQC per-scan JSON outputs of this run
+        threshold (float): |modified z| above which an IQM is flagged
+        loaded (Dict, optional): IQMs already read, by file
+        store_path (Path, optional): mriqc_iqm_store.sqlite
+
+    Returns:
+        outliers (Dict): bids_name -> {"threshold", "population", "flagged": {IQM: z}}
+            for every scan of the run ("flagged" is empty if nothing stands out)
+    """
+    if np is None:
+        log.info("numpy is not installed; skipping the IQM outlier flags.")
+        return {}
+    start = time.perf_counter()
+    by_modality = defaultdict(list)
+    for record in iter_store_records(json_files, loaded):
+        by_modality[record["modality"]].append(record)
+
+    outliers = {}
+    for modality, records in sorted(by_modality.items()):
+        population = [r["iqms"] for r in records]
+        if store_path and Path(store_path).exists():
+            versions = {r["mriqc_version"] for r in records}
+            population.extend(
+                _store_population(Path(store_path), modality, versions, {r["bids_name"] for r in records})
+            )
+        metrics, matrix = build_matrix(population)
+        if not metrics:
+            continue
+        # This run's scans are the first rows
+        z = robust_z_scores(matrix)[: len(records)]
+        flagged = np.abs(np.nan_to_num(z)) > threshold
+        for row, record in enumerate(records):
+            outliers[record["bids_name"]] = {
+                "threshold": threshold,
+                "population": len(population),
+                "flagged": {metrics[c]: round(float(z[row, c]), 2) for c in np.flatnonzero(flagged[row])},
+            }
+        log.info(
+            f"{modality}: {int(flagged.any(axis=1).sum())} of {len(records)} scans have outlying IQMs "
+            f"(population {len(population)} x {len(metrics)} IQMs)"
+        )
+    log.debug(f"Scored IQM outliers in {time.perf_counter() - start:.2f}s")
+    return outliers
@@ -0,0 +1,571 @@
+"""Zip the gear output in parallel, storing files that are already compressed as they are."""
+
+import logging
+import os
+import shutil
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+from flywheel_bids.flywheel_bids_app_toolkit.compression import zip_htmls
+from flywheel_bids.flywheel_bids_app_toolkit.report import report_errors
+
+from fw_gear_bids_mriqc.utils.resources import gear_resources
+from fw_gear_bids_mriqc.utils.retention import Match, RetentionRules, write_retention_listing
+
+log = logging.getLogger(__name__)
+
+# Recompressing these costs CPU time and gains (almost) nothing
+STORED_SUFFIXES = {
+    ".gz", ".tgz", ".zip", ".bz2", ".xz", ".zst", ".7z",
+    ".png", ".jpg", ".jpeg", ".gif", ".mp4", ".webm",
+    ".mgz", ".npz", ".pklz", ".svgz",
+}  # fmt: skip
+COMPRESS_LEVEL = 6
+# Members up to this size are built in memory by the workers; larger ones are
+# streamed from disk by the writer
+IN_MEMORY_BYTES = 16 * 1024**2
+MAX_INFLIGHT_BYTES = 256 * 1024**2
+CHUNK_BYTES = 1024**2
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP_COUNT_LIMIT = 0xFFFF
+ZIP_STORED, ZIP_DEFLATED = 0, 8
+FLAG_DATA_DESCRIPTOR, FLAG_UTF8 = 0x08, 0x800
+VERSION_ZIP64 = 45
+MADE_BY_UNIX = 3 << 8
+
+
+@dataclass
+class PackStats:
+    """Size and throughput of one packaging phase (usually one archive)."""
+
+    phase: str
+    files: int = 0
+    stored: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    wall_time: float = 0.0
+
+    def summary(self) -> Dict:
+        mb_in = self.bytes_in / 1024**2
+        return {
+            "phase": self.phase,
+            "files": self.files,
+            "stored": self.stored,
+            "mb_in": round(mb_in, 1),
+            "mb_out": round(self.bytes_out / 1024**2, 1),
+            "wall_time": round(self.wall_time, 2),
+            "mb_per_s": round(mb_in / self.wall_time, 1) if self.wall_time else 0.0,
+        }
+
+
+@dataclass
+class _Member:
+    path: str
+    arcname: str
+    size: int
+    mtime: float
+    mode: int
+    is_dir: bool = False
+
+
+def _dos_datetime(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(max(mtime, 315532800))  # zip cannot express dates before 1980
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return dos_time, ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _should_store(name: str) -> bool:
+    return any(name.lower().endswith(suffix) for suffix in STORED_SUFFIXES)
+
+
+def iter_members(root_dir: Union[Path, str], source_dir: str, exclude_files: Optional[List[str]] = None) -> Iterator:
+    """Walk <root_dir>/<source_dir> like `zip_output`: directories and files, named relative to root_dir."""
+    exclude = set(exclude_files or [])
+    top = os.path.join(str(root_dir), source_dir)
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        rel = os.path.relpath(dirpath, str(root_dir))
+        for name in dirnames:
+            stat = os.stat(os.path.join(dirpath, name))
+            yield _Member(os.path.join(dirpath, name), f"{rel}/{name}/", 0, stat.st_mtime, stat.st_mode, True)
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if path in exclude:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                log.warning(f"Skipping {path}: unreadable or a broken link")
+                continue
+            yield _Member(path, f"{rel}/{name}", stat.st_size, stat.st_mtime, stat.st_mode)
+
+
+def _build_member(member: _Member) -> Tuple[int, int, bytes]:
+    """Read (and deflate) a small member in a worker; zlib releases the GIL.
+
+    Returns:
+        method, crc, data: the compressed data, or the file itself if deflating does not help
+    """
+    with open(member.path, "rb") as fp:
+        raw = fp.read()
+    crc = zlib.crc32(raw)
+    if not _should_store(member.arcname):
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+        data = compressor.compress(raw) + compressor.flush()
+        if len(data) < len(raw):
+            return ZIP_DEFLATED, crc, data
+    return ZIP_STORED, crc, raw
+
+
+class StreamingZipWriter:
+    """Minimal ZIP writer that writes members straight to the output stream.
+
+    Members can be handed over already compressed (from the worker pool) or be
+    streamed from disk with a data descriptor, so nothing is staged in a temp
+    file. ZIP64 records are added where sizes, offsets, or counts need them.
+    """
+
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+        self.offset = 0
+        self.central: List[bytes] = []
+
+    def _write(self, data: bytes) -> None:
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def _local_header(self, member: _Member, method: int, flags: int, crc: int, sizes: Tuple[int, int], zip64: bool):
+        name = member.arcname.encode("utf-8")
+        dos_time, dos_date = _dos_datetime(member.mtime)
+        extra = b""
+        size_fields = sizes
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, sizes[1], sizes[0])
+            size_fields = (ZIP32_LIMIT, ZIP32_LIMIT)
+        header = struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            VERSION_ZIP64 if zip64 else 20,
+            flags | FLAG_UTF8,
+            method,
+            dos_time,
+            dos_date,
+            crc,
+            size_fields[0],
+            size_fields[1],
+            len(name),
+            len(extra),
+        )
+        self._write(header + name + extra)
+
+    def _central_record(self, member: _Member, method: int, flags: int, crc: int, sizes: Tuple[int, int], offset: int):
+        compressed, uncompressed = sizes
+        name = member.arcname.encode("utf-8")
+        dos_time, dos_date = _dos_datetime(member.mtime)
+        zip64_fields = []
+        if uncompressed >= ZIP32_LIMIT:
+            zip64_fields.append(uncompressed)
+            uncompressed = ZIP32_LIMIT
+        if compressed >= ZIP32_LIMIT:
+            zip64_fields.append(compressed)
+            compressed = ZIP32_LIMIT
+        if offset >= ZIP32_LIMIT:
+            zip64_fields.append(offset)
+            offset = ZIP32_LIMIT
+        extra = b""
+        if zip64_fields:
+            extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields)
+        external = ((member.mode & 0xFFFF) << 16) | (0x10 if member.is_dir else 0)
+        record = struct.pack(
+            "<IHHHHHHIIIHHHHHII",
+            0x02014B50,
+            MADE_BY_UNIX | VERSION_ZIP64,
+            VERSION_ZIP64 if zip64_fields else 20,
+            flags | FLAG_UTF8,
+            method,
+            dos_time,
+            dos_date,
+            crc,
+            compressed,
+            uncompressed,
+            len(name),
+            len(extra),
+            0,
+            0,
+            0,
+            external,
+            offset,
+        )
+        self.central.append(record + name + extra)
+
+    def add_bytes(self, member: _Member, method: int, crc: int, data: bytes) -> int:
+        """Add a member whose (compressed) data is already in memory."""
+        offset = self.offset
+        sizes = (len(data), member.size)
+        zip64 = max(sizes) >= ZIP32_LIMIT
+        self._local_header(member, method, 0, crc, sizes, zip64)
+        self._write(data)
+        self._central_record(member, method, 0, crc, sizes, offset)
+        return len(data)
+
+    def add_file(self, member: _Member) -> int:
+        """Stream a large member from disk, with the CRC and sizes in a trailing data descriptor."""
+        offset = self.offset
+        method = ZIP_STORED if _should_store(member.arcname) else ZIP_DEFLATED
+        # Deflate can grow incompressible data slightly; leave room when deciding on ZIP64
+        zip64 = member.size * 1.01 + 1024 >= ZIP32_LIMIT
+        self._local_header(member, method, FLAG_DATA_DESCRIPTOR, 0, (0, 0), zip64)
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15) if method == ZIP_DEFLATED else None
+        crc, size, start = 0, 0, self.offset
+        with open(member.path, "rb") as fp:
+            while True:
+                chunk = fp.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                self._write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            self._write(compressor.flush())
+        compressed = self.offset - start
+        if zip64:
+            self._write(struct.pack("<IIQQ", 0x08074B50, crc, compressed, size))
+        else:
+            self._write(struct.pack("<IIII", 0x08074B50, crc, compressed, size))
+        member.size = size
+        self._central_record(member, method, FLAG_DATA_DESCRIPTOR, crc, (compressed, size), offset)
+        return compressed
+
+    def close(self) -> None:
+        """Write the central directory and the end records."""
+        cd_offset = self.offset
+        for record in self.central:
+            self._write(record)
+        cd_size, count = self.offset - cd_offset, len(self.central)
+        if count >= ZIP_COUNT_LIMIT or cd_size >= ZIP32_LIMIT or cd_offset >= ZIP32_LIMIT:
+            eocd64_offset = self.offset
+            self._write(
+                struct.pack(
+                    "<IQHHIIQQQQ", 0x06064B50, 44, MADE_BY_UNIX | VERSION_ZIP64, VERSION_ZIP64,
+                    0, 0, count, count, cd_size, cd_offset,
+                )
+            )  # fmt: skip
+            self._write(struct.pack("<IIQI", 0x07064B50, 0, eocd64_offset, 1))
+        self._write(
+            struct.pack(
+                "<IHHHHIIH", 0x06054B50, 0, 0,
+                min(count, ZIP_COUNT_LIMIT), min(count, ZIP_COUNT_LIMIT),
+                min(cd_size, ZIP32_LIMIT), min(cd_offset, ZIP32_LIMIT), 0,
+            )
+        )  # fmt: skip
+
+
+def write_zip(
+    members: Iterable[_Member], output_zip_filename: Union[Path, str], workers: int = 4, phase: Optional[str] = None
+) -> PackStats:
+    """Write members to a zip file as they come.
+
+    Workers read and deflate the small members; the writer appends each finished
+    member, in order, straight to the output file. Large files are streamed in
+    chunks by the writer. Files that are already compressed are stored.
+
+    Args:
+        members (Iterable): files and directories, e.g., from `iter_members`
+        output_zip_filename (Path): full path of the output zip file
+        workers (int): number of threads building members
+        phase (str, optional): name for the throughput report; defaults to the zip name
+
+    Returns:
+        stats (PackStats): sizes and timing of the archive
+    """
+    stats = PackStats(phase or Path(output_zip_filename).name)
+    log.info("Zipping output file %s", output_zip_filename)
+    start = time.perf_counter()
+    pending = deque()
+    inflight = 0
+
+    def write_next() -> None:
+        nonlocal inflight
+        member, future = pending.popleft()
+        method, crc, data = future.result()
+        stats.bytes_out += writer.add_bytes(member, method, crc, data)
+        stats.stored += method == ZIP_STORED
+        inflight -= member.size
+
+    try:
+        with open(output_zip_filename, "wb") as fp, ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+            writer = StreamingZipWriter(fp)
+            for member in members:
+                stats.files += not member.is_dir
+                stats.bytes_in += member.size
+                if member.is_dir:
+                    writer.add_bytes(member, ZIP_STORED, 0, b"")
+                elif member.size > IN_MEMORY_BYTES:
+                    # Keep the archive in walk order
+                    while pending:
+                        write_next()
+                    stats.bytes_out += writer.add_file(member)
+                    stats.stored += _should_store(member.arcname)
+                else:
+                    while pending and (inflight + member.size > MAX_INFLIGHT_BYTES or len(pending) >= 4 * workers):
+                        write_next()
+                    pending.append((member, pool.submit(_build_member, member)))
+                    inflight += member.size
+            while pending:
+                write_next()
+            writer.close()
+    except BaseException:
+        # Never leave a truncated archive behind for upload
+        Path(output_zip_filename).unlink(missing_ok=True)
+        raise
+    stats.wall_time = time.perf_counter() - start
+    summary = stats.summary()
+    log.info(
+        f"{summary['phase']}: {summary['files']} files ({summary['stored']} stored), "
+        f"{summary['mb_in']} MB -> {summary['mb_out']} MB in {summary['wall_time']}s ({summary['mb_per_s']} MB/s)"
+    )
+    return stats
+
+
+def zip_tree(
+    root_dir: Union[Path, str],
+    source_dir: str,
+    output_zip_filename: Union[Path, str],
+    exclude_files: Optional[List[str]] = None,
+    workers: int = 4,
+    phase: Optional[str] = None,
+) -> PackStats:
+    """Parallel stand-in for `zip_output`, with the same arguments and archive layout.
+
+    Args:
+        root_dir (Path): root directory to zip relative to
+        source_dir (str): subdirectory (of root_dir) to zip
+        output_zip_filename (Path): full path of the output zip file
+        exclude_files (List, optional): full paths to leave out
+        workers (int): number of threads building members
+        phase (str, optional): name for the throughput report; defaults to the zip name
+
+    Returns:
+        stats (PackStats): sizes and timing of the archive
+    """
+    if not os.path.exists(root_dir):
+        raise FileNotFoundError(f"The directory, {root_dir}, does not exist.")
+    return write_zip(iter_members(root_dir, source_dir, exclude_files), output_zip_filename, workers, phase)
+
+
+def zip_paths(
+    root_dir: Union[Path, str],
+    paths: Iterable[Union[Path, str]],
+    output_zip_filename: Union[Path, str],
+    workers: int = 4,
+    phase: Optional[str] = None,
+) -> PackStats:
+    """Zip some files and directories under root_dir, named relative to it.
+
+    Args:
+        root_dir (Path): root directory to zip relative to
+        paths (Iterable): files and directories under root_dir
+        output_zip_filename (Path): full path of the output zip file
+        workers (int): number of threads building members
+        phase (str, optional): name for the throughput report; defaults to the zip name
+
+    Returns:
+        stats (PackStats): sizes and timing of the archive
+    """
+
+    def members() -> Iterator[_Member]:
+        for path in paths:
+            rel = os.path.relpath(str(path), str(root_dir))
+            if os.path.isdir(path):
+                yield from iter_members(root_dir, rel)
+            else:
+                stat = os.stat(path)
+                yield _Member(str(path), rel, stat.st_size, stat.st_mtime, stat.st_mode)
+
+    return write_zip(members(), output_zip_filename, workers, phase)
+
+
+def _retained_members(work_dir: Path, matches: Iterable[Match]) -> Iterator[_Member]:
+    """Archive members for the retained files, named work/<relative path> as before."""
+    for path, rel, size, _ in matches:
+        stat = os.stat(path)
+        yield _Member(path, f"{work_dir.name}/{rel}", size, stat.st_mtime, stat.st_mode)
+
+
+def save_retained_work_files(
+    app_context: BIDSAppContext,
+    output_dir: Path,
+    name_prefix: str,
+    suffix: str,
+    workers: int = 4,
+    dry_run: bool = False,
+) -> List[PackStats]:
+    """Archive the work files and folders matching gear-intermediate-files/-folders.
+
+    The matches are found in one pruned walk of the work dir. As with the
+    toolkit's `package_output`, the files go to <prefix>_selected_files_<suffix>.zip
+    and each folder to its own <prefix>_<folder name>_<suffix>.zip. With
+    dry_run, only a listing (<prefix>_selected_files_<suffix>.tsv) with the
+    sizes is written.
+
+    Args:
+        app_context (BIDSAppContext): Details about the gear setup and BIDS options
+        output_dir (Path): where the archives go
+        name_prefix (str): start of the archive names, e.g., "bids-mriqc_work"
+        suffix (str): end of the archive names, "<run label>_<destination id>"
+        workers (int): number of threads building members
+        dry_run (bool): list what would be kept, instead of archiving it
+
+    Returns:
+        phases (List[PackStats]): one per archive; empty for a dry run
+    """
+    work_dir = Path(app_context.work_dir)
+    matches = list(RetentionRules.from_app_context(app_context).walk(work_dir))
+    files_zip = output_dir / f"{name_prefix}_selected_files_{suffix}.zip"
+    if dry_run:
+        write_retention_listing(matches, files_zip.with_suffix(".tsv"))
+        return []
+
+    phases = []
+    files = [match for match in matches if not match[3]]
+    if files:
+        phases.append(write_zip(_retained_members(work_dir, files), files_zip, workers, phase="retained work files"))
+    used = set()
+    for path, rel, _, is_folder in matches:
+        if not is_folder:
+            continue
+        name = Path(path).name
+        # Folders with the same name used to overwrite each other's archive
+        label, n = name, 1
+        while label in used:
+            n += 1
+            label = f"{name}-{n}"
+        used.add(label)
+        phases.append(
+            zip_tree(
+                Path(path).parent,
+                name,
+                output_dir / f"{name_prefix}_{label}_{suffix}.zip",
+                workers=workers,
+                phase=f"retained folder {rel}",
+            )
+        )
+    return phases
+
+
+def log_pack_stats(phases: List[PackStats]) -> None:
+    """One line per packaging phase, plus the total."""
+    if not phases:
+        return
+    total = PackStats("total")
+    lines = []
+    for stats in phases + [total]:
+        if stats is not total:
+            total.files += stats.files
+            total.stored += stats.stored
+            total.bytes_in += stats.bytes_in
+            total.bytes_out += stats.bytes_out
+            total.wall_time += stats.wall_time
+        s = stats.summary()
+        lines.append(f"{s['phase']}: {s['mb_in']} MB in {s['wall_time']}s ({s['mb_per_s']} MB/s)")
+    log.info("Packaging throughput:\n  " + "\n  ".join(lines))
+
+
+def package_output(
+    app_context: BIDSAppContext, gear_name: str, errors: List[str], config: Optional[Dict] = None
+) -> List[PackStats]:
+    """Move all the results to the final destination; clean-up.
+
+    Same archives as the toolkit's `package_output`, built with `zip_tree`.
+
+    Args:
+        app_context (BIDSAppContext): Details about the gear setup and BIDS options
+        gear_name (str): gear name, used in the output file names
+        errors (List[str]): list of errors found
+        config (Dict, optional): gear config, to size the worker pool to the job
+
+    Returns:
+        phases (List[PackStats]): throughput of each archive
+    """
+    workers = int(gear_resources(config or {})["cpus"])
+    output_dir = Path(app_context.output_dir)
+    suffix = f"{app_context.run_label}_{app_context.destination_id}"
+    phases = []
+
+    # zip htmls first, so there are fewer issues updating the image file paths
+    if not app_context.gear_dry_run:
+        start = time.perf_counter()
+        html_dir = Path(app_context.analysis_output_dir) / app_context.bids_app_binary
+        if html_dir.exists():
+            zip_htmls(str(output_dir), app_context.destination_id, html_dir)
+        elif app_context.post_processing_only:
+            zip_htmls(output_dir, app_context.destination_id, app_context.bids_dir)
+        # Catch all other htmls in the destination dir
+        zip_htmls(str(output_dir), app_context.destination_id, app_context.analysis_output_dir)
+        log.info(f"html reports: {time.perf_counter() - start:.2f}s")
+
+    # zip entire output/<analysis_id> folder into
+    #  <gear_name>_<project|subject|session label>_<analysis.id>.zip
+    phases.append(
+        zip_tree(output_dir, app_context.destination_id, output_dir / f"{gear_name}_{suffix}.zip", workers=workers)
+    )
+
+    # As zip_derivatives
+    binary = app_context.bids_app_binary
+    derivative_dir = Path(app_context.analysis_output_dir) / binary
+    if derivative_dir.exists():
+        phases.append(
+            zip_tree(
+                app_context.analysis_output_dir,
+                binary,
+                output_dir / f"{binary}_{app_context.destination_id}_{binary}.zip",
+                workers=workers,
+            )
+        )
+        zip_htmls(output_dir, app_context.destination_id, derivative_dir)
+
+    work_dir = Path(app_context.work_dir)
+    # possibly save ALL intermediate output
+    if app_context.save_intermediate_output:
+        phases.append(
+            zip_tree(work_dir.parent, work_dir.name, output_dir / f"{gear_name}_work_{suffix}.zip", workers=workers)
+        )
+
+    # possibly save intermediate files and folders
+    if RetentionRules.from_app_context(app_context):
+        phases.extend(
+            save_retained_work_files(
+                app_context,
+                output_dir,
+                f"{gear_name}_work",
+                suffix,
+                workers=workers,
+                dry_run=bool((config or {}).get("gear-intermediate-dry-run")),
+            )
+        )
+
+    log_pack_stats(phases)
+
+    # clean up: remove output that was zipped
+    if Path(app_context.analysis_output_dir).exists():
+        if app_context.keep_output:
+            log.info('NOT removing output directory "%s"', str(app_context.analysis_output_dir))
+        else:
+            log.debug('removing output directory "%s"', str(app_context.analysis_output_dir))
+            shutil.rmtree(app_context.analysis_output_dir)
+    else:
+        log.info("Output directory does not exist so it cannot be removed")
+
+    # Report errors at the end of the log, so they can be easily seen.
+    if len(errors) > 0:
+        log.info(report_errors(errors))
+
+    return phases
@@ -0,0 +1,230 @@
+"""Work out the CPUs and memory that the gear may use on this node."""
+
+import logging
+import math
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from fw_gear_bids_mriqc.utils.command_options import has_option, pop_option
+
+log = logging.getLogger(__name__)
+
+_MEM_UNITS = {"K": 1 / 1024**2, "M": 1 / 1024, "G": 1, "T": 1024}
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+# cgroup v1 reports "no limit" as a huge number (close to 2**63)
+UNLIMITED_BYTES = 2**60
+MAX_OMP_THREADS = 8
+MEM_FRACTION = 0.9
+# Every spelling MRIQC accepts for its resource options
+NPROCS_OPTIONS = ["--nprocs", "--n_procs", "--n_cpus"]
+OMP_OPTIONS = ["--omp-nthreads", "--ants-nthreads"]
+MEM_OPTIONS = ["--mem", "--mem_gb", "--mem-gb"]
+
+
+def parse_mem_gb(value: Union[str, int, float, None]) -> Optional[float]:
+    """Convert a Slurm-style memory string into GiB.
+
+    e.g., "4G" -> 4.0, "512M" -> 0.5, "2048" (Slurm default unit, MB) -> 2.0
+
+    Args:
+        value (str, int, float): memory amount
+
+    Returns:
+        mem_gb (float): memory in GiB, or None if the value cannot be parsed
+    """
+    if value is None or value == "":
+        return None
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT])?B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        log.warning(f"Unable to parse memory value {value}")
+        return None
+    unit = (match.group(2) or "M").upper()
+    return float(match.group(1)) * _MEM_UNITS[unit]
+
+
+def available_cpus() -> int:
+    """CPUs this process is allowed to run on (honors taskset/cpusets)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        return os.cpu_count() or 1
+
+
+def available_mem_gb() -> Optional[float]:
+    """Memory currently available on the node, from /proc/meminfo."""
+    try:
+        with open("/proc/meminfo") as fp:
+            for line in fp:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    return None
+
+
+def _read_first_line(path: Path) -> Optional[str]:
+    try:
+        with open(path) as fp:
+            return fp.readline().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_dirs(controller: str) -> List[Path]:
+    """Where this process's cgroup files may live, most specific first (v2, then v1)."""
+    dirs = []
+    try:
+        with open("/proc/self/cgroup") as fp:
+            lines = fp.read().splitlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        hierarchy, _, rest = line.partition(":")
+        controllers, _, cg_path = rest.partition(":")
+        if controllers == "" and hierarchy == "0":
+            dirs.append(CGROUP_ROOT / cg_path.lstrip("/"))
+        elif controller in controllers.split(","):
+            dirs.append(CGROUP_ROOT / controllers / cg_path.lstrip("/"))
+    # Inside a container the cgroup is usually mounted at the root
+    dirs.extend([CGROUP_ROOT, CGROUP_ROOT / controller])
+    return dirs
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """CPU quota of the cgroup (e.g., docker --cpus), in CPUs; None if unlimited."""
+    for cg_dir in _cgroup_dirs("cpu"):
+        cpu_max = _read_first_line(cg_dir / "cpu.max")
+        if cpu_max:
+            quota, _, period = cpu_max.partition(" ")
+            if quota == "max":
+                return None
+            return int(quota) / int(period or 100000)
+        quota = _read_first_line(cg_dir / "cpu.cfs_quota_us")
+        if quota:
+            if int(quota) < 0:
+                return None
+            return int(quota) / int(_read_first_line(cg_dir / "cpu.cfs_period_us") or 100000)
+    return None
+
+
+def cgroup_mem_limit_gb() -> Optional[float]:
+    """Memory limit of the cgroup, in GiB; None if unlimited."""
+    for cg_dir in _cgroup_dirs("memory"):
+        for name in ["memory.max", "memory.limit_in_bytes"]:
+            limit = _read_first_line(cg_dir / name)
+            if not limit:
+                continue
+            if limit == "max" or int(limit) >= UNLIMITED_BYTES:
+                return None
+            return int(limit) / 1024**3
+    return None
+
+
+def slurm_env_limits() -> Dict[str, float]:
+    """CPUs and memory of the Slurm allocation, from the job's environment."""
+    limits = {}
+    cpus = os.environ.get("SLURM_CPUS_PER_TASK") or os.environ.get("SLURM_CPUS_ON_NODE")
+    if cpus and cpus.isdigit():
+        limits["cpus"] = int(cpus)
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        limits["mem_gb"] = parse_mem_gb(os.environ["SLURM_MEM_PER_NODE"])
+    elif os.environ.get("SLURM_MEM_PER_CPU") and "cpus" in limits:
+        limits["mem_gb"] = parse_mem_gb(os.environ["SLURM_MEM_PER_CPU"]) * limits["cpus"]
+    return {k: v for k, v in limits.items() if v}
+
+
+def gear_resources(config: Dict) -> Dict[str, float]:
+    """CPUs and memory available to the gear run.
+
+    The smallest of each limit wins: CPU affinity and available memory on the
+    node, the cgroup CPU quota and memory limit (docker, Singularity with
+    cgroups, Slurm's task/cgroup plugin), the Slurm allocation from the job's
+    environment, and, on Slurm, the `slurm-cpu` and `slurm-ram` (per-CPU)
+    config values.
+
+    Args:
+        config (Dict): gear config
+
+    Returns:
+        resources (Dict): "cpus" and "mem_gb", plus "limited_by" (where each came from)
+    """
+    cpus = {"affinity": available_cpus()}
+    mem_gb = {"meminfo": available_mem_gb()}
+
+    cg_cpus = cgroup_cpu_limit()
+    if cg_cpus:
+        cpus["cgroup"] = max(1, math.floor(cg_cpus))
+    mem_gb["cgroup"] = cgroup_mem_limit_gb()
+
+    slurm = slurm_env_limits()
+    cpus["slurm"] = slurm.get("cpus")
+    mem_gb["slurm"] = slurm.get("mem_gb")
+
+    if os.environ.get("SLURM_JOB_ID"):
+        try:
+            cpus["slurm-cpu"] = int(config.get("slurm-cpu") or 0) or None
+        except ValueError:
+            log.warning(f"Ignoring slurm-cpu={config.get('slurm-cpu')}")
+    cpus = {k: v for k, v in cpus.items() if v}
+    n_cpus = min(cpus.values())
+
+    mem_per_cpu = parse_mem_gb(config.get("slurm-ram")) if os.environ.get("SLURM_JOB_ID") else None
+    if mem_per_cpu:
+        mem_gb["slurm-ram"] = mem_per_cpu * n_cpus
+    mem_gb = {k: v for k, v in mem_gb.items() if v}
+    total_mem = min(mem_gb.values()) if mem_gb else 4.0 * n_cpus
+
+    return {
+        "cpus": n_cpus,
+        "mem_gb": total_mem,
+        "limited_by": {
+            "cpus": min(cpus, key=cpus.get),
+            "mem_gb": min(mem_gb, key=mem_gb.get) if mem_gb else "default",
+        },
+    }
+
+
+def omp_threads_for(nprocs: int) -> int:
+    """Threads per process: leave one CPU for the nipype scheduler, at most 8."""
+    return max(1, min(nprocs - 1, MAX_OMP_THREADS))
+
+
+def with_resource_options(command: List[str], config: Dict) -> List[str]:
+    """Add --nprocs, --omp-nthreads, and --mem_gb sized to this job's allocation.
+
+    Options that the user already set are kept as they are. Memory is capped
+    at 90% of the allocation, to leave room for the gear and page cache.
+
+    Args:
+        command (List): BIDS App command
+        config (Dict): gear config (`gear-auto-resources` turns this on or off)
+
+    Returns:
+        command (List): command with the resource options
+    """
+    if config.get("gear-auto-resources") is False:
+        return command
+    resources = gear_resources(config)
+    # Threads per process follow the user's --nprocs, if given
+    _, user_nprocs = pop_option(command, NPROCS_OPTIONS)
+    nprocs = int(user_nprocs[0]) if user_nprocs and user_nprocs[0].isdigit() else resources["cpus"]
+    plan = {
+        "--nprocs": resources["cpus"],
+        "--omp-nthreads": omp_threads_for(nprocs),
+        "--mem_gb": max(1, math.floor(MEM_FRACTION * resources["mem_gb"])),
+    }
+    spellings = {"--nprocs": NPROCS_OPTIONS, "--omp-nthreads": OMP_OPTIONS, "--mem_gb": MEM_OPTIONS}
+    command = list(command)
+    added = []
+    for option, value in plan.items():
+        if not has_option(command, spellings[option]):
+            command.append(f"{option}={value}")
+            added.append(f"{option}={value}")
+    log.info(
+        f"Resources: {resources['cpus']} CPUs (limited by {resources['limited_by']['cpus']}), "
+        f"{resources['mem_gb']:.1f} GB (limited by {resources['limited_by']['mem_gb']}). "
+        + (f"Added {' '.join(added)}" if added else "Keeping the resource options that were set.")
+    )
+    return command
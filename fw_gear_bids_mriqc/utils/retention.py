@@ -0,0 +1,156 @@
+"""Select the intermediate work files to keep, by glob pattern, in a single pruned walk."""
+
+import fnmatch
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Iterator, List, Optional, Pattern, Tuple, Union
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+
+log = logging.getLogger(__name__)
+
+# Walk results: (path, relative path, size in bytes, is a kept folder)
+Match = Tuple[str, str, int, bool]
+
+
+def _compile(segment: str) -> Optional[Pattern]:
+    return None if segment == "**" else re.compile(fnmatch.translate(segment))
+
+
+class _Glob:
+    """One retention pattern.
+
+    A pattern without "/" matches a name anywhere in the tree (as the original
+    name lists did). A pattern with "/" is anchored to the top of the work dir,
+    one segment per directory level; "**" matches any number of levels.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.anchored = "/" in pattern.strip("/")
+        self.segments = [_compile(s) for s in pattern.strip("/").split("/")] if self.anchored else []
+        self.name = None if self.anchored else re.compile(fnmatch.translate(pattern.strip("/")))
+
+    def _match_from(self, i: int, parts: List[str], j: int) -> bool:
+        segs = self.segments
+        while i < len(segs):
+            if segs[i] is None:
+                # "**": any number of levels, including none
+                return any(self._match_from(i + 1, parts, k) for k in range(j, len(parts) + 1))
+            if j >= len(parts) or not segs[i].match(parts[j]):
+                return False
+            i, j = i + 1, j + 1
+        return j == len(parts)
+
+    def matches(self, parts: List[str]) -> bool:
+        if not self.anchored:
+            return bool(self.name.match(parts[-1]))
+        return self._match_from(0, parts, 0)
+
+    def may_match_below(self, parts: List[str]) -> bool:
+        """Could anything under this directory match? Anchored patterns let the walk skip whole subtrees."""
+        if not self.anchored:
+            return True
+        for i, part in enumerate(parts):
+            if i >= len(self.segments):
+                return False
+            if self.segments[i] is None:
+                return True
+            if not self.segments[i].match(part):
+                return False
+        return len(self.segments) > len(parts)
+
+
+class RetentionRules:
+    """File and folder patterns for the intermediate files to keep.
+
+    Args:
+        file_patterns (str or List): space-separated or listed globs for files to keep
+        folder_patterns (str or List): globs for folders to keep, with everything in them
+    """
+
+    def __init__(self, file_patterns: Union[str, List[str], None], folder_patterns: Union[str, List[str], None]):
+        self.files = [_Glob(p) for p in _split(file_patterns)]
+        self.folders = [_Glob(p) for p in _split(folder_patterns)]
+
+    @classmethod
+    def from_app_context(cls, app_context: BIDSAppContext) -> "RetentionRules":
+        return cls(app_context.save_intermediate_files, app_context.save_intermediate_folders)
+
+    def __bool__(self) -> bool:
+        return bool(self.files or self.folders)
+
+    def walk(self, top: Union[Path, str]) -> Iterator[Match]:
+        """Yield the matching files and folders under top, without descending into subtrees that cannot match.
+
+        A matching folder is yielded once (size 0) and not walked; the caller
+        takes all of it.
+        """
+        top = str(top)
+        rules = self.files + self.folders
+        stack = [(top, [])]
+        while stack:
+            dirpath, parent = stack.pop()
+            try:
+                entries = sorted(os.scandir(dirpath), key=lambda e: e.name)
+            except OSError as exc:
+                log.debug(f"Cannot list {dirpath}: {exc}")
+                continue
+            subdirs = []
+            for entry in entries:
+                parts = parent + [entry.name]
+                if entry.is_dir(follow_symlinks=False):
+                    if any(rule.matches(parts) for rule in self.folders):
+                        yield entry.path, "/".join(parts), 0, True
+                    elif any(rule.may_match_below(parts) for rule in rules):
+                        subdirs.append((entry.path, parts))
+                elif any(rule.matches(parts) for rule in self.files):
+                    try:
+                        size = entry.stat().st_size
+                    except OSError:
+                        log.warning(f"Skipping {entry.path}: unreadable or a broken link")
+                        continue
+                    yield entry.path, "/".join(parts), size, False
+            # Depth first, in name order
+            stack.extend(reversed(subdirs))
+
+
+def _split(patterns: Union[str, List[str], None]) -> List[str]:
+    if not patterns:
+        return []
+    return patterns.split() if isinstance(patterns, str) else list(patterns)
+
+
+def tree_bytes(top: str) -> int:
+    """Size of the files in a kept folder."""
+    total = 0
+    for dirpath, _, filenames in os.walk(top):
+        for name in filenames:
+            try:
+                total += os.stat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def write_retention_listing(matches: List[Match], listing_path: Union[Path, str]) -> int:
+    """Dry run: write what would be kept (with sizes) and log a summary.
+
+    Returns:
+        total (int): bytes that would be archived, before compression
+    """
+    total = 0
+    with open(listing_path, "w") as fp:
+        fp.write("path\ttype\tbytes\n")
+        for path, rel, size, is_folder in matches:
+            if is_folder:
+                size = tree_bytes(path)
+            total += size
+            fp.write(f"{rel}\t{'folder' if is_folder else 'file'}\t{size}\n")
+    log.info(
+        f"gear-intermediate-dry-run: {len(matches)} files and folders ({total / 1024**2:.1f} MB before compression) "
+        f"would be kept from the work directory; see {Path(listing_path).name}"
+    )
+    return total
@@ -0,0 +1,203 @@
+"""Reuse MRIQC participant outputs when a participant's inputs have not changed."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple, Union
+
+from fw_gear_bids_mriqc.utils.command_options import ANALYSIS_LEVELS, PARTICIPANT_OPTIONS, pop_option
+from fw_gear_bids_mriqc.utils.resources import MEM_OPTIONS, NPROCS_OPTIONS, OMP_OPTIONS
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = "mriqc-cache"
+MANIFEST_NAME = "manifest.json"
+_CHUNK = 1024 * 1024
+
+# Options that change where or how fast MRIQC runs, but not what it computes
+IGNORED_OPTIONS = (
+    PARTICIPANT_OPTIONS
+    + ["--session-id", "-w", "--work-dir"]
+    + NPROCS_OPTIONS
+    + OMP_OPTIONS
+    + MEM_OPTIONS
+    + ["-v", "-vv", "-vvv", "--verbose", "--notrack"]
+)
+
+
+def mriqc_version(binary: str) -> str:
+    """Version string reported by the BIDS App, e.g. "MRIQC v23.1.0"."""
+    try:
+        result = subprocess.run([binary, "--version"], capture_output=True, text=True, timeout=120)
+        return (result.stdout or result.stderr).strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+def relevant_flags(command: List[str], positionals: Iterable[Union[Path, str]]) -> List[str]:
+    """Command options that affect the IQMs, without paths or resource settings.
+
+    The binary, the analysis level, and the given positional arguments are
+    removed wherever they are in the command, since options may come before
+    or between them.
+
+    Args:
+        command (List): BIDS App command
+        positionals (Iterable): the bids_dir and output_dir given to the command
+
+    Returns:
+        flags (List): the remaining options and their values
+    """
+    expected = [str(p) for p in positionals]
+    level_found = False
+    flags = []
+    for arg in command[1:]:
+        if arg in expected:
+            expected.remove(arg)
+        elif arg in ANALYSIS_LEVELS and not level_found:
+            level_found = True
+        else:
+            flags.append(arg)
+    flags, _ = pop_option(flags, IGNORED_OPTIONS)
+    return flags
+
+
+def _hash_file(hasher, path: Path) -> None:
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(_CHUNK), b""):
+            hasher.update(chunk)
+
+
+def participant_fingerprint(bids_dir: Union[Path, str], participant: str, salt: str = "") -> str:
+    """Hash a participant's NIfTI files and sidecars, plus the dataset-level sidecars.
+
+    Args:
+        bids_dir (Path): downloaded BIDS dataset
+        participant (str): label, without "sub-"
+        salt (str): anything else the outputs depend on (app version, flags)
+
+    Returns:
+        fingerprint (str): hex digest
+    """
+    bids_dir = Path(bids_dir)
+    files = sorted(bids_dir.glob("*.json"))
+    files += sorted(
+        p
+        for p in (bids_dir / f"sub-{participant}").rglob("*")
+        if p.is_file() and p.name.endswith((".nii", ".nii.gz", ".json"))
+    )
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(salt.encode())
+    for path in files:
+        hasher.update(str(path.relative_to(bids_dir)).encode())
+        _hash_file(hasher, path)
+    return hasher.hexdigest()
+
+
+def _participant_outputs(analysis_output_dir: Path, participant: str) -> List[Path]:
+    """The participant's output folder and its html reports."""
+    analysis_output_dir = Path(analysis_output_dir)
+    reports = analysis_output_dir.glob(f"sub-{participant}_*")
+    return sorted(p for p in [analysis_output_dir / f"sub-{participant}", *reports] if p.exists())
+
+
+class RunCache:
+    """Participant outputs saved by previous runs, with the fingerprints of their inputs.
+
+    The manifest maps each participant label to the fingerprint of the inputs
+    that produced the saved outputs. Outputs live next to the manifest, in one
+    folder per participant.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[Path, str],
+        bids_dir: Union[Path, str],
+        command: List[str],
+        output_dir: Union[Path, str],
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.bids_dir = Path(bids_dir)
+        self.salt = json.dumps([mriqc_version(command[0]), relevant_flags(command, [bids_dir, output_dir])])
+        self.manifest = self._load_manifest()
+        self.fingerprints = {}
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.cache_dir / MANIFEST_NAME
+
+    def _load_manifest(self) -> Dict:
+        try:
+            with open(self.manifest_path) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            log.warning(f"Ignoring unreadable run cache manifest {self.manifest_path}: {exc}")
+            return {}
+
+    def _write_manifest(self) -> None:
+        # Write then rename, so a concurrent reader never sees half a manifest
+        tmp_path = self.manifest_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(self.manifest, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def fingerprint(self, participant: str) -> str:
+        if participant not in self.fingerprints:
+            self.fingerprints[participant] = participant_fingerprint(self.bids_dir, participant, self.salt)
+        return self.fingerprints[participant]
+
+    def partition(self, participants: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """Split participants into those with saved, up-to-date outputs and the rest.
+
+        Returns:
+            hits (List): participants whose outputs can be reused
+            misses (List): participants that need to be run
+        """
+        hits, misses = [], []
+        for participant in participants:
+            entry = self.manifest.get(participant, {})
+            if entry.get("fingerprint") == self.fingerprint(participant) and (self.cache_dir / participant).is_dir():
+                hits.append(participant)
+            else:
+                misses.append(participant)
+        log.info(f"Run cache: reusing {len(hits)} participant(s), running {len(misses)}.")
+        return hits, misses
+
+    def restore(self, participants: Iterable[str], analysis_output_dir: Union[Path, str]) -> None:
+        """Copy the saved outputs of these participants into the analysis output directory."""
+        analysis_output_dir = Path(analysis_output_dir)
+        analysis_output_dir.mkdir(parents=True, exist_ok=True)
+        for participant in participants:
+            for src in sorted((self.cache_dir / participant).iterdir()):
+                dest = analysis_output_dir / src.name
+                if src.is_dir():
+                    shutil.copytree(src, dest, dirs_exist_ok=True)
+                else:
+                    shutil.copy2(src, dest)
+            log.debug(f"Restored sub-{participant} from {self.cache_dir}")
+
+    def save(self, participants: Iterable[str], analysis_output_dir: Union[Path, str]) -> None:
+        """Save the new outputs of these participants and record their fingerprints."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest = self._load_manifest()
+        for participant in participants:
+            outputs = _participant_outputs(analysis_output_dir, participant)
+            if not outputs:
+                log.debug(f"No outputs to cache for sub-{participant}")
+                continue
+            dest_dir = self.cache_dir / participant
+            shutil.rmtree(dest_dir, ignore_errors=True)
+            dest_dir.mkdir()
+            for src in outputs:
+                if src.is_dir():
+                    shutil.copytree(src, dest_dir / src.name)
+                else:
+                    shutil.copy2(src, dest_dir / src.name)
+            self.manifest[participant] = {"fingerprint": self.fingerprint(participant)}
+        self._write_manifest()
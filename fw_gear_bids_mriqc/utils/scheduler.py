@@ -0,0 +1,208 @@
+"""Split a project-level run into per-participant MRIQC runs and execute them in parallel."""
+
+import logging
+import math
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Union
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+
+from fw_gear_bids_mriqc.utils.command_options import has_option, pop_option, set_option, set_output_dir
+from fw_gear_bids_mriqc.utils.log_monitor import run_with_log_monitor
+from fw_gear_bids_mriqc.utils.resources import MEM_OPTIONS, NPROCS_OPTIONS, OMP_OPTIONS, gear_resources, omp_threads_for
+
+log = logging.getLogger(__name__)
+
+# Smallest slice of the node worth giving to one MRIQC participant run
+UNIT_CPUS = 2
+UNIT_MEM_GB = 4.0
+UNITS_DIR = "mriqc_units"
+
+
+class WorkUnit(NamedTuple):
+    """One participant (optionally, one session) to run through MRIQC."""
+
+    participant: str
+    session: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        if self.session:
+            return f"sub-{self.participant}_ses-{self.session}"
+        return f"sub-{self.participant}"
+
+
+def discover_work_units(
+    bids_dir: Union[Path, str], by_session: bool = False, participants: Optional[List[str]] = None
+) -> List[WorkUnit]:
+    """List the participants (or participant x session) in the BIDS directory.
+
+    Args:
+        bids_dir (Path): downloaded BIDS dataset
+        by_session (bool): make one unit per session instead of per participant
+        participants (List, optional): restrict to these labels (no "sub-")
+
+    Returns:
+        units (List[WorkUnit]): sorted work units
+    """
+    units = []
+    for sub_dir in sorted(Path(bids_dir).glob("sub-*")):
+        if not sub_dir.is_dir():
+            continue
+        participant = sub_dir.name[len("sub-") :]
+        if participants and participant not in participants:
+            continue
+        sessions = sorted(d.name[len("ses-") :] for d in sub_dir.glob("ses-*") if d.is_dir())
+        if by_session and sessions:
+            units.extend(WorkUnit(participant, ses) for ses in sessions)
+        else:
+            units.append(WorkUnit(participant))
+    return units
+
+
+def plan_pool(config: Dict, n_units: int) -> Dict[str, float]:
+    """Size the pool of concurrent MRIQC runs from the available resources.
+
+    Args:
+        config (Dict): gear config (see `gear_resources` for the limits that apply)
+        n_units (int): number of work units
+
+    Returns:
+        plan (Dict): "workers", plus the "nprocs" and "mem_gb" for each run
+    """
+    resources = gear_resources(config)
+    workers = min(
+        n_units,
+        max(1, resources["cpus"] // UNIT_CPUS),
+        max(1, math.floor(resources["mem_gb"] / UNIT_MEM_GB)),
+    )
+    workers = max(1, workers)
+    plan = {
+        "workers": workers,
+        "nprocs": max(1, resources["cpus"] // workers),
+        "mem_gb": max(1, math.floor(resources["mem_gb"] / workers)),
+    }
+    log.info(
+        f"Running {n_units} MRIQC work units, {plan['workers']} at a time, "
+        f"each with {plan['nprocs']} CPUs and {plan['mem_gb']} GB "
+        f"(from {resources['cpus']} CPUs, {resources['mem_gb']:.1f} GB)."
+    )
+    return plan
+
+
+def build_unit_command(command: List[str], unit: WorkUnit, unit_dir: Path, plan: Dict) -> List[str]:
+    """Point a participant-level command at a single work unit.
+
+    The unit gets its own output and work directories, so that concurrent runs
+    never share nipype caches or partially written outputs. Resource kwargs are
+    only added when the user did not set them.
+    """
+    unit_cmd = set_output_dir(command, unit_dir / "out")
+    unit_cmd = set_option(unit_cmd, "--participant-label", unit.participant)
+    if unit.session:
+        unit_cmd = set_option(unit_cmd, "--session-id", unit.session)
+    unit_cmd = set_option(unit_cmd, "-w", unit_dir / "work")
+    unit_cmd, _ = pop_option(unit_cmd, ["--work-dir"])
+    if not has_option(unit_cmd, NPROCS_OPTIONS):
+        unit_cmd = set_option(unit_cmd, "--nprocs", plan["nprocs"])
+    if not has_option(unit_cmd, OMP_OPTIONS):
+        unit_cmd = set_option(unit_cmd, "--omp-nthreads", omp_threads_for(plan["nprocs"]))
+    if not has_option(unit_cmd, MEM_OPTIONS):
+        unit_cmd = set_option(unit_cmd, "--mem_gb", plan["mem_gb"])
+    return unit_cmd
+
+
+def _run_unit(unit_cmd: List[str], log_dir: Path, log_prefix: str, dry_run: bool) -> int:
+    """Run MRIQC for one unit; the output goes to the unit's own compressed log and timing report."""
+    if dry_run:
+        log.info("Executing command: \n %s \n\n", " ".join(unit_cmd))
+        return 0
+    try:
+        # Not echoed: the concurrent units' lines would be interleaved in the job log
+        return run_with_log_monitor(unit_cmd, log_dir, log_prefix, environ=os.environ, echo=False)
+    except (RuntimeError, OSError) as exc:
+        log.debug(exc)
+        return 1
+
+
+def merge_unit_outputs(unit_out: Path, analysis_output_dir: Path) -> None:
+    """Move a finished unit's MRIQC outputs into the shared output directory.
+
+    Participant outputs do not overlap between units; shared files such as
+    dataset_description.json are kept from the first unit that wrote them.
+    """
+    for src in sorted(Path(unit_out).rglob("*")):
+        if not src.is_file():
+            continue
+        dest = Path(analysis_output_dir) / src.relative_to(unit_out)
+        if dest.exists():
+            log.debug(f"Keeping existing {dest}")
+            continue
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(src), str(dest))
+
+
+def run_work_units(
+    app_context: BIDSAppContext, command: List[str], units: List[WorkUnit], config: Dict
+) -> int:
+    """Run MRIQC once per work unit, several at a time, and merge the outputs.
+
+    Each worker thread only supervises an MRIQC subprocess, so threads are
+    enough to keep all of the node's cores busy. Failed units are retried up
+    to `gear-unit-retries` times; each retry reuses the unit's work directory,
+    so nipype skips the nodes that already finished.
+
+    Args:
+        app_context (BIDSAppContext): information specific to this BIDS app and gear run
+        command (List): participant-level BIDS App command
+        units (List[WorkUnit]): participants (or sessions) to run
+        config (Dict): gear config
+
+    Returns:
+        e_code (int): 0 if every unit succeeded, else 1
+    """
+    if not units:
+        log.warning("No participants found to run.")
+        return 1
+
+    plan = plan_pool(config, len(units))
+    retries = int(config.get("gear-unit-retries") or 0)
+    # Units work on the fast tier when the work dir is staged (gear-work-dir-staging)
+    units_root = Path(getattr(app_context, "staged_work_dir", None) or app_context.work_dir) / UNITS_DIR
+    log_dir = Path(app_context.analysis_output_dir) / "logs" / "units"
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    pending = {unit: 0 for unit in units}
+    failed = []
+    with ThreadPoolExecutor(max_workers=plan["workers"]) as pool:
+        futures = {}
+
+        def submit(unit):
+            unit_dir = units_root / unit.label
+            unit_cmd = build_unit_command(command, unit, unit_dir, plan)
+            log_prefix = f"{app_context.bids_app_binary}_{unit.label}"
+            futures[pool.submit(_run_unit, unit_cmd, log_dir, log_prefix, app_context.gear_dry_run)] = unit
+
+        for unit in units:
+            submit(unit)
+        while futures:
+            future = next(as_completed(futures))
+            unit = futures.pop(future)
+            if future.result() == 0:
+                merge_unit_outputs(units_root / unit.label / "out", app_context.analysis_output_dir)
+                log.info(f"Finished {unit.label}")
+            elif pending[unit] < retries:
+                pending[unit] += 1
+                log.warning(f"{unit.label} failed. Retry {pending[unit]} of {retries}.")
+                submit(unit)
+            else:
+                log.error(f"{unit.label} failed. See {log_dir} for the MRIQC log.")
+                failed.append(unit.label)
+
+    if failed:
+        log.error(f"{len(failed)} of {len(units)} work units failed: {', '.join(failed)}")
+        return 1
+    return 0
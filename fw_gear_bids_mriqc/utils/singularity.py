@@ -1,6 +1,7 @@
 """Do what it takes to be able to run gears in Singularity.
 """
 
+import json
 import logging
 import os
 import re
@@ -15,6 +16,19 @@ FWV0 = "/flywheel/v0"
 SCRATCH_NAME = "gear-temp-dir-"
 
 
+def configured_writable_dir(config_path=Path(FWV0) / "config.json"):
+    """Read gear-writable-dir from config.json, before the gear context exists.
+
+    Args:
+        config_path (path): the gear's config.json
+
+    Returns:
+        writable_dir (string): the gear-writable-dir config value
+    """
+    with open(config_path) as fp:
+        return json.load(fp)["config"]["gear-writable-dir"]
+
+
 def run_in_tmp_dir(writable_dir):
     """Copy gear to a temporary directory and cd to there.
 
@@ -0,0 +1,265 @@
+"""Fan a project-level run out to a Slurm job array, one task per participant."""
+
+import logging
+import math
+import os
+import shlex
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+
+from fw_gear_bids_mriqc.utils.command_options import PARTICIPANT_OPTIONS, pop_option
+from fw_gear_bids_mriqc.utils.resources import parse_mem_gb
+from fw_gear_bids_mriqc.utils.scheduler import UNITS_DIR, build_unit_command, discover_work_units
+
+log = logging.getLogger(__name__)
+
+SLURM_POLL_SECONDS = 30
+SLURM_DIR = "mriqc_slurm"
+SLURM_QUERY_RETRIES = 8
+SLURM_MAX_BACKOFF = 600
+# sacct states of jobs that will not run any more
+FINAL_STATES = {
+    "BOOT_FAIL",
+    "CANCELLED",
+    "COMPLETED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "TIMEOUT",
+}
+
+# config key -> sbatch option
+SLURM_OPTIONS = {
+    "slurm-cpu": "--cpus-per-task",
+    "slurm-ram": "--mem-per-cpu",
+    "slurm-nodes": "--nodes",
+    "slurm-ntasks": "--ntasks",
+    "slurm-partition": "--partition",
+    "slurm-qos": "--qos",
+    "slurm-account": "--account",
+    "slurm-time": "--time",
+}
+
+
+def sbatch_directives(config: Dict, job_name: str, log_pattern: Path) -> List[str]:
+    """#SBATCH lines for one task, from the slurm-* config values."""
+    lines = [f"#SBATCH --job-name={job_name}", f"#SBATCH --output={log_pattern}"]
+    for key, option in SLURM_OPTIONS.items():
+        if config.get(key):
+            lines.append(f"#SBATCH {option}={config[key]}")
+    return lines
+
+
+def task_plan(config: Dict) -> Dict[str, int]:
+    """Resources that MRIQC may use inside a single array task."""
+    try:
+        cpus = int(config.get("slurm-cpu") or 1)
+    except ValueError:
+        cpus = 1
+    mem_per_cpu = parse_mem_gb(config.get("slurm-ram")) or 4.0
+    return {"nprocs": cpus, "mem_gb": max(1, math.floor(cpus * mem_per_cpu))}
+
+
+def _container_prefix(bind_dirs: List[str]) -> List[str]:
+    """Re-enter the gear's Singularity image for the commands run by Slurm."""
+    image = os.environ.get("SINGULARITY_CONTAINER")
+    if not image:
+        return []
+    binds = ",".join(sorted(set(bind_dirs)))
+    return ["singularity", "exec", "--cleanenv", "-B", binds, image]
+
+
+def write_job_scripts(
+    app_context: BIDSAppContext, command: List[str], config: Dict, slurm_dir: Path
+) -> Dict:
+    """Create the participant array script and the dependent group script.
+
+    Args:
+        app_context (BIDSAppContext): information specific to this BIDS app and gear run
+        command (List): group-level BIDS App command
+        config (Dict): gear config (slurm-* keys)
+        slurm_dir (Path): where the scripts, task list, and Slurm logs go
+
+    Returns:
+        scripts (Dict): "array", "group", and "status" file paths, plus "n_tasks" and the
+            planned "units" (labels)
+    """
+    slurm_dir.mkdir(parents=True, exist_ok=True)
+    units_root = Path(app_context.work_dir).resolve() / UNITS_DIR
+    analysis_output_dir = Path(app_context.analysis_output_dir).resolve()
+    prefix = _container_prefix(
+        [str(Path(config.get("gear-writable-dir") or "/tmp")), str(units_root.parent), str(analysis_output_dir.parent)]
+    )
+
+    participant_command = ["participant" if arg == "group" else arg for arg in command]
+    participant_command, labels = pop_option(participant_command, PARTICIPANT_OPTIONS)
+    units = discover_work_units(app_context.bids_dir, participants=[label.replace("sub-", "") for label in labels])
+    plan = task_plan(config)
+    task_file = slurm_dir / "tasks.txt"
+    with open(task_file, "w") as fp:
+        for unit in units:
+            unit_cmd = build_unit_command(participant_command, unit, units_root / unit.label, plan)
+            fp.write(shlex.join(prefix + unit_cmd) + "\n")
+
+    job_name = f"{app_context.bids_app_binary}-{app_context.destination_id}"
+    limit = config.get("gear-slurm-array-limit")
+    array = f"1-{len(units)}" + (f"%{limit}" if limit else "")
+    array_script = slurm_dir / "participant_array.sh"
+    array_script.write_text(
+        "\n".join(
+            ["#!/bin/bash"]
+            + sbatch_directives(config, job_name, slurm_dir / "%x_%A_%a.log")
+            + [
+                f"#SBATCH --array={array}",
+                "set -euo pipefail",
+                f'eval "$(sed -n "${{SLURM_ARRAY_TASK_ID}}p" {shlex.quote(str(task_file))})"',
+                "",
+            ]
+        )
+    )
+
+    status_file = slurm_dir / "group.status"
+    group_script = slurm_dir / "group.sh"
+    group_script.write_text(
+        "\n".join(
+            ["#!/bin/bash"]
+            + sbatch_directives(config, f"{job_name}-group", slurm_dir / "%x_%j.log")
+            + [
+                "set -uo pipefail",
+                # Gather the finished participants before summarizing
+                f"for unit_out in {shlex.quote(str(units_root))}/*/out; do",
+                f'  [ -d "$unit_out" ] && cp -Rn "$unit_out"/. {shlex.quote(str(analysis_output_dir))}/',
+                "done",
+                shlex.join(prefix + command),
+                f"echo $? > {shlex.quote(str(status_file))}",
+                "",
+            ]
+        )
+    )
+    return {
+        "array": array_script,
+        "group": group_script,
+        "status": status_file,
+        "n_tasks": len(units),
+        "units": [unit.label for unit in units],
+    }
+
+
+def _sbatch(*args) -> str:
+    """Submit a job and return its id."""
+    result = subprocess.run(["sbatch", "--parsable", *args], capture_output=True, text=True, check=True)
+    return result.stdout.strip().split(";")[0]
+
+
+def _sacct_finished(job_ids: List[str]) -> Optional[bool]:
+    """Whether sacct reports every job (and array task) in a final state; None if sacct cannot tell."""
+    if not shutil.which("sacct"):
+        return None
+    result = subprocess.run(
+        ["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", ",".join(job_ids)], capture_output=True, text=True
+    )
+    rows = [line.split("|") for line in result.stdout.splitlines() if "|" in line]
+    if result.returncode != 0 or not rows:
+        return None
+    # e.g., "CANCELLED by 1234"
+    return all(state.split()[0] in FINAL_STATES for _, state in rows if state)
+
+
+def wait_for_jobs(job_ids: List[str], poll_seconds: int = SLURM_POLL_SECONDS) -> None:
+    """Block until the jobs are finished.
+
+    squeue stops listing a job once it ends, but it also fails when slurmctld
+    is busy, and "not listed" alone cannot tell the two apart. squeue errors
+    are retried with backoff, and the jobs count as finished only when sacct
+    confirms their final state (or, without accounting, when squeue
+    successfully lists none of them).
+
+    Raises:
+        RuntimeError: if Slurm cannot be queried after SLURM_QUERY_RETRIES attempts
+    """
+    failures = 0
+    while True:
+        result = subprocess.run(
+            ["squeue", "-h", "-o", "%i", "-j", ",".join(job_ids)], capture_output=True, text=True
+        )
+        if result.returncode == 0 and result.stdout.strip():
+            failures = 0
+            log.debug(f"Waiting on Slurm jobs:\n{result.stdout}")
+            time.sleep(poll_seconds)
+            continue
+
+        finished = _sacct_finished(job_ids)
+        if finished or (finished is None and result.returncode == 0):
+            return
+        if result.returncode == 0:
+            # Between squeue and the accounting records; look again later
+            time.sleep(poll_seconds)
+            continue
+
+        failures += 1
+        if failures > SLURM_QUERY_RETRIES:
+            raise RuntimeError(f"Unable to query Slurm for jobs {', '.join(job_ids)}: {result.stderr.strip()}")
+        delay = min(poll_seconds * 2 ** (failures - 1), SLURM_MAX_BACKOFF)
+        log.warning(f"squeue failed ({result.stderr.strip()}); retry {failures} of {SLURM_QUERY_RETRIES} in {delay}s")
+        time.sleep(delay)
+
+
+def fan_out_to_slurm(app_context: BIDSAppContext, command: List[str], config: Dict) -> int:
+    """Run participants as a Slurm job array and the group step as a dependent job.
+
+    Each participant becomes one array task with its own resources (slurm-cpu,
+    slurm-ram, slurm-time, ...). The group job waits for the whole array,
+    merges the participant outputs, and runs the group command. The gear waits
+    for both, then continues with the usual post-processing.
+
+    Args:
+        app_context (BIDSAppContext): information specific to this BIDS app and gear run
+        command (List): group-level BIDS App command
+        config (Dict): gear config
+
+    Returns:
+        e_code (int): 0 if the group step succeeded
+    """
+    if not shutil.which("sbatch"):
+        log.error("gear-slurm-fanout is set, but sbatch is not available on this node.")
+        return 1
+
+    slurm_dir = Path(app_context.work_dir).resolve() / SLURM_DIR
+    scripts = write_job_scripts(app_context, command, config, slurm_dir)
+    if not scripts["n_tasks"]:
+        log.warning("No participants found to run.")
+        return 1
+    if app_context.gear_dry_run:
+        log.info(f"gear-dry-run is set: Slurm scripts written to {slurm_dir}, but not submitted.")
+        return 0
+
+    try:
+        array_id = _sbatch(str(scripts["array"]))
+        group_id = _sbatch(f"--dependency=afterany:{array_id}", str(scripts["group"]))
+    except subprocess.CalledProcessError as exc:
+        log.error(f"Unable to submit the Slurm jobs:\n{exc.stderr}")
+        return 1
+    log.info(
+        f"Submitted {scripts['n_tasks']} participant tasks as Slurm array {array_id} "
+        f"and the group summaries as job {group_id}. Logs: {slurm_dir}"
+    )
+    wait_for_jobs([array_id, group_id])
+
+    try:
+        e_code = int(Path(scripts["status"]).read_text().strip())
+    except (OSError, ValueError):
+        log.error(f"The group job did not finish. See {slurm_dir} for the Slurm logs.")
+        return 1
+
+    units_root = Path(app_context.work_dir).resolve() / UNITS_DIR
+    missing = [label for label in scripts["units"] if not any((units_root / label / "out").glob("sub-*"))]
+    if missing:
+        log.warning(f"No outputs from {len(missing)} participant task(s): {', '.join(missing)}")
+    return e_code
@@ -0,0 +1,151 @@
+"""Put the nipype work directory on a RAM disk or node-local scratch while MRIQC runs."""
+
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+
+from fw_gear_bids_mriqc.utils.command_options import has_option, set_option
+from fw_gear_bids_mriqc.utils.resources import gear_resources
+from fw_gear_bids_mriqc.utils.retention import RetentionRules
+
+log = logging.getLogger(__name__)
+
+SHM_DIR = Path("/dev/shm")
+STAGE_PREFIX = "mriqc-work-"
+# nipype work dir size per GB of BIDS input, plus a fixed allowance
+WORK_DIR_FACTOR = 5
+WORK_DIR_BASE_GB = 1.0
+# A RAM disk uses the job's memory; never give it more than this share
+SHM_MEM_FRACTION = 0.25
+
+
+def tree_size_gb(top: Union[Path, str]) -> float:
+    """Total size of the files under a directory (no symlinks followed)."""
+    total, stack = 0, [str(top)]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+    return total / 1024**3
+
+
+def _free_gb(path: Path) -> float:
+    try:
+        return shutil.disk_usage(path).free / 1024**3
+    except OSError:
+        return 0.0
+
+
+def _same_filesystem(a: Union[Path, str], b: Union[Path, str]) -> bool:
+    try:
+        return os.stat(a).st_dev == os.stat(b).st_dev
+    except OSError:
+        return False
+
+
+def choose_stage_dir(mode: str, need_gb: float, shared_dir: Union[Path, str], config: Dict) -> Optional[Path]:
+    """Pick the fastest tier with room for the work directory.
+
+    Args:
+        mode (str): "auto", "shm" (RAM disk only), "local" (node-local scratch only), or "off"
+        need_gb (float): expected size of the nipype work directory
+        shared_dir (Path): the current (shared) work location; a tier on the same
+            filesystem is no improvement
+        config (Dict): gear config, for the memory available to the job
+
+    Returns:
+        tier (Path): directory to create the staged work dir in, or None
+    """
+    candidates = []
+    if mode in ["auto", "shm"] and SHM_DIR.is_dir():
+        mem_gb = gear_resources(config)["mem_gb"]
+        if need_gb <= SHM_MEM_FRACTION * mem_gb and need_gb <= _free_gb(SHM_DIR):
+            candidates.append(SHM_DIR)
+        else:
+            log.debug(f"{need_gb:.1f} GB does not fit on {SHM_DIR} with {mem_gb:.1f} GB of job memory")
+    if mode in ["auto", "local"]:
+        candidates.extend(Path(d) for d in [os.environ.get("TMPDIR"), tempfile.gettempdir()] if d)
+
+    for tier in candidates:
+        if not os.access(tier, os.W_OK) or _same_filesystem(tier, shared_dir):
+            continue
+        if _free_gb(tier) >= need_gb:
+            return tier
+        log.debug(f"Not enough room on {tier} for {need_gb:.1f} GB")
+    return None
+
+
+class WorkDirStage:
+    """A nipype work directory on fast storage, with the retained files synced back after the run."""
+
+    def __init__(self, stage_dir: Path, app_context: BIDSAppContext):
+        self.stage_dir = stage_dir
+        self.app_context = app_context
+
+    def command_with_work_dir(self, command: List[str]) -> List[str]:
+        """Point MRIQC's -w at the staged directory."""
+        return set_option(command, "-w", self.stage_dir)
+
+    def _retained(self) -> List[Path]:
+        """Staged files and folders that packaging will keep (see `package_output`)."""
+        if self.app_context.save_intermediate_output:
+            return [self.stage_dir]
+        rules = RetentionRules.from_app_context(self.app_context)
+        return [Path(path) for path, _, _, _ in rules.walk(self.stage_dir)] if rules else []
+
+    def sync_back(self) -> None:
+        """Copy the retained work files to the gear's work dir, then free the fast tier."""
+        work_dir = Path(self.app_context.work_dir)
+        try:
+            for src in self._retained():
+                dest = work_dir / src.relative_to(self.stage_dir)
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                if src.is_dir():
+                    shutil.copytree(src, dest, symlinks=True, dirs_exist_ok=True)
+                else:
+                    shutil.copy2(src, dest)
+                log.debug(f"Kept {dest}")
+        finally:
+            shutil.rmtree(self.stage_dir, ignore_errors=True)
+            self.app_context.staged_work_dir = None
+            log.info(f"Removed the staged work directory {self.stage_dir}")
+
+
+def stage_work_dir(config: Dict, app_context: BIDSAppContext, command: List[str]) -> Optional[WorkDirStage]:
+    """Stage the nipype work directory per `gear-work-dir-staging`.
+
+    The BIDS inputs and the outputs stay where they are; only nipype's many
+    small intermediate files go to the fast tier. The staged location is kept
+    on `app_context.staged_work_dir` for the parallel work units.
+
+    Args:
+        config (Dict): gear config
+        app_context (BIDSAppContext): information specific to this BIDS app and gear run
+        command (List): BIDS App command; a user-given -w/--work-dir turns staging off
+
+    Returns:
+        stage (WorkDirStage): or None, if the work dir stays in place
+    """
+    mode = config.get("gear-work-dir-staging") or "off"
+    if mode == "off" or has_option(command, ["-w", "--work-dir"]):
+        return None
+    need_gb = WORK_DIR_FACTOR * tree_size_gb(app_context.bids_dir) + WORK_DIR_BASE_GB
+    tier = choose_stage_dir(mode, need_gb, app_context.work_dir, config)
+    if tier is None:
+        log.info(f"No fast tier with room for the work directory (~{need_gb:.1f} GB); using {app_context.work_dir}")
+        return None
+    stage_dir = Path(tempfile.mkdtemp(prefix=STAGE_PREFIX, dir=tier))
+    app_context.staged_work_dir = stage_dir
+    log.info(f"Staging the nipype work directory (~{need_gb:.1f} GB expected) on {stage_dir}")
+    return WorkDirStage(stage_dir, app_context)
@@ -0,0 +1,118 @@
+"""Time the gear's startup: module imports and context parsing.
+
+`ImportTimer` is installed at the top of run.py, before the heavy imports, and
+records the self and cumulative time of every module loaded from a file, the
+way `python -X importtime` does. The breakdown is logged in debug mode, once
+logging is configured.
+"""
+
+import importlib.machinery
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List
+
+log = logging.getLogger(__name__)
+
+# Loaders whose instances load a single module, so wrapping one times one import
+_TIMED_LOADERS = (
+    importlib.machinery.SourceFileLoader,
+    importlib.machinery.SourcelessFileLoader,
+    importlib.machinery.ExtensionFileLoader,
+)
+# Modules listed in the debug breakdown
+TOP_IMPORTS = 25
+
+
+@dataclass
+class ImportRecord:
+    """Time spent executing one module (self) and it plus its imports (cumulative)."""
+
+    name: str
+    self_s: float = 0.0
+    cumulative_s: float = 0.0
+
+
+class ImportTimer:
+    """Meta path finder that times the loading of every module found after it is installed."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.records: Dict[str, ImportRecord] = {}
+        self.phases: Dict[str, float] = {}
+        # Imports not nested in another timed import
+        self.imports_s = 0.0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def install(cls) -> "ImportTimer":
+        timer = cls()
+        sys.meta_path.insert(0, timer)
+        return timer
+
+    def uninstall(self) -> None:
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if isinstance(spec.loader, _TIMED_LOADERS):
+            spec.loader.exec_module = self._timed(fullname, spec.loader.exec_module)
+        return spec
+
+    def _timed(self, name: str, exec_module):
+        def timed_exec_module(module):
+            stack = self._local.__dict__.setdefault("stack", [])
+            # Time spent in nested imports, subtracted for the self time
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return exec_module(module)
+            finally:
+                cumulative = time.perf_counter() - start
+                children = stack.pop()
+                with self._lock:
+                    if stack:
+                        stack[-1] += cumulative
+                    else:
+                        self.imports_s += cumulative
+                    self.records[name] = ImportRecord(name, cumulative - children, cumulative)
+
+        return timed_exec_module
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a named startup step, e.g. building the gear context."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def top(self, n: int = TOP_IMPORTS) -> List[ImportRecord]:
+        return sorted(self.records.values(), key=lambda r: r.cumulative_s, reverse=True)[:n]
+
+    def report(self) -> None:
+        """Log the total startup time and, in debug mode, the slowest imports."""
+        self.uninstall()
+        total = time.perf_counter() - self.started
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        log.info(
+            f"Startup took {total:.2f}s: {len(self.records)} modules imported in {self.imports_s:.2f}s"
+            + (f", {phases}" if phases else "")
+        )
+        if log.isEnabledFor(logging.DEBUG):
+            lines = [f"{'self [ms]':>10} | {'cumulative [ms]':>15} | imported package"]
+            lines.extend(f"{r.self_s * 1000:10.1f} | {r.cumulative_s * 1000:15.1f} | {r.name}" for r in self.top())
+            log.debug("Slowest imports:\n  " + "\n  ".join(lines))
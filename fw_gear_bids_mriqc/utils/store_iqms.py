@@ -1,12 +1,10 @@
 import json
 import logging
 import os.path as op
-from collections import defaultdict
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import List
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, NamedTuple, Optional
 
-import flywheel
-from flywheel import ApiException, Client
 from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
 from flywheel_bids.flywheel_bids_app_toolkit.utils.helpers import (
     determine_dir_structure,
@@ -14,25 +12,74 @@ from flywheel_bids.flywheel_bids_app_toolkit.utils.helpers import (
 # from flywheel_bids.flywheel_bids_app_toolkit.utils.query_flywheel import find_associated_bids_acqs
 from flywheel_gear_toolkit import GearToolkitContext
 
+from fw_gear_bids_mriqc.utils.bids_entities import bids_key
+from fw_gear_bids_mriqc.utils.fw_updates import PhaseStats, log_phase_stats, run_update_pool
+from fw_gear_bids_mriqc.utils.iqm_encoding import DEFAULT_CHUNK_KB, DEFAULT_DIGITS, CompactIqmWriter, round_floats
+
+if TYPE_CHECKING:
+    from flywheel import Client
+
 log = logging.getLogger(__name__)
 
+# Rows per data view request when streaming the BIDS files
+VIEW_PAGE_SIZE = 1000
+
+
+class BidsFileRef(NamedTuple):
+    """The few fields of a Flywheel BIDS file that IQM matching needs."""
+
+    acquisition_id: str
+    acquisition_label: str
+    file_id: str
+    name: str
+    bids_filename: str
+    # file.info.IQM, if it was requested (`iter_associated_bids_files(with_iqms=True)`)
+    iqms: Optional[Dict] = None
+
+
+def build_bids_file_index(bids_files: Iterable[BidsFileRef]) -> dict:
+    """Index the BIDS NIfTI files by their BIDS entities.
+
+    Built once per gear run, so that matching each IQM file to the scan it
+    describes is a dictionary lookup rather than a scan over every file of
+    every acquisition.
+
+    Args:
+        bids_files (Iterable[BidsFileRef]): e.g., from `iter_associated_bids_files`
+    Returns:
+        bids_index (dict): BidsFileRef keyed by the `bids_key` of the
+                file's BIDS filename.
+    """
+    bids_index = {}
+    for ref in bids_files:
+        key = bids_key(ref.bids_filename)
+        if key is None:
+            continue
+        if key in bids_index and bids_index[key].file_id != ref.file_id:
+            log.warning(
+                f"{ref.name} and {bids_index[key].name} share the BIDS filename "
+                f"{ref.bids_filename}. Using {bids_index[key].name} for IQMs."
+            )
+            continue
+        bids_index[key] = ref
+    log.debug(f"Indexed {len(bids_index)} BIDS files for IQM matching.")
+    return bids_index
+
 
-def filter_fw_files(bids_name, acqs: list):
+def filter_fw_files(bids_name, bids_index: dict):
     """
     Args:
-        bids_name (str): most of the filename that needs
+        bids_name (str): filename (stem) of the MRIQC output that needs
                 to match the BIDS filename in BIDS.info
-        acqs (list): List of fw acquisition objects
+        bids_index (dict): output of `build_bids_file_index`
     Returns:
-        acquisition and file objects matching the original
-                image file on which the metrics were completed.
+        BidsFileRef for the original image file on which the
+                metrics were completed. None, if there is no exact match.
 
     """
-    for acq in acqs:
-        for f in acq.files:
-            if f.info.get("BIDS"):
-                if bids_name in f.info.get("BIDS").get("Filename") and "nii" in f.name:
-                    return acq, f
+    key = bids_key(bids_name)
+    if key is not None:
+        return bids_index.get(key)
 
 
 def store_iqms(gear_context: GearToolkitContext, bids_app_context: BIDSAppContext) -> dict:
@@ -49,82 +96,274 @@ def store_iqms(gear_context: GearToolkitContext, bids_app_context: BIDSAppContex
                     BIDS app and gear run
 
     """
-    log.debug("Searching for IQMS to update metadata.")
-    json_files = _find_output_files(bids_app_context.analysis_output_dir, "json")
-    metadata_to_upload = defaultdict(dict)
-
-    if json_files:
+    # Imported when needed; the harvester and the stored-IQM reader only use the matching helpers
+    from fw_gear_bids_mriqc.utils.batch import batch_session_ids
+
+    harvester = getattr(bids_app_context, "iqm_harvester", None)
+    # Read straight from the archived run (gear-post-processing-only)
+    archived = getattr(bids_app_context, "archived_iqms", None)
+    if harvester:
+        # Found, parsed, and (mostly) sent while MRIQC was running (gear-live-iqms)
+        json_files = harvester.confirmed_files()
+        log.info(f"Confirmed {len(json_files)} IQM files harvested during the run.")
+    elif archived is not None:
+        json_files = list(archived)
+        log.info(f"Using {len(json_files)} IQM files read from the archived run.")
+    else:
+        log.debug("Searching for IQMS to update metadata.")
+        json_files = _find_output_files(bids_app_context.analysis_output_dir, "json")
+    metadata_to_upload = {}
+    file_updates = []
+    # Unmatched scans are streamed to compact, size-bounded chunks for the analysis info
+    unmatched = CompactIqmWriter(
+        bids_app_context.output_dir,
+        max_chunk_bytes=(gear_context.config.get("gear-metadata-chunk-kb") or DEFAULT_CHUNK_KB) * 1024,
+        digits=_iqm_digits(gear_context),
+    )
+    all_files = list(json_files or [])
+    # Scored over all of the run's scans (and the IQM store's), written with the IQMs
+    outliers = _score_outliers(gear_context, bids_app_context, all_files, harvester.index if harvester else archived)
+
+    # IQMs that were read back from Flywheel (gear-group-from-stored-iqms) or
+    # already sent by the harvester are already stored
+    done = set(getattr(bids_app_context, "reused_iqm_files", set()))
+    if harvester:
+        done.update(harvester.uploaded)
+    json_files = [f for f in all_files if Path(f) not in done]
+    # Those only need their outlier flags
+    flags_only = [f for f in all_files if Path(f) in done and Path(f).stem in outliers]
+
+    if json_files or flags_only:
+        # One lookup of the Flywheel files for the whole run
+        bids_index = build_bids_file_index(
+            iter_associated_bids_files(gear_context, parent_ids=batch_session_ids(bids_app_context))
+        )
         for json_file in json_files:
-            log.debug(f"Parsing {json_file}")
-            json_data = _parse_json_file(json_file)
-
-            bids_acquisitions = find_associated_bids_acqs(gear_context)
-            try:
-                fw_parent, fw_file = filter_fw_files(Path(json_file).stem, bids_acquisitions)
-                if fw_file:
-                    _update_fw_file(fw_file, json_data)
-                else:
-                    _add_metadata_to_upload(metadata_to_upload, json_file, json_data)
-            except TypeError:
+            if harvester and json_file in harvester.index:
+                json_data = harvester.index[json_file]
+            elif archived and json_file in archived:
+                json_data = archived[json_file]
+            else:
+                log.debug(f"Parsing {json_file}")
+                json_data = _parse_json_file(json_file)
+
+            fw_file = filter_fw_files(Path(json_file).stem, bids_index)
+            if fw_file:
+                file_updates.append((fw_file, json_data, outliers.get(Path(json_file).stem)))
+            else:
                 log.info(
-                    f"find_fw_file did not return any matching, " f"analyzed acquisitions for {Path(json_file).stem}"
+                    f"filter_fw_files did not return any matching, " f"analyzed acquisitions for {Path(json_file).stem}"
                 )
+                _add_metadata_to_upload(unmatched, json_file, json_data, outliers.get(Path(json_file).stem))
+        for json_file in flags_only:
+            fw_file = filter_fw_files(Path(json_file).stem, bids_index)
+            if fw_file:
+                file_updates.append((fw_file, None, outliers[Path(json_file).stem]))
+
+    unmatched.close()
+    if unmatched.records:
+        _add_compact_metadata(metadata_to_upload, unmatched)
+
+    write_stats = [harvester.stats] if harvester and harvester.stats else []
+    if file_updates:
+        write_stats.extend(_apply_file_updates(gear_context, file_updates, metadata_to_upload))
 
     if metadata_to_upload:
-        _upload_metrics(bids_app_context, metadata_to_upload)
+        _upload_metrics(gear_context, bids_app_context, metadata_to_upload)
 
+    log_phase_stats(write_stats)
 
-def find_associated_bids_acqs(gear_context) -> List:
-    """Search BIDS-related acquisitions from whichever level the gear is launched.
 
-    This method helps address project-level analyses by BIDS app gears.
-    Currently UNTESTED; may need to use `gear_context.get_parent_destination`
-    and a gear_context-based `iter_find` in order to be able to test.
-    The mock for `fw.acquisitions.iter_find` has been elusive when developing
-    bids-qsiprep and specific testing within this toolkit.
+def _apply_file_updates(gear_context: GearToolkitContext, file_updates: list, metadata_to_upload: dict) -> list:
+    """Send the IQMs to the scans' file info in as few writes as possible.
+
+    Files that belong to the acquisition the gear was launched from can be
+    updated by the engine from the single .metadata.json written at the end of
+    the run. All other files are updated through the API by a bounded,
+    retrying pool of workers.
 
     Args:
-        gear_context (gear_toolkit.GearToolkitContext): flywheel gear context
+        gear_context (GearToolkitContext): gear context
+        file_updates (list): (BidsFileRef, json_data, outliers) for each matched
+                    scan; json_data is None when only the outlier flags are written
+        metadata_to_upload (dict): engine metadata (.metadata.json) being built
 
     Returns:
-        bids_acqs (List): list of acquisition objects
+        write_stats (list): PhaseStats for each way the updates were written
     """
-    fw = Client(gear_context.get_input("api-key")["key"])
-    destination = fw.get(gear_context.destination["id"])
-    # Look up the acquisitions using the parent_id so that
-    # all the files for the gear launch level are found, but
-    # not more. i.e., don't find all the project files, if
-    # the gear was launched for acquisition or subject.
-    parent_id = destination.parents[destination.parent.type]
-
-    # `iter_find` syntax should be 'subject=some_value'. Deviating
-    # is likely to return none, since the quotes and syntax is so strict.
-    acq_list = fw.acquisitions.iter_find(f"{destination.parent.type}={parent_id}")
-    bids_acqs = []
-    # acq_list is a list of FW objects.
-    # The FW objects will most likely be project, subject, or acquisition
-    for acq in acq_list:
-        if "ignore-BIDS" in acq.label:
-            continue
-        for f in acq.files:
-            if f.info.get("BIDS") and "nii" in f.name:
-                bids_acqs.append(acq)
-    return bids_acqs
+    fw = _get_client(gear_context)
+    engine_acq_id = _get_engine_acquisition_id(gear_context)
+    digits = _iqm_digits(gear_context)
+    engine_files = []
+    api_tasks = []
+    for fw_file, json_data, outliers in file_updates:
+        if engine_acq_id and fw_file.acquisition_id == engine_acq_id:
+            engine_files.append({"name": fw_file.name, "info": _file_info(json_data, outliers, digits)})
+        else:
+            api_tasks.append((fw_file.name, partial(_update_fw_file, fw, fw_file, json_data, outliers, digits)))
+
+    write_stats = []
+    if engine_files:
+        metadata_to_upload.setdefault("acquisition", {}).setdefault("files", []).extend(engine_files)
+        write_stats.append(PhaseStats("engine-metadata", writes=len(engine_files)))
+    if api_tasks:
+        log.info(f"Updating IQMs on {len(api_tasks)} files through the API.")
+        write_stats.append(
+            run_update_pool(
+                api_tasks,
+                "file-info",
+                max_workers=gear_context.config.get("gear-metadata-workers") or 4,
+            )
+        )
+    return write_stats
+
+
+def _get_engine_acquisition_id(gear_context: GearToolkitContext):
+    """Id of the acquisition whose files the engine can update from .metadata.json.
+
+    Only the containers in the hierarchy of the analysis are addressable by the
+    engine; files of other acquisitions must be updated through the API.
+    """
+    destination = _get_client(gear_context).get(gear_context.destination["id"])
+    if destination.parent.type == "acquisition":
+        return destination.parent.id
+    return None
 
 
-def _add_metadata_to_upload(metadata_to_upload: dict, json_file: str, json_data: dict):
-    metadata_dict = _create_nested_metadata(json_data)
-    metadata_dict["filename"] = Path(json_file).stem
-    metadata_to_upload["IQM"].append(metadata_dict)
+def iter_associated_bids_files(
+    gear_context,
+    page_size: int = VIEW_PAGE_SIZE,
+    parent_ids: Optional[List[str]] = None,
+    with_iqms: bool = False,
+) -> Iterator[BidsFileRef]:
+    """Stream the BIDS NIfTI files from whichever level the gear is launched.
 
+    The acquisitions and their full file and info blobs are never loaded. A
+    data view asks the API for only the columns needed to match IQMs to files,
+    restricted to NIfTI files on the server. Rows are read lazily, one page at a time, so the memory used does
+    not grow with the size of the project.
 
-def _create_nested_metadata(data_to_parse):
+    Args:
+        gear_context (gear_toolkit.GearToolkitContext): flywheel gear context
+        page_size (int): number of rows requested from the API per call
+        parent_ids (List, optional): containers to read instead of the launch
+                    container, e.g., the sessions of gear-batch-sessions
+        with_iqms (bool): also read the IQMs stored on each file by earlier runs
+
+    Yields:
+        BidsFileRef: one per BIDS-curated NIfTI file, without duplicates
+    """
+    fw = _get_client(gear_context)
+    if not parent_ids:
+        destination = fw.get(gear_context.destination["id"])
+        parent_ids = [destination.parents[destination.parent.type]]
+
+    columns = [
+        ("acquisition.id", "acquisition_id"),
+        ("acquisition.label", "acquisition_label"),
+        ("file.file_id", "file_id"),
+        ("file.name", "name"),
+        ("file.info.BIDS.Filename", "bids_filename"),
+    ]
+    if with_iqms:
+        columns.append(("file.info.IQM", "iqms"))
+    view = fw.View(
+        container="acquisition",
+        filename="*.nii*",
+        match="all",
+        process_files=False,
+        include_ids=False,
+        include_labels=False,
+        columns=columns,
+    )
+
+    for parent_id in parent_ids:
+        skip = 0
+        # Rows arrive grouped by acquisition, so remembering the files of the
+        # current acquisition is enough to drop duplicates.
+        current_acq, seen = None, set()
+        while True:
+            rows = 0
+            stream = fw.read_view_data(view, parent_id, format="ndjson", skip=skip, limit=page_size)
+            try:
+                for line in stream:
+                    if not line.strip():
+                        continue
+                    rows += 1
+                    row = json.loads(line)
+                    if not row.get("bids_filename") or "ignore-BIDS" in (row.get("acquisition_label") or ""):
+                        continue
+                    if row["acquisition_id"] != current_acq:
+                        current_acq, seen = row["acquisition_id"], set()
+                    if row["name"] in seen:
+                        continue
+                    seen.add(row["name"])
+                    yield BidsFileRef(
+                        row["acquisition_id"],
+                        row.get("acquisition_label") or "",
+                        row.get("file_id") or "",
+                        row["name"],
+                        row["bids_filename"],
+                        row.get("iqms"),
+                    )
+            finally:
+                stream.close()
+            if rows < page_size:
+                break
+            skip += rows
+
+
+def _get_client(gear_context) -> "Client":
+    """Flywheel client for the api-key input, created once per run."""
+    return _client_for_key(gear_context.get_input("api-key")["key"])
+
+
+@lru_cache(maxsize=None)
+def _client_for_key(api_key: str) -> "Client":
+    # The SDK is imported on first use, not when the gear starts
+    from flywheel import Client
+
+    return Client(api_key)
+
+
+def _add_metadata_to_upload(writer: CompactIqmWriter, json_file: str, json_data: dict, outliers: dict = None):
+    writer.add(Path(json_file).stem, _create_nested_metadata(json_data), outliers)
+
+
+def _add_compact_metadata(metadata_to_upload: dict, writer: CompactIqmWriter):
+    """Put the unmatched scans' IQMs in the analysis info.
+
+    A single chunk goes in as is (see `iqm_encoding.decode_records`). Larger
+    sets stay in the chunk files, which are uploaded with the analysis, and the
+    analysis info lists them.
+    """
+    if len(writer.chunks) == 1:
+        with open(writer.chunks[0]) as fp:
+            iqm_info = json.load(fp)
+        writer.chunks[0].unlink()
+    else:
+        iqm_info = writer.summary()
+    metadata_to_upload.setdefault("analysis", {}).setdefault("info", {})["IQM"] = iqm_info
+    log.info(
+        f"Encoded the IQMs of {writer.records} unmatched scans in {writer.encoded_bytes / 1024:.0f} KB "
+        f"({len(writer.chunks)} chunk(s)), {writer.ratio:.1f}x smaller than {writer.raw_bytes / 1024:.0f} KB "
+        "at full precision"
+    )
+
+
+def _iqm_digits(gear_context) -> Optional[int]:
+    """Significant digits of the IQMs sent to Flywheel (gear-iqm-precision); None for full precision."""
+    return gear_context.config.get("gear-iqm-precision", DEFAULT_DIGITS) or None
+
+
+def _create_nested_metadata(data_to_parse, digits: Optional[int] = None):
     """
     Sift through the json files that correspond with different types of scans. Keep the
     fields associated with IQMs for MRIQC. Reorder the fields for export to
     metadata.json
     Args:
         data_to_parse (dict): converted from original analyses' output json summaries
+        digits (int, optional): significant digits to round floats to
     Returns:
         add_metadata (dict): dictionary to append to metadata under the analysis >
         info > sorting_classifier (filename) entry
@@ -140,7 +379,7 @@ def _create_nested_metadata(data_to_parse):
             add_metadata[k] = v
     # Should be roughly 68 metrics. See https://mriqc.readthedocs.io/en/latest/measures.html
     log.debug(f"Passing {len(add_metadata)} IQM items to metadata.")
-    return add_metadata
+    return round_floats(add_metadata, digits)
 
 
 def _find_output_files(analysis_output_dir, ext):
@@ -184,16 +423,53 @@ def _parse_json_file(json_file: str) -> dict:
     return json_data
 
 
-def _update_fw_file(fw_file: flywheel.FileEntry, json_data: dict):
+def _file_info(json_data: Optional[dict], outliers: Optional[dict] = None, digits: Optional[int] = None) -> dict:
+    """File info to set: the IQMs and/or their outlier flags."""
+    info = {}
+    if json_data is not None:
+        info["IQM"] = _create_nested_metadata(json_data, digits)
+    if outliers is not None:
+        info["IQM_outliers"] = outliers
+    return info
+
+
+def _update_fw_file(
+    fw: "Client",
+    fw_file: BidsFileRef,
+    json_data: Optional[dict],
+    outliers: Optional[dict] = None,
+    digits: Optional[int] = None,
+):
     """Add the metadata to the system"""
-    fw_file.update_info({"IQM": _create_nested_metadata(json_data)})
+    info = _file_info(json_data, outliers, digits)
+    fw.modify_acquisition_file_info(fw_file.acquisition_id, fw_file.name, {"set": info})
     log.info(f"Updated {fw_file.name}")
 
 
-def _upload_metrics(app_context, metadata_to_upload):
-    """Push MRIQC metrics an output JSON."""
-    # Save the .metadata.json
-    with open(f"{app_context.output_dir}/.metadata.json", "w") as fff:
-        json.dump(metadata_to_upload, fff)
+def _score_outliers(gear_context, app_context, json_files: list, loaded: Optional[dict]) -> dict:
+    """Outlier flags of the run's scans by bids_name (gear-outlier-threshold; 0 turns them off).
+
+    When the run keeps an IQM store, the project's earlier scans are part of the population.
+    """
+    # Imported when needed: outliers brings in numpy, and the store its table modules
+    from fw_gear_bids_mriqc.utils.iqm_store import STORE_NAME
+    from fw_gear_bids_mriqc.utils.outliers import DEFAULT_THRESHOLD, score_outliers
+
+    threshold = gear_context.config.get("gear-outlier-threshold", DEFAULT_THRESHOLD)
+    if not threshold or not json_files:
+        return {}
+    store_path = Path(app_context.output_dir) / STORE_NAME
+    return score_outliers(json_files, threshold, loaded=loaded, store_path=store_path if store_path.exists() else None)
+
+
+def _upload_metrics(gear_context, app_context, metadata_to_upload):
+    """Push MRIQC metrics to the engine's .metadata.json.
+
+    The entries are merged into the gear context's metadata, which is written
+    once, when the gear context exits. Writing the file here would be
+    overwritten by that final write.
+    """
+    for container_type, update in metadata_to_upload.items():
+        gear_context.metadata.update_container(container_type, **update)
     log.debug(f"Metadata = \n{metadata_to_upload}")
-    log.info(f"Wrote {app_context.output_dir}/.metadata.json")
+    log.info(f"Added IQMs to {app_context.output_dir}/.metadata.json")
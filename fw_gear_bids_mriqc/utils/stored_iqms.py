@@ -0,0 +1,87 @@
+"""Rebuild MRIQC participant outputs from the IQMs stored on Flywheel files by earlier runs."""
+
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
+from flywheel_gear_toolkit import GearToolkitContext
+
+from fw_gear_bids_mriqc.utils.batch import batch_session_ids
+from fw_gear_bids_mriqc.utils.bids_entities import bids_key, parse_bids_entities
+from fw_gear_bids_mriqc.utils.store_iqms import build_bids_file_index, iter_associated_bids_files
+
+log = logging.getLogger(__name__)
+
+# Suffixes summarized by the MRIQC group level
+GROUP_SUFFIXES = ("T1w", "T2w", "bold")
+
+
+def iter_local_scans(bids_dir: Path, participants: Optional[List[str]] = None) -> Iterator[Path]:
+    """NIfTI files in the downloaded BIDS tree that MRIQC computes IQMs for.
+
+    Args:
+        bids_dir (Path): downloaded BIDS dataset
+        participants (List, optional): restrict to these labels (no "sub-")
+
+    Yields:
+        path to each NIfTI file
+    """
+    for nifti in sorted(Path(bids_dir).glob("sub-*/**/*.nii*")):
+        entities = parse_bids_entities(nifti.name)
+        if entities.get("suffix") not in GROUP_SUFFIXES:
+            continue
+        if participants and entities.get("sub") not in participants:
+            continue
+        yield nifti
+
+
+def materialize_stored_iqms(
+    gear_context: GearToolkitContext, app_context: BIDSAppContext, participants: Optional[List[str]] = None
+) -> List[str]:
+    """Write the stored IQMs where MRIQC's group level expects the participant JSONs.
+
+    Each scan's IQMs go to `<analysis_output_dir>/sub-X/[ses-Y/]<datatype>/<scan>.json`,
+    mirroring the scan's place in the BIDS tree. The paths that were written are
+    kept on `app_context.reused_iqm_files`, so that `store_iqms` does not write
+    the same IQMs back to Flywheel.
+
+    Args:
+        gear_context (GearToolkitContext): gear context
+        app_context (BIDSAppContext): information specific to this BIDS app and gear run
+        participants (List, optional): restrict to these labels (no "sub-")
+
+    Returns:
+        missing (List): participants with at least one scan without stored IQMs
+    """
+    start = time.perf_counter()
+    scans = list(iter_local_scans(app_context.bids_dir, participants))
+    # The IQMs come with the pages of the data view, not one API call per file
+    bids_index = build_bids_file_index(
+        iter_associated_bids_files(gear_context, parent_ids=batch_session_ids(app_context), with_iqms=True)
+    )
+    refs = {scan: bids_index.get(bids_key(scan.name)) for scan in scans}
+
+    # Filled as the files are written, so that a running IqmHarvester can skip them
+    missing, written = set(), set()
+    app_context.reused_iqm_files = written
+    for scan, ref in refs.items():
+        iqms = ref.iqms if ref else None
+        if not iqms:
+            missing.add(parse_bids_entities(scan.name)["sub"])
+            continue
+        rel_path = scan.relative_to(app_context.bids_dir)
+        json_file = Path(app_context.analysis_output_dir) / rel_path.parent / (scan.name.split(".nii")[0] + ".json")
+        json_file.parent.mkdir(parents=True, exist_ok=True)
+        written.add(json_file)
+        with open(json_file, "w") as fp:
+            json.dump(iqms, fp, indent=2)
+
+    log.info(
+        f"Reused stored IQMs for {len(written)} of {len(scans)} scans; "
+        f"{len(missing)} participant(s) still need a participant-level run "
+        f"({time.perf_counter() - start:.1f}s)."
+    )
+    return sorted(missing)
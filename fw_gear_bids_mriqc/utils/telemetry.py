@@ -0,0 +1,202 @@
+"""Sample CPU, memory, and I/O of the MRIQC process tree from /proc."""
+
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Union
+
+log = logging.getLogger(__name__)
+
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_MB = (os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096) / 1024**2
+COLUMNS = ["time", "procs", "cpu_pct", "rss_mb", "pss_mb", "read_mb", "write_mb", "open_files", "threads"]
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as fp:
+            return fp.read()
+    except OSError:
+        # The process exited, or we may not look at it
+        return None
+
+
+def _parse_stat(pid: int) -> Optional[Dict]:
+    """ppid, cpu ticks (utime + stime), threads, and rss pages from /proc/<pid>/stat."""
+    stat = _read(f"/proc/{pid}/stat")
+    if not stat:
+        return None
+    # The command name may contain spaces; the fields after it do not
+    fields = stat[stat.rfind(")") + 2 :].split()
+    return {
+        "ppid": int(fields[1]),
+        "ticks": int(fields[11]) + int(fields[12]),
+        "threads": int(fields[17]),
+        "rss_mb": int(fields[21]) * PAGE_MB,
+    }
+
+
+def _pss_mb(pid: int) -> float:
+    rollup = _read(f"/proc/{pid}/smaps_rollup") or ""
+    for line in rollup.splitlines():
+        if line.startswith("Pss:"):
+            return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _io_mb(pid: int) -> Dict[str, float]:
+    values = {}
+    for line in (_read(f"/proc/{pid}/io") or "").splitlines():
+        key, _, value = line.partition(":")
+        values[key] = int(value)
+    return {"read_mb": values.get("read_bytes", 0) / 1024**2, "write_mb": values.get("write_bytes", 0) / 1024**2}
+
+
+def _open_files(pid: int) -> int:
+    try:
+        return len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        return 0
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(round(pct / 100 * (len(ordered) - 1)))] if ordered else 0.0
+
+
+class ProcessTreeSampler:
+    """Background thread that samples every descendant of a process.
+
+    Each sample sums the tree's CPU use (percent of one core), resident and
+    proportional memory, cumulative disk I/O (including processes that have
+    already exited), open files, and threads. The root process itself is left
+    out, so sampling the gear's own pid measures everything it launches.
+    """
+
+    def __init__(self, root_pid: int, interval: float = 10.0):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.samples: List[Dict] = []
+        self._ticks: Dict[int, int] = {}
+        self._io: Dict[int, Dict[str, float]] = {}
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+
+    def _descendants(self, stats: Dict[int, Dict]) -> Set[int]:
+        children = {}
+        for pid, stat in stats.items():
+            children.setdefault(stat["ppid"], []).append(pid)
+        tree, stack = set(), [self.root_pid]
+        while stack:
+            for child in children.get(stack.pop(), []):
+                tree.add(child)
+                stack.append(child)
+        return tree
+
+    def sample(self) -> Dict:
+        now = time.monotonic()
+        stats = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                stat = _parse_stat(int(entry))
+                if stat:
+                    stats[int(entry)] = stat
+        tree = self._descendants(stats)
+
+        elapsed = now - self._last if self._last else None
+        cpu_ticks = 0
+        for pid in tree:
+            ticks = stats[pid]["ticks"]
+            cpu_ticks += ticks - self._ticks.get(pid, 0)
+            self._ticks[pid] = ticks
+            self._io[pid] = _io_mb(pid)
+        self._last = now
+
+        row = {
+            "time": round(time.time(), 1),
+            "procs": len(tree),
+            "cpu_pct": round(100 * cpu_ticks / CLK_TCK / elapsed, 1) if elapsed else 0.0,
+            "rss_mb": round(sum(stats[pid]["rss_mb"] for pid in tree), 1),
+            "pss_mb": round(sum(_pss_mb(pid) for pid in tree), 1),
+            "read_mb": round(sum(io["read_mb"] for io in self._io.values()), 1),
+            "write_mb": round(sum(io["write_mb"] for io in self._io.values()), 1),
+            "open_files": sum(_open_files(pid) for pid in tree),
+            "threads": sum(stats[pid]["threads"] for pid in tree),
+        }
+        self.samples.append(row)
+        return row
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.sample()
+            except Exception as exc:  # never take the run down with the sampler
+                log.debug(f"Telemetry sample failed: {exc}")
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self) -> "ProcessTreeSampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self) -> Dict:
+        """Peak and percentile values over the run, for right-sizing future launches."""
+        if not self.samples:
+            return {}
+        summary = {
+            "interval_s": self.interval,
+            "samples": len(self.samples),
+            "duration_s": round(self.samples[-1]["time"] - self.samples[0]["time"], 1),
+        }
+        for column in ["cpu_pct", "rss_mb", "pss_mb", "open_files", "threads", "procs"]:
+            values = [s[column] for s in self.samples]
+            summary[column] = {
+                "peak": max(values),
+                "p50": _percentile(values, 50),
+                "p95": _percentile(values, 95),
+            }
+        summary["read_mb"] = self.samples[-1]["read_mb"]
+        summary["write_mb"] = self.samples[-1]["write_mb"]
+        return summary
+
+
+def start_telemetry(config: Dict) -> Optional[ProcessTreeSampler]:
+    """Sample everything launched by the gear, every `gear-telemetry-interval` seconds (0 turns it off)."""
+    interval = float(config.get("gear-telemetry-interval") or 0)
+    if interval <= 0 or not Path("/proc/self/stat").exists():
+        return None
+    return ProcessTreeSampler(os.getpid(), interval).start()
+
+
+def write_telemetry(sampler: ProcessTreeSampler, output_dir: Union[Path, str], prefix: str) -> Dict:
+    """Stop sampling; write <prefix>_telemetry.tsv (time series) and _telemetry.json (summary).
+
+    Returns:
+        summary (Dict): peaks and percentiles, also suitable for the analysis info
+    """
+    sampler.stop()
+    summary = sampler.summary()
+    stem = Path(output_dir) / f"{prefix}_telemetry"
+    with open(f"{stem}.tsv", "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=COLUMNS, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(sampler.samples)
+    with open(f"{stem}.json", "w") as fp:
+        json.dump(summary, fp, indent=2)
+    if summary:
+        log.info(
+            f"Resource use: peak {summary['cpu_pct']['peak']:.0f}% CPU "
+            f"(p95 {summary['cpu_pct']['p95']:.0f}%), peak RSS {summary['rss_mb']['peak'] / 1024:.1f} GB "
+            f"(PSS {summary['pss_mb']['peak'] / 1024:.1f} GB), read {summary['read_mb'] / 1024:.1f} GB, "
+            f"wrote {summary['write_mb'] / 1024:.1f} GB"
+        )
+    return summary
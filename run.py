@@ -6,24 +6,29 @@ import os
 import sys
 import shutil
 import tempfile
-#
-from flywheel_bids.flywheel_bids_app_toolkit import BIDSAppContext
 
+# Installed before the other imports, so that their cost is in the startup report
+from fw_gear_bids_mriqc.utils.startup import ImportTimer
+
+import_timer = ImportTimer.install()
+
+#
 # This design with the main interfaces separated from a gear module (with main and
 # parser) allows the gear module to be publishable, so it can then be imported in
 # another project, which enables chaining multiple gears together.
-from flywheel_bids.flywheel_bids_app_toolkit.commands import generate_bids_command
-from flywheel_bids.flywheel_bids_app_toolkit.hpc_utils import check_and_link_dirs, remove_tmp_dir
-from flywheel_bids.flywheel_bids_app_toolkit.report import package_output, save_metadata
-from flywheel_bids.flywheel_bids_app_toolkit.utils.helpers import check_bids_dir
-from flywheel_bids.flywheel_bids_app_toolkit.utils.query_flywheel import get_fw_details
-from flywheel_gear_toolkit import GearToolkitContext
-
-from fw_gear_bids_mriqc.main import customize_bids_command, setup_bids_env, run_bids_algo
-from fw_gear_bids_mriqc.parser import parse_config, parse_input_files
-from fw_gear_bids_mriqc.utils.dry_run import pretend_it_ran
-from fw_gear_bids_mriqc.utils.helpers import analyze_participants, extra_post_processing, validate_setup
-from fw_gear_bids_mriqc.utils.singularity import run_in_tmp_dir
+# Only what validation needs is imported here; the rest is imported once the gear
+# knows which path it takes, so early exits and dry runs don't pay for it.
+from flywheel_bids.flywheel_bids_app_toolkit.hpc_utils import check_and_link_dirs  # noqa: E402
+from flywheel_gear_toolkit import GearToolkitContext  # noqa: E402
+
+from fw_gear_bids_mriqc.utils.archived_runs import MRIQCAppContext  # noqa: E402
+from fw_gear_bids_mriqc.utils.helpers import (  # noqa: E402
+    analyze_participants,
+    extra_post_processing,
+    reuse_stored_iqms,
+    validate_setup,
+)
+from fw_gear_bids_mriqc.utils.singularity import configured_writable_dir, run_in_tmp_dir  # noqa: E402
 
 log = logging.getLogger(__name__)
 
@@ -56,10 +61,21 @@ def main(gear_context: GearToolkitContext) -> None:
     # with bids_app_context, directories, and performance settings.
     # While mirroring GTK context, this object is specifically for
     # BIDS apps and contains the building blocks for command execution.
-    app_context = BIDSAppContext(gear_context)
+    # (MRIQCAppContext only extracts what post-processing needs from archived_runs.)
+    app_context = MRIQCAppContext(gear_context)
 
     validate_setup(gear_context, app_context)
 
+    # Querying Flywheel, downloading, and building the command
+    from flywheel_bids.flywheel_bids_app_toolkit.commands import generate_bids_command
+    from flywheel_bids.flywheel_bids_app_toolkit.report import save_metadata
+    from flywheel_bids.flywheel_bids_app_toolkit.utils.helpers import check_bids_dir
+    from flywheel_bids.flywheel_bids_app_toolkit.utils.query_flywheel import get_fw_details
+
+    from fw_gear_bids_mriqc.main import customize_bids_command, run_bids_algo, setup_bids_env
+    from fw_gear_bids_mriqc.parser import parse_config, parse_input_files
+    from fw_gear_bids_mriqc.utils.packaging import package_output
+
     # Make sure that all the BIDS app directories are writable (for HPC)
     # check_and_link_dirs also checks/updates FreeSurfer before setup_bids_env
     check_and_link_dirs(gear_context)
@@ -101,12 +117,20 @@ def main(gear_context: GearToolkitContext) -> None:
             # specific ways that this BIDS app is called.
             command = customize_bids_command(command, config_options)
 
+        if getattr(app_context, "batch_members", None):
+            from fw_gear_bids_mriqc.utils.batch import batch_command
+
+            # All the sessions of the batch in this one MRIQC run
+            command = batch_command(command, app_context.batch_members)
+
         # Section 3
         if len(errors) > 0:
             e_code = 1
             log.info(f"{app_context.bids_app_binary} was NOT run because of previous errors.")
 
         elif app_context.gear_dry_run:
+            from fw_gear_bids_mriqc.utils.dry_run import pretend_it_ran
+
             e_code = 0
             pretend_it_ran(app_context, command)
             save_metadata(
@@ -119,13 +143,49 @@ def main(gear_context: GearToolkitContext) -> None:
             log.warning(e)
 
         else:
+            from fw_gear_bids_mriqc.utils.checkpoint import start_checkpoints
+            from fw_gear_bids_mriqc.utils.iqm_watcher import start_iqm_harvester
+            from fw_gear_bids_mriqc.utils.slurm import fan_out_to_slurm
+            from fw_gear_bids_mriqc.utils.staging import stage_work_dir
+            from fw_gear_bids_mriqc.utils.telemetry import start_telemetry, write_telemetry
+
+            # On Slurm, participants and the group summaries can be submitted as
+            # separate jobs instead of all running within this one
+            fan_out = destination.parent.type == "project" and gear_context.config.get("gear-slurm-fanout")
+
+            # Resume from the checkpoint of a preempted run of this container, and keep
+            # checkpointing; nipype's cached results need the work dir at the same path
+            checkpoints = (
+                None if fan_out else start_checkpoints(gear_context.config, app_context, command, destination.parent.id)
+            )
+            # nipype's many small files go to a RAM disk or node-local scratch, when
+            # there is room; Slurm tasks on other nodes need the shared work dir
+            stage = None if fan_out or checkpoints else stage_work_dir(gear_context.config, app_context, command)
+            if checkpoints and (gear_context.config.get("gear-work-dir-staging") or "off") != "off":
+                log.warning("Checkpointing keeps the work directory in place; gear-work-dir-staging is ignored.")
+            if stage:
+                command = stage.command_with_work_dir(command)
+            # Send IQMs to Flywheel as MRIQC writes them. Outputs written by other
+            # nodes are only visible by polling.
+            harvester = start_iqm_harvester(gear_context, app_context, polling=fan_out)
+            # CPU, memory, and I/O of everything the run launches, for right-sizing
+            telemetry = start_telemetry(gear_context.config)
+            e_code = 1
             try:
                 # Pass the args, kwargs to fw_gear_qsiprep.main.run function to execute
                 # the main functionality of the gear.
 
                 # Start with running all participants, if at the group level
                 if destination.parent.type == "project":
-                    e_code = analyze_participants(app_context, command)
+                    if not fan_out:
+                        participant_command = command
+                        if gear_context.config.get("gear-group-from-stored-iqms"):
+                            participant_command = reuse_stored_iqms(gear_context, app_context, command)
+                        e_code = 0
+                        if participant_command:
+                            e_code = analyze_participants(
+                                app_context, participant_command, gear_context.config, cache_key=destination.parent.id
+                            )
                     # Due to the bug, specify the modalities to summarize
                     # and pass the modified command to run_bids_algo
                     log.warning(
@@ -133,7 +193,7 @@ def main(gear_context: GearToolkitContext) -> None:
                         "Please wait for the next official release to fix "
                         "DWI summaries."
                     )
-                    command.extend(["-m", "T1w T2w bold"])
+                    command.extend(["-m", "T1w", "T2w", "bold"])
 
                 # matplotlib workaround for multiple runs on same hpc node
                 if 'MPLCONFIGDIR' not in os.environ or os.environ['MPLCONFIGDIR'].startswith('/home'):
@@ -143,13 +203,26 @@ def main(gear_context: GearToolkitContext) -> None:
                 # as originally specified by the command.
                 # This will run the group summaries, if 'group', or the participant
                 # analysis, if 'participant'
-                e_code = run_bids_algo(gear_context, app_context, command)
+                if fan_out:
+                    e_code = fan_out_to_slurm(app_context, command, gear_context.config)
+                else:
+                    e_code = run_bids_algo(gear_context, app_context, command)
 
             except RuntimeError as exc:
                 e_code = 1
                 errors.append(str(exc))
                 log.critical(exc)
                 log.exception("Unable to execute command.")
+            finally:
+                if checkpoints:
+                    checkpoints.finish(success=e_code == 0)
+                if stage:
+                    stage.sync_back()
+                if harvester:
+                    harvester.stop()
+                if telemetry:
+                    usage = write_telemetry(telemetry, app_context.output_dir, app_context.bids_app_binary)
+                    gear_context.metadata.update_container("analysis", info={"telemetry": usage})
 
     if e_code == 0:
         # Section 4
@@ -159,7 +232,7 @@ def main(gear_context: GearToolkitContext) -> None:
         # available for debugging.
         extra_post_processing(gear_context, app_context)
 
-        package_output(app_context, gear_name=gear_context.manifest["name"], errors=errors)
+        package_output(app_context, gear_name=gear_context.manifest["name"], errors=errors, config=gear_context.config)
 
     log.info("%s Gear is done.  Returning %s", gear_name_and_version, e_code)
 
@@ -169,15 +242,19 @@ def main(gear_context: GearToolkitContext) -> None:
 # Only execute if file is run as main, not when imported by another module
 if __name__ == "__main__":  # pragma: no cover
 
-    # move the singularity check inside one level where the centext is available to check which directory should be made /tmp
-    with GearToolkitContext() as gear_context:
-        scratch_dir = run_in_tmp_dir(gear_context.config["gear-writable-dir"])
+    # Check which directory should be made /tmp (Singularity). Only gear-writable-dir
+    # is read here, so the gear context below is created once, in the directory the
+    # gear runs in.
+    scratch_dir = run_in_tmp_dir(configured_writable_dir())
 
     # Get access to gear config, inputs, and sdk client if enabled.
-    with GearToolkitContext() as gear_context:
+    with import_timer.phase("context"):
+        gear_context = GearToolkitContext()
+    with gear_context:
         # Initialize logging, set logging level based on `debug` configuration
         # key in gear config.
         gear_context.init_logging()
+        import_timer.report()
 
         # Pass the gear context into main function defined above.
         return_code = main(gear_context)
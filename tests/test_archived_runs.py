@@ -0,0 +1,77 @@
+import json
+import zipfile
+
+from fw_gear_bids_mriqc.utils.archived_runs import (
+    extract_needed_members,
+    is_work_archive,
+    read_archived_iqms,
+    restore_archived_work,
+)
+
+
+def make_zip(path, members):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return path
+
+
+def test_restore_only_takes_the_work_dir_members(tmp_path):
+    archive = make_zip(
+        tmp_path / "bids-mriqc_work_proj_123.zip",
+        {
+            "README.txt": "not part of the work dir",
+            "work/mriqc_wf/node/result_node.pklz": b"pkl",
+            "work/../../escaped.txt": b"outside",
+            "other/file.txt": b"other",
+        },
+    )
+    dest = tmp_path / "restored"
+
+    assert restore_archived_work(archive, dest, "work") == 1
+
+    assert (dest / "mriqc_wf" / "node" / "result_node.pklz").read_bytes() == b"pkl"
+    assert not (tmp_path / "escaped.txt").exists()
+    assert not (dest / "file.txt").exists()
+
+
+def test_restore_empty_archive(tmp_path):
+    archive = make_zip(tmp_path / "empty.zip", {})
+
+    assert restore_archived_work(archive, tmp_path / "restored", "work") == 0
+
+
+def test_is_work_archive(tmp_path):
+    with zipfile.ZipFile(make_zip(tmp_path / "w.zip", {"work/a/result_a.pklz": b""})) as archive:
+        assert is_work_archive(archive, "work")
+        assert not is_work_archive(archive, "other")
+
+
+def test_post_processing_reads_only_what_it_needs(tmp_path):
+    iqms = {"cjv": 0.4, "provenance": {"version": "23.1.0"}}
+    archive_path = make_zip(
+        tmp_path / "run.zip",
+        {
+            "abc/dataset_description.json": "{}",
+            "abc/group_T1w.tsv": "bids_name\tcjv\n",
+            "abc/sub-01_T1w.html": "<html/>",
+            "abc/sub-01/figures/sub-01_T1w_mask.svg": "<svg/>",
+            "abc/sub-01/anat/sub-01_T1w.json": json.dumps(iqms),
+            "abc/sub-01/anat/sub-01_T1w.nii.gz": b"nifti",
+            "abc/sub-01/anat/sub-01_T2w.json": "",
+        },
+    )
+    unzip_dir = tmp_path / "run"
+
+    with zipfile.ZipFile(archive_path) as archive:
+        extracted = extract_needed_members(archive, unzip_dir)
+        loaded = read_archived_iqms(archive, unzip_dir)
+
+    assert sorted(extracted) == [
+        "abc/dataset_description.json",
+        "abc/group_T1w.tsv",
+        "abc/sub-01/figures/sub-01_T1w_mask.svg",
+        "abc/sub-01_T1w.html",
+    ]
+    assert loaded == {unzip_dir / "abc/sub-01/anat/sub-01_T1w.json": iqms}
+    assert not (unzip_dir / "abc/sub-01/anat").exists()
@@ -0,0 +1,104 @@
+import os
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import flywheel_bids.export_bids as export_bids
+
+from fw_gear_bids_mriqc.utils import bids_download
+from fw_gear_bids_mriqc.utils.bids_download import BlobCache, blob_key, materialize, parallel_bids_downloads
+
+MODIFIED = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class FakeClient:
+    """Writes the file name as its content and counts the downloads."""
+
+    def __init__(self):
+        self.downloads = 0
+
+    def download_file_from_acquisition(self, container_id, name, dest):
+        self.downloads += 1
+        with open(dest, "w") as fp:
+            fp.write(f"{container_id}/{name}")
+
+
+def test_blob_key_changes_with_the_file_version():
+    assert blob_key("acq", "T1w.nii.gz", "2024") == blob_key("acq", "T1w.nii.gz", "2024")
+    assert blob_key("acq", "T1w.nii.gz", "2024") != blob_key("acq", "T1w.nii.gz", "2025")
+    assert blob_key("acq", "a", None) != blob_key("acq", "b", None)
+
+
+def test_materialize_hard_links_the_blob(tmp_path):
+    blob = tmp_path / "blob"
+    blob.write_text("data")
+    dest = tmp_path / "sub-01_T1w.nii.gz"
+    dest.write_text("stale")
+
+    assert materialize(blob, dest) == "link"
+    assert dest.read_text() == "data"
+    assert os.path.samefile(blob, dest)
+
+
+def test_materialize_copies_across_filesystems_and_keeps_the_modified_time(tmp_path, monkeypatch):
+    blob = tmp_path / "blob"
+    blob.write_text("data")
+    os.utime(blob, (1_000_000, 1_000_000))
+    dest = tmp_path / "sub-01_T1w.nii.gz"
+
+    def cross_device(src, dst):
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", cross_device)
+
+    assert materialize(blob, dest) == "copy"
+    assert dest.read_text() == "data"
+    assert dest.stat().st_mtime == 1_000_000
+
+
+def test_second_download_comes_from_the_cache(tmp_path):
+    cache = BlobCache(tmp_path / "cache")
+    fw = FakeClient()
+    first, second = tmp_path / "run1.nii.gz", tmp_path / "run2.nii.gz"
+
+    assert bids_download._download(fw, "acquisition", ("acq", "T1w.nii.gz", str(first)), MODIFIED, cache) == (
+        "download"
+    )
+    assert bids_download._download(fw, "acquisition", ("acq", "T1w.nii.gz", str(second)), MODIFIED, cache) == "cache"
+    assert fw.downloads == 1
+    assert second.read_text() == "acq/T1w.nii.gz"
+    assert second.stat().st_mtime == MODIFIED.timestamp()
+    assert not list(cache.root.glob("*/*.tmp"))
+
+
+def test_sidecars_download_from_the_acquisition_without_a_cache(tmp_path):
+    fw = FakeClient()
+    dest = tmp_path / "sub-01_T1w.json"
+
+    assert bids_download._download(fw, "sidecar", ("acq", "T1w.json", str(dest)), None, None) == "direct"
+    assert dest.read_text() == "acq/T1w.json"
+
+
+def test_evict_removes_the_least_recently_used_blobs(tmp_path):
+    cache = BlobCache(tmp_path / "cache", max_gb=150 / 1024**3)
+    for age, key in enumerate(["aa01", "bb02", "cc03"]):
+        tmp = cache.tmp_path(key)
+        tmp.write_bytes(b"x" * 100)
+        cache.put(key, tmp)
+        os.utime(cache.path(key).with_suffix(".used"), (age, age))
+
+    evicted, remaining = cache.evict()
+
+    assert (evicted, remaining) == (2, 100)
+    assert [cache.get(key) is not None for key in ["aa01", "bb02", "cc03"]] == [False, False, True]
+
+
+def test_parallel_downloads_patch_and_restore_the_toolkit(tmp_path):
+    original = export_bids.download_bids_files
+    config = {"gear-download-workers": 4, "gear-download-cache-gb": 0}
+
+    with parallel_bids_downloads(SimpleNamespace(config=config), tmp_path):
+        assert export_bids.download_bids_files is not original
+    assert export_bids.download_bids_files is original
+
+    with parallel_bids_downloads(SimpleNamespace(config=dict(config, **{"gear-download-workers": 1})), tmp_path):
+        assert export_bids.download_bids_files is original
@@ -0,0 +1,45 @@
+from fw_gear_bids_mriqc.utils.bids_entities import bids_key, parse_bids_entities
+from fw_gear_bids_mriqc.utils.store_iqms import BidsFileRef, build_bids_file_index, filter_fw_files
+
+
+def test_parse_bids_entities():
+    assert parse_bids_entities("/out/sub-01/func/sub-01_ses-A_task-rest_run-1_bold.nii.gz") == {
+        "sub": "01",
+        "ses": "A",
+        "task": "rest",
+        "run": "1",
+        "suffix": "bold",
+    }
+
+
+def test_key_ignores_entity_order_and_extensions():
+    assert bids_key("sub-01_acq-fast_run-2_T1w.nii.gz") == bids_key("sub-01_run-2_acq-fast_T1w.json")
+
+
+def test_key_compares_labels_exactly():
+    assert bids_key("sub-01_run-1_bold") != bids_key("sub-01_run-10_bold")
+    assert bids_key("sub-01_echo-1_bold") != bids_key("sub-01_echo-2_bold")
+
+
+def test_key_needs_subject_and_suffix():
+    assert bids_key("dataset_description.json") is None
+    assert bids_key("sub-01_ses-A") is None
+
+
+def ref(file_id, bids_filename):
+    return BidsFileRef("acq-id", "acq", file_id, f"{file_id}.nii.gz", bids_filename)
+
+
+def test_iqm_files_match_their_scan():
+    t1w, bold_1, bold_10 = (
+        ref("t1w", "sub-01_ses-A_T1w.nii.gz"),
+        ref("bold1", "sub-01_ses-A_task-rest_run-1_bold.nii.gz"),
+        ref("bold10", "sub-01_ses-A_task-rest_run-10_bold.nii.gz"),
+    )
+    index = build_bids_file_index([t1w, bold_1, bold_10, ref("dup", "sub-01_ses-A_T1w.nii.gz"), ref("x", "")])
+
+    assert len(index) == 3
+    assert filter_fw_files("sub-01_ses-A_T1w", index) is t1w
+    assert filter_fw_files("sub-01_ses-A_task-rest_run-1_bold", index) is bold_1
+    assert filter_fw_files("sub-01_ses-A_task-rest_run-10_bold", index) is bold_10
+    assert filter_fw_files("sub-02_ses-A_T1w", index) is None
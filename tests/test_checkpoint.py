@@ -0,0 +1,105 @@
+import json
+import os
+from types import SimpleNamespace
+
+from fw_gear_bids_mriqc.utils.checkpoint import (
+    MANIFEST_NAME,
+    PASS_DIR,
+    PENDING_DIR,
+    REMOVED_NAME,
+    TREE,
+    WorkDirCheckpointer,
+    nipype_work_dir,
+    restore_checkpoint,
+)
+
+KEY = {"version": "MRIQC v23.1.0", "flags": ["--no-sub"], "source": "/work"}
+
+
+def _write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def test_sync_copies_changes_and_drops_removed_files(tmp_path):
+    source, checkpoint_dir = tmp_path / "work", tmp_path / "checkpoint"
+    _write(source / "wf" / "node" / "result.pklz", "one")
+    _write(source / "wf" / "old.txt", "old")
+    _write(source / "cache" / "skip.txt", "not checkpointed")
+    checkpointer = WorkDirCheckpointer(source, checkpoint_dir, 60, KEY, exclude=["cache"])
+
+    stats = checkpointer.sync(settle=0)
+    assert (stats.copied, stats.removed) == (2, 0)
+    assert (checkpoint_dir / TREE / "wf" / "node" / "result.pklz").read_text() == "one"
+    assert not (checkpoint_dir / TREE / "cache").exists()
+
+    (source / "wf" / "old.txt").unlink()
+    _write(source / "wf" / "new.txt", "new")
+    stats = checkpointer.sync(settle=0)
+    assert (stats.copied, stats.removed) == (1, 1)
+    assert sorted(p.name for p in (checkpoint_dir / TREE / "wf").iterdir()) == ["new.txt", "node"]
+    assert not (checkpoint_dir / PENDING_DIR).exists()
+    assert not (checkpoint_dir / PASS_DIR).exists()
+    manifest = json.loads((checkpoint_dir / MANIFEST_NAME).read_text())
+    assert manifest["files"] == 2 and manifest["version"] == KEY["version"]
+
+
+def test_sync_leaves_files_still_being_written(tmp_path):
+    source = tmp_path / "work"
+    _write(source / "busy.txt", "partial")
+    checkpointer = WorkDirCheckpointer(source, tmp_path / "checkpoint", 60, KEY)
+
+    stats = checkpointer.sync(settle=3600)
+
+    assert (stats.copied, stats.skipped) == (0, 1)
+
+
+def _checkpoint(checkpoint_dir, key=KEY):
+    _write(checkpoint_dir / TREE / "wf" / "result.pklz", "done")
+    (checkpoint_dir / MANIFEST_NAME).write_text(json.dumps(dict(key, files=1, updated="now")))
+
+
+def test_restore_checkpoint_made_for_the_same_run(tmp_path):
+    checkpoint_dir, source = tmp_path / "checkpoint", tmp_path / "work"
+    _checkpoint(checkpoint_dir)
+
+    assert restore_checkpoint(checkpoint_dir, source, KEY) == 1
+    assert (source / "wf" / "result.pklz").read_text() == "done"
+
+
+def test_a_checkpoint_for_another_run_is_discarded(tmp_path):
+    checkpoint_dir, source = tmp_path / "checkpoint", tmp_path / "work"
+    _checkpoint(checkpoint_dir)
+
+    assert restore_checkpoint(checkpoint_dir, source, dict(KEY, version="MRIQC v24.0.0")) == 0
+    assert not checkpoint_dir.exists()
+    assert not source.exists()
+
+
+def test_no_checkpoint_restores_nothing(tmp_path):
+    assert restore_checkpoint(tmp_path / "missing", tmp_path / "work", KEY) == 0
+
+
+def test_a_completed_pass_is_merged_and_an_incomplete_one_dropped(tmp_path):
+    checkpoint_dir, source = tmp_path / "checkpoint", tmp_path / "work"
+    _checkpoint(checkpoint_dir)
+    _write(checkpoint_dir / TREE / "wf" / "gone.txt", "removed by nipype")
+    _write(checkpoint_dir / PASS_DIR / TREE / "wf" / "late.txt", "complete pass")
+    (checkpoint_dir / PASS_DIR / REMOVED_NAME).write_text(json.dumps([os.path.join("wf", "gone.txt")]))
+    _write(checkpoint_dir / PENDING_DIR / TREE / "wf" / "half.txt", "incomplete pass")
+
+    restore_checkpoint(checkpoint_dir, source, KEY)
+
+    assert sorted(p.name for p in (source / "wf").iterdir()) == ["late.txt", "result.pklz"]
+    assert not (checkpoint_dir / PASS_DIR).exists()
+    assert not (checkpoint_dir / PENDING_DIR).exists()
+
+
+def test_nipype_work_dir():
+    app_context = SimpleNamespace(work_dir="/flywheel/v0/work")
+
+    assert str(nipype_work_dir(app_context, ["mriqc", "bids", "out", "participant"])) == "/flywheel/v0/work"
+    assert str(nipype_work_dir(app_context, ["mriqc", "bids", "out", "participant", "-w", "/scratch"])) == "/scratch"
+    assert str(nipype_work_dir(app_context, ["mriqc", "--work-dir=/scratch/w", "bids", "out", "participant"])) == (
+        "/scratch/w"
+    )
@@ -0,0 +1,41 @@
+import pytest
+
+from fw_gear_bids_mriqc.utils.command_options import has_option, pop_option, set_option, set_output_dir
+
+COMMAND = ["mriqc", "/bids", "/out", "participant", "--participant-label", "01", "02", "--nprocs=4", "-m", "T1w"]
+
+
+def test_has_option_in_either_form():
+    assert has_option(COMMAND, ["--n_procs", "--nprocs"])
+    assert has_option(COMMAND, ["--participant_label", "--participant-label"])
+    assert not has_option(COMMAND, ["--nprocs-extra", "--mem_gb"])
+
+
+def test_pop_option_returns_every_value():
+    command, labels = pop_option(COMMAND, ["--participant-label"])
+    assert labels == ["01", "02"]
+    assert command == ["mriqc", "/bids", "/out", "participant", "--nprocs=4", "-m", "T1w"]
+
+    command, nprocs = pop_option(COMMAND, ["--nprocs"])
+    assert nprocs == ["4"]
+    assert "--nprocs=4" not in command
+
+
+def test_pop_option_leaves_the_input_alone():
+    original = list(COMMAND)
+    pop_option(COMMAND, ["-m"])
+    assert COMMAND == original
+
+
+def test_set_option_replaces_the_previous_entry():
+    command = set_option(COMMAND, "--participant-label", "03")
+
+    assert command[-2:] == ["--participant-label", "03"]
+    assert command.count("--participant-label") == 1
+    assert set_option(["mriqc"], "--no-sub") == ["mriqc", "--no-sub"]
+
+
+def test_set_output_dir():
+    assert set_output_dir(COMMAND, "/units/sub-01/out")[:4] == ["mriqc", "/bids", "/units/sub-01/out", "participant"]
+    with pytest.raises(ValueError):
+        set_output_dir(["mriqc", "/bids", "/out"], "/new")
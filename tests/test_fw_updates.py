@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from fw_gear_bids_mriqc.utils import fw_updates
+from fw_gear_bids_mriqc.utils.fw_updates import MAX_RETRY_DELAY, PhaseStats, run_update_pool
+
+
+class ApiError(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.headers = headers
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    waits = []
+    monkeypatch.setattr(fw_updates.time, "sleep", waits.append)
+    return waits
+
+
+def flaky(failures):
+    """A write that raises each of `failures` in turn, then succeeds."""
+    remaining = list(failures)
+
+    def write():
+        if remaining:
+            raise remaining.pop(0)
+
+    return write
+
+
+def test_transient_errors_are_retried(no_sleep):
+    tasks = [("a", flaky([ApiError(429), ApiError(503)])), ("b", flaky([ConnectionResetError()])), ("c", flaky([]))]
+
+    stats = run_update_pool(tasks, "file-info", max_workers=2, backoff=0.01)
+
+    assert (stats.writes, stats.failures, stats.retries) == (3, 0, 3)
+    assert len(no_sleep) == 3
+
+
+def test_permanent_errors_fail_without_stopping_the_rest(caplog):
+    stats = run_update_pool([("bad", flaky([ApiError(404)])), ("good", flaky([]))], "file-info")
+
+    assert (stats.writes, stats.failures, stats.retries) == (1, 1, 0)
+    assert "Unable to update bad" in caplog.text
+
+
+def test_retries_give_up(no_sleep):
+    stats = run_update_pool([("a", flaky([ApiError(500)] * 10))], "file-info", max_retries=2, backoff=0.01)
+
+    assert (stats.writes, stats.failures, stats.retries) == (0, 1, 2)
+
+
+@pytest.mark.parametrize(
+    "retry_after, expected",
+    [("3", 3.0), ("86400", MAX_RETRY_DELAY), ("-5", 0.0), ("nan", MAX_RETRY_DELAY)],
+)
+def test_retry_after_is_honoured_within_bounds(retry_after, expected):
+    assert fw_updates._retry_delay(ApiError(429, {"Retry-After": retry_after}), 0, 0.5) == expected
+
+
+def test_backoff_is_capped():
+    assert fw_updates._retry_delay(ApiError(503), 30, 0.5) == MAX_RETRY_DELAY
+    assert 0.5 <= fw_updates._retry_delay(ApiError(503), 0, 0.5) <= 1.0
+
+
+def test_pool_is_bounded():
+    lock, running, peak = threading.Lock(), [0], [0]
+    release = threading.Event()
+
+    def write():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        release.wait(0.05)
+        with lock:
+            running[0] -= 1
+
+    run_update_pool([(str(i), write) for i in range(12)], "file-info", max_workers=3)
+
+    assert peak[0] <= 3
+
+
+def test_summary():
+    stats = PhaseStats("file-info", writes=3, latencies=[0.3, 0.1, 0.2])
+
+    summary = stats.summary()
+
+    assert summary["mean_latency"] == 0.2
+    assert summary["max_latency"] == 0.3
+    assert PhaseStats("empty").summary()["p95_latency"] == 0.0
@@ -0,0 +1,61 @@
+import json
+
+from fw_gear_bids_mriqc.utils.iqm_encoding import ENCODING, CompactIqmWriter, read_chunk, round_floats
+
+
+def test_round_floats_keeps_significant_digits_in_nested_values():
+    value = {"a": 3.14159265, "b": [0.000123456789, 2, "x"], "c": {"d": 123456.789}}
+
+    assert round_floats(value, 3) == {"a": 3.14, "b": [0.000123, 2, "x"], "c": {"d": 123000.0}}
+
+
+def test_round_floats_without_digits_keeps_the_value():
+    value = [1.23456789]
+
+    assert round_floats(value, None) is value
+    assert round_floats(value, 0) is value
+
+
+def test_records_round_trip(tmp_path):
+    anat = {"cjv": 0.123456789, "snr": 12.3456789}
+    func = {"fd_mean": 0.2, "tsnr": 45.678912}
+    with CompactIqmWriter(tmp_path, digits=4) as writer:
+        writer.add("sub-01_T1w", anat)
+        writer.add("sub-01_task-rest_bold", func, outliers={"tsnr": True})
+        writer.add("sub-02_T1w", anat)
+
+    assert [p.name for p in writer.chunks] == ["mriqc_iqm_metadata_001.json"]
+    chunk = json.loads(writer.chunks[0].read_text())
+    assert chunk["encoding"] == ENCODING
+    assert chunk["schemas"] == [["cjv", "snr"], ["fd_mean", "tsnr"]]
+    assert list(read_chunk(writer.chunks[0])) == [
+        {"cjv": 0.1235, "snr": 12.35, "filename": "sub-01_T1w"},
+        {"fd_mean": 0.2, "tsnr": 45.68, "filename": "sub-01_task-rest_bold", "IQM_outliers": {"tsnr": True}},
+        {"cjv": 0.1235, "snr": 12.35, "filename": "sub-02_T1w"},
+    ]
+    assert writer.summary()["scans"] == 3
+    assert writer.encoded_bytes == writer.chunks[0].stat().st_size
+    assert writer.ratio > 1
+
+
+def test_chunks_stay_under_the_size_limit(tmp_path):
+    iqms = {f"metric_{i}": i + 0.5 for i in range(20)}
+    with CompactIqmWriter(tmp_path, max_chunk_bytes=600, digits=None) as writer:
+        for n in range(10):
+            writer.add(f"sub-{n:02d}_T1w", iqms)
+
+    assert len(writer.chunks) > 1
+    names = []
+    for path in writer.chunks:
+        assert path.stat().st_size <= 600
+        names.extend(record["filename"] for record in read_chunk(path))
+    assert names == [f"sub-{n:02d}_T1w" for n in range(10)]
+
+
+def test_a_record_larger_than_the_limit_gets_its_own_chunk(tmp_path):
+    with CompactIqmWriter(tmp_path, max_chunk_bytes=50) as writer:
+        writer.add("sub-01_T1w", {f"metric_{i}": 1.0 for i in range(10)})
+        writer.add("sub-02_T1w", {"cjv": 1.0})
+
+    assert len(writer.chunks) == 2
+    assert [len(list(read_chunk(path))) for path in writer.chunks] == [1, 1]
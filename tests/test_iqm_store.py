@@ -0,0 +1,86 @@
+import json
+import math
+import sqlite3
+
+import pytest
+
+from fw_gear_bids_mriqc.utils.iqm_store import STORE_NAME, IqmStore, iter_store_records, update_iqm_store
+
+
+def write_iqms(out_dir, name, version="23.1.0", **iqms):
+    path = out_dir / name.split("_")[0] / "anat" / f"{name}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({**iqms, "provenance": {"version": version}, "bids_meta": {"EchoTime": 0.003}}))
+    return path
+
+
+def stats_by_name(store, modality="T1w"):
+    return {name: (n, mean, std) for _, name, n, mean, std in store.stats(modality)}
+
+
+def test_records_skip_unknown_suffixes(tmp_path):
+    t1w = write_iqms(tmp_path, "sub-01_ses-a_T1w", cjv=0.4)
+    mask = write_iqms(tmp_path, "sub-01_ses-a_mask", cjv=0.4)
+
+    [record] = iter_store_records([t1w, mask])
+
+    assert record["bids_name"] == "sub-01_ses-a_T1w"
+    assert record["modality"] == "T1w"
+    assert record["entities"]["ses"] == "a"
+    assert record["mriqc_version"] == "23.1.0"
+    assert record["iqms"]["cjv"] == 0.4
+
+
+def test_reanalysis_replaces_the_scan_and_its_statistics(tmp_path):
+    first = [write_iqms(tmp_path, f"sub-0{i}_T1w", cjv=v) for i, v in [(1, 0.2), (2, 0.4)]]
+    with IqmStore(tmp_path / STORE_NAME) as store:
+        assert store.upsert(iter_store_records(first), "analysis-1") == {"inserted": 2, "updated": 0, "unchanged": 0}
+
+        again = [write_iqms(tmp_path, "sub-01_T1w", cjv=0.6), first[1]]
+        assert store.upsert(iter_store_records(again), "analysis-2") == {"inserted": 0, "updated": 1, "unchanged": 1}
+
+        # Only the latest value of sub-01 is kept, in the rows and in the statistics
+        rows = {row["bids_name"]: json.loads(row["iqms"])["cjv"] for row in store.latest_scans("T1w")}
+        assert rows == {"sub-01_T1w": 0.6, "sub-02_T1w": 0.4}
+        n, mean, std = stats_by_name(store)["cjv"]
+        assert n == 2 and mean == pytest.approx(0.5) and std == pytest.approx(math.sqrt(0.02))
+        assert [row["bids_name"] for row in store.scans_from("T1w", "analysis-2")] == ["sub-01_T1w"]
+
+
+def test_another_mriqc_version_adds_a_row(tmp_path):
+    with IqmStore(tmp_path / STORE_NAME) as store:
+        store.upsert(iter_store_records([write_iqms(tmp_path, "sub-01_T1w", cjv=0.2)]))
+        store.upsert(iter_store_records([write_iqms(tmp_path, "sub-01_T1w", version="24.0.0", cjv=0.3)]))
+
+        assert store.conn.execute("SELECT COUNT(*) FROM scans").fetchone()[0] == 2
+        assert {version for version, *_ in store.stats("T1w")} == {"23.1.0", "24.0.0"}
+
+
+def test_update_iqm_store_writes_the_changed_scans(tmp_path):
+    out, work = tmp_path / "out", tmp_path / "work"
+    out.mkdir()
+    work.mkdir()
+    files = [write_iqms(tmp_path / "mriqc", "sub-01_T1w", cjv=0.2)]
+    first = update_iqm_store(files, out, work, "analysis-1")
+
+    files.append(write_iqms(tmp_path / "mriqc", "sub-02_T1w", cjv=0.4))
+    second_out = tmp_path / "out2"
+    second_out.mkdir()
+    store_path = update_iqm_store(files, second_out, work, "analysis-2", previous_store=first, export=True)
+
+    updates = (second_out / "project_group_T1w_updates.tsv").read_text().splitlines()
+    assert [line.split("\t")[0] for line in updates[1:]] == ["sub-02_T1w"]
+    full = (second_out / "project_group_T1w.tsv").read_text().splitlines()
+    assert [line.split("\t")[0] for line in full[1:]] == ["sub-01_T1w", "sub-02_T1w"]
+    assert (second_out / "project_group_T1w_stats.tsv").exists()
+    with sqlite3.connect(store_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0] == 2
+
+
+def test_newer_schema_is_refused(tmp_path):
+    path = tmp_path / STORE_NAME
+    with sqlite3.connect(path) as conn:
+        conn.execute("PRAGMA user_version = 99")
+
+    with pytest.raises(ValueError, match="newer gear"):
+        IqmStore(path)
@@ -0,0 +1,38 @@
+import json
+import time
+from types import SimpleNamespace
+
+from fw_gear_bids_mriqc.utils.iqm_watcher import IqmHarvester, _InotifyWatcher
+
+IQMS = {"cjv": 0.5, "provenance": {"md5sum": "abc"}}
+
+
+def test_unwatched_directories_are_scanned_when_the_run_ends(tmp_path, caplog):
+    harvester = IqmHarvester(SimpleNamespace(analysis_output_dir=tmp_path / "out"))
+    assert isinstance(harvester.watcher, _InotifyWatcher)
+    # As when fs.inotify.max_user_watches is exhausted
+    harvester.watcher._add_watch = lambda *args: -1
+    harvester.start()
+
+    iqm_file = tmp_path / "out" / "sub-01" / "anat" / "sub-01_T1w.json"
+    iqm_file.parent.mkdir(parents=True)
+    iqm_file.write_text(json.dumps(IQMS))
+    time.sleep(1.5)
+    harvester.stop()
+
+    assert harvester.confirmed_files() == [iqm_file]
+    assert harvester.index[iqm_file] == IQMS
+    assert "could not be watched" in caplog.text
+
+
+def test_polling_harvester_indexes_existing_files(tmp_path):
+    iqm_file = tmp_path / "out" / "sub-01" / "func" / "sub-01_task-rest_bold.json"
+    iqm_file.parent.mkdir(parents=True)
+    iqm_file.write_text(json.dumps(IQMS))
+    (iqm_file.parent / "dataset_description.json").write_text("{}")
+
+    harvester = IqmHarvester(SimpleNamespace(analysis_output_dir=tmp_path / "out"), polling=True, poll_interval=0.1)
+    harvester.start()
+    harvester.stop()
+
+    assert harvester.confirmed_files() == [iqm_file]
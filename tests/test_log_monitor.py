@@ -0,0 +1,67 @@
+import gzip
+import io
+import sys
+from unittest import mock
+
+import pytest
+
+from fw_gear_bids_mriqc.utils import log_monitor
+
+NIPYPE_LINES = [
+    '[Node] Setting-up "mriqc_wf.anatMRIQCWorkflow.SpatialNormalization" in "/work/sub-01/_in_file_sub-01_T1w"',
+    '[Node] Finished "mriqc_wf.anatMRIQCWorkflow.SpatialNormalization", elapsed time 12.5s.',
+]
+
+
+def read_log(output_dir):
+    stem = output_dir / "mriqc_log.txt"
+    if log_monitor.zstandard is not None:
+        with open(f"{stem}.zst", "rb") as fp:
+            return io.TextIOWrapper(log_monitor.zstandard.ZstdDecompressor().stream_reader(fp)).read()
+    with gzip.open(f"{stem}.gz", "rt") as fp:
+        return fp.read()
+
+
+def python_command(code):
+    return [sys.executable, "-c", code]
+
+
+def test_output_is_logged_and_timed(tmp_path):
+    code = "import sys; sys.stdout.write(" + repr("\n".join(NIPYPE_LINES) + "\n") + ")"
+
+    assert log_monitor.run_with_log_monitor(python_command(code), tmp_path, "mriqc", echo=False) == 0
+
+    assert read_log(tmp_path).splitlines() == NIPYPE_LINES
+    timing = (tmp_path / "mriqc_node_timing.tsv").read_text().splitlines()
+    assert timing[1].startswith("mriqc_wf.anatMRIQCWorkflow.SpatialNormalization\t1\t12.5")
+
+
+def test_undecodable_output_is_replaced(tmp_path):
+    code = r"import sys; sys.stdout.buffer.write(b'bad \xff byte\nnext line\n')"
+
+    log_monitor.run_with_log_monitor(python_command(code), tmp_path, "mriqc", echo=False)
+
+    assert read_log(tmp_path) == "bad � byte\nnext line\n"
+
+
+def test_failure_raises_with_the_command(tmp_path):
+    with pytest.raises(RuntimeError, match="has failed"):
+        log_monitor.run_with_log_monitor(python_command("raise SystemExit(3)"), tmp_path, "mriqc", echo=False)
+
+
+def test_process_is_killed_when_reading_fails(tmp_path):
+    code = "import time; print('started', flush=True); time.sleep(60)"
+    procs = []
+    popen = log_monitor.subprocess.Popen
+
+    def tracked_popen(*args, **kwargs):
+        procs.append(popen(*args, **kwargs))
+        return procs[-1]
+
+    with mock.patch.object(log_monitor.subprocess, "Popen", tracked_popen), mock.patch.object(
+        log_monitor.NodeTimer, "feed", side_effect=OSError("No space left on device")
+    ):
+        with pytest.raises(OSError):
+            log_monitor.run_with_log_monitor(python_command(code), tmp_path, "mriqc", echo=False)
+
+    assert procs[0].returncode is not None
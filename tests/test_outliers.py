@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from fw_gear_bids_mriqc.utils.iqm_store import STORE_NAME, IqmStore, iter_store_records  # noqa: E402
+from fw_gear_bids_mriqc.utils.outliers import build_matrix, robust_z_scores, score_outliers  # noqa: E402
+
+
+def write_iqms(out_dir, name, **iqms):
+    path = out_dir / f"{name}.json"
+    path.write_text(json.dumps({**iqms, "provenance": {"version": "23.1.0"}}))
+    return path
+
+
+def test_robust_z_scores_match_the_formula():
+    column = np.array([1.0, 2.0, 3.0, 4.0, 100.0])
+    matrix = np.column_stack([column, np.full(5, 7.0)])
+
+    z = robust_z_scores(matrix)
+
+    # median 3, MAD 1
+    np.testing.assert_allclose(z[:, 0], (column - 3.0) / 1.4826)
+    # Constant metrics are never outliers
+    assert not z[:, 1].any()
+
+
+def test_zero_mad_falls_back_to_the_mean_absolute_deviation():
+    column = np.array([5.0, 5.0, 5.0, 5.0, 9.0])
+
+    z = robust_z_scores(column[:, None])[:, 0]
+
+    mean_ad = np.mean(np.abs(column - 5.0))
+    np.testing.assert_allclose(z, (column - 5.0) / (1.2533 * mean_ad))
+
+
+def test_missing_values_stay_missing():
+    matrix = np.array([[1.0], [2.0], [np.nan], [3.0]])
+
+    z = robust_z_scores(matrix)
+
+    assert np.isnan(z[2, 0])
+    np.testing.assert_allclose(z[[0, 1, 3], 0], np.array([-1.0, 0.0, 1.0]) / 1.4826)
+
+
+def test_build_matrix_skips_geometry_and_text():
+    records = [{"cjv": 0.4, "size_x": 256, "spacing_x": 1.0, "summary_bg_k": None}, {"cjv": 0.5, "note": "x"}]
+
+    metrics, matrix = build_matrix(records)
+
+    assert metrics == ["cjv"]
+    np.testing.assert_array_equal(matrix, [[0.4], [0.5]])
+
+
+def test_score_outliers_flags_the_odd_scan(tmp_path):
+    files = [write_iqms(tmp_path, f"sub-{i:02d}_T1w", cjv=0.40 + i / 1000, snr=10.0 + i / 10) for i in range(1, 10)]
+    files.append(write_iqms(tmp_path, "sub-10_T1w", cjv=0.9, snr=10.5))
+
+    outliers = score_outliers(files)
+
+    assert set(outliers["sub-10_T1w"]["flagged"]) == {"cjv"}
+    assert outliers["sub-10_T1w"]["population"] == 10
+    assert outliers["sub-01_T1w"]["flagged"] == {}
+
+
+def test_store_scans_join_the_population(tmp_path):
+    earlier = tmp_path / "earlier"
+    earlier.mkdir()
+    store_files = [write_iqms(earlier, f"sub-{i:02d}_T1w", cjv=0.40 + i / 1000) for i in range(1, 10)]
+    with IqmStore(tmp_path / STORE_NAME) as store:
+        store.upsert(iter_store_records(store_files))
+
+    outliers = score_outliers([write_iqms(tmp_path, "sub-20_T1w", cjv=0.9)], store_path=tmp_path / STORE_NAME)
+
+    assert outliers["sub-20_T1w"]["population"] == 10
+    assert "cjv" in outliers["sub-20_T1w"]["flagged"]
+
+
+def test_input_matrix_is_not_modified():
+    matrix = np.array([[1.0], [2.0], [9.0]])
+
+    robust_z_scores(matrix)
+
+    np.testing.assert_array_equal(matrix, [[1.0], [2.0], [9.0]])
@@ -0,0 +1,77 @@
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+
+from fw_gear_bids_mriqc.utils import packaging
+
+
+@pytest.fixture
+def work_dir(tmp_path):
+    work_dir = tmp_path / "work"
+    for rel, data in {
+        "mriqc_wf/anat/ComputeIQMs/result.json": b'{"cjv": 0.4}',
+        "mriqc_wf/anat/figures/plot.svg": b"<svg/>" * 100,
+        "mriqc_wf/anat/figures/mask.nii.gz": b"\x1f\x8b" + b"0" * 100,
+        "mriqc_wf/func/figures/carpet.svg": b"<svg/>",
+        "mriqc_wf/func/report.rtf": b"rtf",
+    }.items():
+        (work_dir / rel).parent.mkdir(parents=True, exist_ok=True)
+        (work_dir / rel).write_bytes(data)
+    return work_dir
+
+
+def app_context_for(work_dir, files="", folders=""):
+    return SimpleNamespace(work_dir=work_dir, save_intermediate_files=files, save_intermediate_folders=folders)
+
+
+def test_zip_tree_matches_the_toolkit_layout(tmp_path, work_dir):
+    stats = packaging.zip_tree(tmp_path, "work", tmp_path / "work.zip", workers=2)
+
+    with zipfile.ZipFile(tmp_path / "work.zip") as archive:
+        assert archive.testzip() is None
+        names = archive.namelist()
+        assert "work/mriqc_wf/anat/figures/plot.svg" in names
+        assert archive.read("work/mriqc_wf/anat/ComputeIQMs/result.json") == b'{"cjv": 0.4}'
+        mask = archive.getinfo("work/mriqc_wf/anat/figures/mask.nii.gz")
+        assert mask.compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo("work/mriqc_wf/anat/figures/plot.svg").compress_type == zipfile.ZIP_DEFLATED
+    assert stats.files == 5
+    assert stats.bytes_in == sum(p.stat().st_size for p in work_dir.rglob("*") if p.is_file())
+
+
+def test_retained_files_and_folders_get_their_own_archives(tmp_path, work_dir):
+    out = tmp_path / "out"
+    out.mkdir()
+    app_context = app_context_for(work_dir, files="*.rtf mriqc_wf/**/ComputeIQMs/*.json", folders="figures")
+
+    phases = packaging.save_retained_work_files(app_context, out, "bids-mriqc_work", "proj_123", workers=2)
+
+    assert sorted(p.name for p in out.iterdir()) == [
+        "bids-mriqc_work_figures-2_proj_123.zip",
+        "bids-mriqc_work_figures_proj_123.zip",
+        "bids-mriqc_work_selected_files_proj_123.zip",
+    ]
+    assert len(phases) == 3
+    with zipfile.ZipFile(out / "bids-mriqc_work_selected_files_proj_123.zip") as archive:
+        assert sorted(archive.namelist()) == [
+            "work/mriqc_wf/anat/ComputeIQMs/result.json",
+            "work/mriqc_wf/func/report.rtf",
+        ]
+    with zipfile.ZipFile(out / "bids-mriqc_work_figures_proj_123.zip") as archive:
+        assert "figures/plot.svg" in archive.namelist()
+    with zipfile.ZipFile(out / "bids-mriqc_work_figures-2_proj_123.zip") as archive:
+        assert "figures/carpet.svg" in archive.namelist()
+
+
+def test_retention_dry_run_only_lists(tmp_path, work_dir):
+    out = tmp_path / "out"
+    out.mkdir()
+    app_context = app_context_for(work_dir, folders="anat")
+
+    assert packaging.save_retained_work_files(app_context, out, "bids-mriqc_work", "s", dry_run=True) == []
+
+    listing = (out / "bids-mriqc_work_selected_files_s.tsv").read_text().splitlines()
+    assert listing[0] == "path\ttype\tbytes"
+    assert listing[1].startswith("mriqc_wf/anat\tfolder\t")
+    assert not list(out.glob("*.zip"))
@@ -0,0 +1,70 @@
+import pytest
+
+from fw_gear_bids_mriqc.utils import resources
+from fw_gear_bids_mriqc.utils.resources import omp_threads_for, parse_mem_gb, with_resource_options
+
+SLURM_VARS = ["SLURM_JOB_ID", "SLURM_CPUS_PER_TASK", "SLURM_CPUS_ON_NODE", "SLURM_MEM_PER_NODE", "SLURM_MEM_PER_CPU"]
+
+
+@pytest.fixture
+def node(monkeypatch, tmp_path):
+    """A node with 16 CPUs and 64 GB, without cgroup limits or Slurm."""
+    for name in SLURM_VARS:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(resources, "available_cpus", lambda: 16)
+    monkeypatch.setattr(resources, "available_mem_gb", lambda: 64.0)
+    monkeypatch.setattr(resources, "CGROUP_ROOT", tmp_path / "cgroup")
+    return monkeypatch
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("4G", 4.0), ("512M", 0.5), ("2048", 2.0), ("1T", 1024.0), ("8GB", 8.0), ("", None), ("lots", None)],
+)
+def test_parse_mem_gb(value, expected):
+    assert parse_mem_gb(value) == expected
+
+
+def test_omp_threads():
+    assert [omp_threads_for(n) for n in [1, 2, 4, 32]] == [1, 1, 3, 8]
+
+
+def test_slurm_allocation_limits_the_node(node):
+    node.setenv("SLURM_JOB_ID", "1")
+    node.setenv("SLURM_CPUS_PER_TASK", "4")
+    node.setenv("SLURM_MEM_PER_CPU", "2G")
+
+    found = resources.gear_resources({})
+
+    assert (found["cpus"], found["mem_gb"]) == (4, 8.0)
+    assert found["limited_by"] == {"cpus": "slurm", "mem_gb": "slurm"}
+
+
+def test_cgroup_v2_limits(node, tmp_path):
+    cgroup = tmp_path / "cgroup"
+    cgroup.mkdir()
+    (cgroup / "cpu.max").write_text("200000 100000\n")
+    (cgroup / "memory.max").write_text(str(6 * 1024**3))
+
+    assert resources.cgroup_cpu_limit() == 2.0
+    assert resources.cgroup_mem_limit_gb() == 6.0
+
+
+def test_resource_options_are_added(node):
+    command = with_resource_options(["mriqc", "/bids", "/out", "participant"], {})
+
+    assert command[4:] == ["--nprocs=16", "--omp-nthreads=8", "--mem_gb=57"]
+
+
+def test_user_options_are_kept_in_any_spelling(node):
+    command = ["mriqc", "/bids", "/out", "participant", "--n_procs", "4", "--mem-gb", "10"]
+
+    added = with_resource_options(command, {})
+
+    assert added == command + ["--omp-nthreads=3"]
+
+
+def test_auto_resources_off(node):
+    command = ["mriqc", "/bids", "/out", "participant"]
+
+    assert with_resource_options(command, {"gear-auto-resources": False}) == command
@@ -0,0 +1,36 @@
+from fw_gear_bids_mriqc.utils.retention import RetentionRules
+
+
+def make_tree(top, paths):
+    for rel in paths:
+        (top / rel).parent.mkdir(parents=True, exist_ok=True)
+        (top / rel).write_text("x" * 10)
+
+
+def relative_matches(rules, top):
+    return [(rel, is_folder) for _, rel, _, is_folder in rules.walk(top)]
+
+
+def test_name_patterns_match_anywhere(tmp_path):
+    make_tree(tmp_path, ["a.rtf", "deep/er/b.rtf", "deep/c.txt"])
+
+    assert relative_matches(RetentionRules("*.rtf", None), tmp_path) == [("a.rtf", False), ("deep/er/b.rtf", False)]
+
+
+def test_anchored_patterns_and_double_star(tmp_path):
+    make_tree(tmp_path, ["wf/x/ComputeIQMs/a.json", "wf/ComputeIQMs/b.json", "other/ComputeIQMs/c.json"])
+
+    matches = relative_matches(RetentionRules(["wf/**/ComputeIQMs/*.json"], None), tmp_path)
+
+    assert matches == [("wf/ComputeIQMs/b.json", False), ("wf/x/ComputeIQMs/a.json", False)]
+
+
+def test_folders_are_yielded_once_and_not_walked(tmp_path):
+    make_tree(tmp_path, ["wf/figures/a.svg", "wf/figures/sub/b.svg"])
+
+    assert relative_matches(RetentionRules(None, "figures"), tmp_path) == [("wf/figures", True)]
+
+
+def test_no_patterns_is_falsy():
+    assert not RetentionRules("", None)
+    assert RetentionRules(None, "figures")
@@ -0,0 +1,70 @@
+import pytest
+
+from fw_gear_bids_mriqc.utils import run_cache
+from fw_gear_bids_mriqc.utils.resources import MEM_OPTIONS, NPROCS_OPTIONS, OMP_OPTIONS
+from fw_gear_bids_mriqc.utils.run_cache import RunCache, relevant_flags
+
+
+@pytest.fixture
+def bids_dir(tmp_path):
+    bids_dir = tmp_path / "bids"
+    for participant in ["01", "02"]:
+        anat = bids_dir / f"sub-{participant}" / "anat"
+        anat.mkdir(parents=True)
+        (anat / f"sub-{participant}_T1w.nii.gz").write_bytes(participant.encode() * 10)
+        (anat / f"sub-{participant}_T1w.json").write_text("{}")
+    (bids_dir / "dataset_description.json").write_text('{"Name": "test"}')
+    return bids_dir
+
+
+@pytest.fixture
+def fixed_version(monkeypatch):
+    monkeypatch.setattr(run_cache, "mriqc_version", lambda binary: "MRIQC v23.1.0")
+
+
+def test_ignored_options_cover_every_resource_spelling():
+    for name in NPROCS_OPTIONS + OMP_OPTIONS + MEM_OPTIONS:
+        assert name in run_cache.IGNORED_OPTIONS
+
+
+def test_relevant_flags_strips_positionals_wherever_they_are():
+    expected = ["--fd_thres", "0.3", "-m", "T1w"]
+    in_order = ["mriqc", "/bids", "/out", "participant", "--fd_thres", "0.3", "-m", "T1w", "--mem-gb", "8"]
+    options_first = ["mriqc", "--nprocs", "4", "--fd_thres", "0.3", "/bids", "/out", "participant", "-m", "T1w"]
+
+    assert relevant_flags(in_order, ["/bids", "/out"]) == expected
+    assert relevant_flags(options_first, ["/bids", "/out"]) == expected
+
+
+def test_participant_fingerprint_changes_with_the_inputs(bids_dir):
+    before = run_cache.participant_fingerprint(bids_dir, "01")
+    assert run_cache.participant_fingerprint(bids_dir, "01", salt="other flags") != before
+
+    (bids_dir / "sub-02" / "anat" / "sub-02_T1w.json").write_text('{"EchoTime": 0.003}')
+    assert run_cache.participant_fingerprint(bids_dir, "01") == before
+
+    (bids_dir / "sub-01" / "anat" / "sub-01_T1w.json").write_text('{"EchoTime": 0.003}')
+    assert run_cache.participant_fingerprint(bids_dir, "01") != before
+
+
+def test_saved_participants_are_reused_until_their_inputs_change(tmp_path, bids_dir, fixed_version):
+    out = tmp_path / "out"
+    command = ["mriqc", str(bids_dir), str(out), "participant", "--nprocs", "4"]
+    for participant in ["01", "02"]:
+        (out / f"sub-{participant}" / "anat").mkdir(parents=True)
+        (out / f"sub-{participant}" / "anat" / f"sub-{participant}_T1w.json").write_text('{"cjv": 0.4}')
+        (out / f"sub-{participant}_T1w.html").write_text("<html/>")
+    RunCache(tmp_path / "cache", bids_dir, command, out).save(["01", "02"], out)
+
+    (bids_dir / "sub-02" / "anat" / "sub-02_T1w.nii.gz").write_bytes(b"new scan")
+    # Resource settings do not invalidate the cache
+    cache = RunCache(tmp_path / "cache", bids_dir, command[:4] + ["--nprocs", "16"], out)
+    assert cache.partition(["01", "02"]) == (["01"], ["02"])
+
+    restored = tmp_path / "restored"
+    cache.restore(["01"], restored)
+    assert (restored / "sub-01" / "anat" / "sub-01_T1w.json").read_text() == '{"cjv": 0.4}'
+    assert (restored / "sub-01_T1w.html").exists()
+
+    other_flags = RunCache(tmp_path / "cache", bids_dir, command + ["--fd_thres", "0.3"], out)
+    assert other_flags.partition(["01"]) == ([], ["01"])
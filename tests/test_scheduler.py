@@ -0,0 +1,66 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+from fw_gear_bids_mriqc.utils import scheduler
+from fw_gear_bids_mriqc.utils.scheduler import WorkUnit
+
+# Stands in for mriqc: writes the participant's output, and fails for sub-02
+FAKE_MRIQC = """
+import sys
+from pathlib import Path
+out, label = Path(sys.argv[1]), sys.argv[sys.argv.index("--participant-label") + 1]
+print(f"running {label}")
+if label == "02":
+    raise SystemExit(1)
+(out / f"sub-{label}").mkdir(parents=True)
+(out / f"sub-{label}" / f"sub-{label}_T1w.json").write_text("{}")
+"""
+
+
+def test_build_unit_command_keeps_user_resources(tmp_path):
+    command = ["mriqc", "/bids", "/out", "participant", "--participant-label", "01", "02", "--n_procs", "3"]
+
+    unit_cmd = scheduler.build_unit_command(command, WorkUnit("01", "pre"), tmp_path, {"nprocs": 8, "mem_gb": 16})
+
+    assert unit_cmd[:4] == ["mriqc", "/bids", str(tmp_path / "out"), "participant"]
+    assert unit_cmd[unit_cmd.index("--participant-label") + 1 :][:2] == ["01", "--session-id"]
+    assert "--nprocs" not in unit_cmd and "--n_procs" in unit_cmd
+    assert unit_cmd[unit_cmd.index("--mem_gb") + 1] == "16"
+    assert unit_cmd[unit_cmd.index("-w") + 1] == str(tmp_path / "work")
+
+
+def test_discover_work_units(tmp_path):
+    for path in ["sub-01/ses-a", "sub-01/ses-b", "sub-02/anat", "sub-03/ses-a"]:
+        (tmp_path / path).mkdir(parents=True)
+
+    assert scheduler.discover_work_units(tmp_path, participants=["01", "02"]) == [WorkUnit("01"), WorkUnit("02")]
+    assert [u.label for u in scheduler.discover_work_units(tmp_path, by_session=True)] == [
+        "sub-01_ses-a",
+        "sub-01_ses-b",
+        "sub-02",
+        "sub-03_ses-a",
+    ]
+
+
+def test_run_work_units_logs_each_unit(tmp_path, monkeypatch):
+    script = tmp_path / "fake_mriqc.py"
+    script.write_text(FAKE_MRIQC)
+    monkeypatch.delenv("SLURM_CPUS_PER_TASK", raising=False)
+    app_context = SimpleNamespace(
+        work_dir=tmp_path / "work",
+        analysis_output_dir=tmp_path / "out",
+        bids_app_binary="mriqc",
+        gear_dry_run=False,
+    )
+    command = [sys.executable, str(script), str(tmp_path / "out"), "participant"]
+
+    e_code = scheduler.run_work_units(
+        app_context, command, [WorkUnit("01"), WorkUnit("02")], {"gear-unit-retries": 0}
+    )
+
+    assert e_code == 1
+    assert (tmp_path / "out" / "sub-01" / "sub-01_T1w.json").exists()
+    log_dir = Path(app_context.analysis_output_dir) / "logs" / "units"
+    assert sorted(p.name.split("_log.txt")[0] for p in log_dir.glob("*_log.txt.*")) == ["mriqc_sub-01", "mriqc_sub-02"]
+    assert (log_dir / "mriqc_sub-01_node_timing.tsv").exists()
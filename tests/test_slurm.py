@@ -0,0 +1,87 @@
+import logging
+import shlex
+import stat
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from fw_gear_bids_mriqc.utils import slurm
+
+SBATCH = """#!/bin/bash
+script="${@: -1}"
+echo "$script" >> "$(dirname "$script")/submitted.txt"
+case "$script" in
+  *group.sh) echo 0 > "$(dirname "$script")/group.status"; echo 102 ;;
+  *) echo 101 ;;
+esac
+"""
+SQUEUE = "#!/bin/bash\nexit 0\n"
+SACCT = "#!/bin/bash\necho '101|COMPLETED'\necho '102|COMPLETED'\n"
+
+
+@pytest.fixture
+def slurm_bin(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, body in {"sbatch": SBATCH, "squeue": SQUEUE, "sacct": SACCT}.items():
+        shim = bin_dir / name
+        shim.write_text(body)
+        shim.chmod(shim.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{Path('/usr/bin')}:{Path('/bin')}")
+    monkeypatch.delenv("SINGULARITY_CONTAINER", raising=False)
+    return bin_dir
+
+
+@pytest.fixture
+def app_context(tmp_path):
+    bids_dir = tmp_path / "bids"
+    for label in ["01", "02", "03"]:
+        (bids_dir / f"sub-{label}" / "anat").mkdir(parents=True)
+    return SimpleNamespace(
+        bids_dir=bids_dir,
+        work_dir=tmp_path / "work",
+        analysis_output_dir=tmp_path / "out",
+        bids_app_binary="mriqc",
+        destination_id="abc123",
+        gear_dry_run=False,
+    )
+
+
+def group_command(app_context, *args):
+    return ["mriqc", str(app_context.bids_dir), str(app_context.analysis_output_dir), "group", *args]
+
+
+def test_write_job_scripts_keeps_only_the_requested_participants(app_context, tmp_path):
+    command = group_command(app_context, "--participant-label", "sub-01", "03", "-m", "T1w")
+
+    scripts = slurm.write_job_scripts(app_context, command, {"slurm-cpu": "2"}, tmp_path / "slurm")
+
+    assert scripts["units"] == ["sub-01", "sub-03"]
+    tasks = [shlex.split(line) for line in (tmp_path / "slurm" / "tasks.txt").read_text().splitlines()]
+    for task, label in zip(tasks, ["01", "03"]):
+        assert task.count("--participant-label") == 1
+        assert task[task.index("--participant-label") + 1 : task.index("--participant-label") + 3] == [label, "-w"]
+    assert "--array=1-2" in scripts["array"].read_text()
+
+
+def test_fan_out_reports_planned_units_without_outputs(app_context, slurm_bin, caplog):
+    units_root = Path(app_context.work_dir).resolve() / slurm.UNITS_DIR
+    (units_root / "sub-01" / "out" / "sub-01").mkdir(parents=True)
+    # sub-02 has outputs from an earlier run, but was not requested this time
+    (units_root / "sub-02" / "out" / "sub-02").mkdir(parents=True)
+    command = group_command(app_context, "--participant_label", "01", "03")
+
+    with caplog.at_level(logging.WARNING):
+        e_code = slurm.fan_out_to_slurm(app_context, command, {})
+
+    assert e_code == 0
+    submitted = (Path(app_context.work_dir).resolve() / slurm.SLURM_DIR / "submitted.txt").read_text().splitlines()
+    assert [Path(s).name for s in submitted] == ["participant_array.sh", "group.sh"]
+    assert "No outputs from 1 participant task(s): sub-03" in caplog.text
+
+
+def test_fan_out_with_no_matching_participants(app_context, slurm_bin):
+    command = group_command(app_context, "--participant-label", "99")
+
+    assert slurm.fan_out_to_slurm(app_context, command, {}) == 1